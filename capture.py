@@ -0,0 +1,158 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import graphics as gr
+
+import OpenGL.GL as gl
+import numpy as np
+import ctypes
+import threading
+import queue
+import struct
+import zlib
+import os
+
+# Asynchronous frame capture
+# --------------------------
+# Frames are rendered into an offscreen framebuffer and read back through a ring
+# of pixel pack buffers (PBOs). glReadPixels into a PBO returns immediately, a
+# fence tells when the copy is done so the data is only mapped once it is
+# available, some frames later. The frames are then handed to a background
+# thread which encodes them. The simulation thus (almost) never waits for the
+# readback or the encoding.
+#
+# Formats:
+#   'png' -> path is a directory, frames are written as frame_000000.png, ...
+#   'raw' -> path is a file with all frames as raw rgb24 appended, convert with
+#            ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r 30 -i path out.mp4
+
+def writePNG(path:str, image:np.ndarray):
+    """ Write an (H,W,3) uint8 image as png (no extra dependencies)
+    """
+    height, width, _ = image.shape
+    # Filter type 0 (none) in front of each row
+    rows = np.zeros([height, width*3+1], dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, width*3)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+class FrameCapture():
+    def __init__(self, path:str, width:int, height:int, format:str='png', ringSize:int=3, queueSize:int=16):
+        """ Create frame capture
+        parameters:
+            path : str          Directory (png) or file (raw) to write to
+            width : int         Width of the captured frames
+            height : int        Height of the captured frames
+            format : str        'png' for a png sequence or 'raw' for a raw rgb24 video
+            ringSize : int      Amount of PBOs used for the readback
+            queueSize : int     Amount of frames which may wait for the encoder
+        """
+        if format not in ('png', 'raw'):
+            raise ValueError("Unknown capture format '%s'"%format)
+        self.path = path
+        self.width = width
+        self.height = height
+        self.format = format
+        self.frameSize = width*height*4
+        self.frameNumber = 0
+
+        self.framebuffer = gr.Framebuffer(width, height)
+        self.pbos = []
+        for i in range(ringSize):
+            pbo = gr.Buffer(gr.PIXEL_PACK_BUFFER, gr.STREAM_READ)
+            pbo.reserveData(self.frameSize)
+            self.pbos.append(pbo)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.pending = []           # [(pbo index, fence, frame number)]
+        self.nextPBO = 0
+
+        if format == 'png':
+            os.makedirs(path, exist_ok=True)
+            self.file = None
+        else:
+            self.file = open(path, 'wb')
+
+        self.queue = queue.Queue(queueSize)
+        self.thread = threading.Thread(target=self._encoder, daemon=True)
+        self.thread.start()
+
+    def begin(self):
+        """ Bind the offscreen framebuffer, draw the frame after this
+        """
+        self.framebuffer.bind()
+        gl.glClearColor(1.0, 1.0, 1.0, 1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+
+    def end(self):
+        """ Start the asynchronous readback of the drawn frame
+        """
+        # Make room in the ring
+        if len(self.pending) == len(self.pbos):
+            self._collect(wait=True)
+
+        pbo = self.pbos[self.nextPBO]
+        pbo.bind()
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.framebuffer.unbind()
+
+        self.pending.append((self.nextPBO, fence, self.frameNumber))
+        self.nextPBO = (self.nextPBO + 1) % len(self.pbos)
+        self.frameNumber += 1
+
+        # Hand over every frame which is already done
+        self._collect(wait=False)
+
+    def _collect(self, wait:bool):
+        # Map the finished PBOs (oldest first) and send them to the encoder
+        while len(self.pending) > 0:
+            index, fence, number = self.pending[0]
+            timeout = gl.GL_TIMEOUT_IGNORED if wait else 0
+            status = gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+            if status not in (gl.GL_ALREADY_SIGNALED, gl.GL_CONDITION_SATISFIED):
+                return
+            gl.glDeleteSync(fence)
+            self.pending.pop(0)
+
+            pbo = self.pbos[index]
+            pbo.bind()
+            ptr = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, self.frameSize, gl.GL_MAP_READ_BIT)
+            frame = np.frombuffer((ctypes.c_ubyte*self.frameSize).from_address(ptr), dtype=np.uint8).copy()
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+            self.queue.put((number, frame))
+            wait = False
+
+    def _encoder(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            number, frame = item
+            # OpenGL rows start at the bottom
+            image = frame.reshape(self.height, self.width, 4)[::-1, :, 0:3]
+            try:
+                if self.format == 'png':
+                    writePNG(os.path.join(self.path, 'frame_%06d.png'%number), image)
+                else:
+                    self.file.write(np.ascontiguousarray(image).tobytes())
+            except Exception as e:
+                logger.error("ERROR: could not write frame %d: %s"%(number, e))
+
+    def close(self):
+        """ Read back the remaining frames and wait for the encoder
+        """
+        self._collect(wait=True)
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+        logger.info("Captured %d frames to %s"%(self.frameNumber, self.path))
@@ -0,0 +1,95 @@
+import numpy as np
+
+from typing import Dict
+
+# Checkpoint file format
+# ----------------------
+# A checkpoint is a single binary file which is memory-mapped for reading and
+# writing. It starts with a fixed header followed by a section table and the
+# raw section data (each section aligned to 64 bytes):
+#   header   -> magic, version, N, M, stepCount, time, number of sections
+#   sections -> [{name, offset in file, size in bytes}]
+#   data     -> raw bytes of each section (i.e. the content of a GPU buffer)
+
+MAGIC = b'FLOCKCKP'
+VERSION = 1
+ALIGNMENT = 64
+
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('N', '<u4'),
+    ('M', '<u4'),
+    ('sections', '<u4'),
+    ('stepCount', '<u8'),
+    ('time', '<f8'),
+])
+
+SECTION = np.dtype([
+    ('name', 'S24'),
+    ('offset', '<u8'),
+    ('size', '<u8'),
+])
+
+def _align(offset:int):
+    return (offset + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+def write(path:str, N:int, M:int, stepCount:int, time:float, sections:Dict[str, np.ndarray]):
+    """ Write a checkpoint file
+    parameters:
+        path : str          File to write to
+        N, M : int          Amount of vehicles and obstacles
+        stepCount : int     Step count of the simulation
+        time : float        Elapsed simulation time
+        sections : dict     Name -> data (numpy array or bytes) of each section
+    """
+    data = {name:np.frombuffer(d, dtype=np.uint8) if isinstance(d, (bytes, bytearray)) else np.ascontiguousarray(d).reshape(-1).view(np.uint8)
+        for name, d in sections.items()}
+
+    # Layout of the file
+    offset = _align(HEADER.itemsize + SECTION.itemsize*len(data))
+    table = np.zeros(len(data), dtype=SECTION)
+    for i, (name, d) in enumerate(data.items()):
+        table[i] = (name.encode(), offset, d.nbytes)
+        offset = _align(offset + d.nbytes)
+
+    mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(offset, 1),))
+    header = np.zeros(1, dtype=HEADER)
+    header[0] = (MAGIC, VERSION, N, M, len(data), stepCount, time)
+    mm[:HEADER.itemsize] = header.view(np.uint8)
+    mm[HEADER.itemsize:HEADER.itemsize+table.nbytes] = table.view(np.uint8)
+    for t, d in zip(table, data.values()):
+        mm[t['offset']:t['offset']+t['size']] = d
+    mm.flush()
+    del mm
+
+class Checkpoint():
+    def __init__(self, path:str):
+        """ Open a checkpoint file (read only, memory-mapped)
+        Sections are returned as uint8 views on the mapped file, nothing is
+        read from disk before it is used.
+        """
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r')
+        header = self.mm[:HEADER.itemsize].view(HEADER)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError("%s is not a checkpoint file"%path)
+        if header['version'] != VERSION:
+            raise ValueError("Checkpoint version %d is not supported"%header['version'])
+        self.N = int(header['N'])
+        self.M = int(header['M'])
+        self.stepCount = int(header['stepCount'])
+        self.time = float(header['time'])
+        table = self.mm[HEADER.itemsize:HEADER.itemsize+SECTION.itemsize*int(header['sections'])].view(SECTION)
+        self.sections = {t['name'].decode():(int(t['offset']), int(t['size'])) for t in table}
+
+    def __contains__(self, name:str):
+        return name in self.sections
+
+    def __getitem__(self, name:str):
+        offset, size = self.sections[name]
+        return self.mm[offset:offset+size]
+
+    def get(self, name:str, dtype):
+        """ Return a section interpreted as an array of dtype
+        """
+        return self[name].view(dtype)
@@ -1,6 +1,8 @@
 from .window import Window
+from .framebuffer import Framebuffer
+from .passgraph import PassGraph
 
-from .shader import Shader, ShaderProgram, VERTEX_SHADER, FRAGMENT_SHADER, COMPUTE_SHADER
-from .buffer import Buffer, VERTEX_BUFFER, INDEX_BUFFER, UNIFORM_BUFFER, SHADER_STORAGE_BUFFER, STATIC_DRAW, DYNAMIC_DRAW, VertexArray, VertexElement, FLOAT, INT, UINT
-from .draw import draw, drawInstanced, drawLines, drawLinesInstanced
+from .shader import Shader, ShaderProgram, CommandList, memoryBarrier, VERTEX_SHADER, FRAGMENT_SHADER, COMPUTE_SHADER
+from .buffer import Buffer, VERTEX_BUFFER, INDEX_BUFFER, UNIFORM_BUFFER, SHADER_STORAGE_BUFFER, DRAW_INDIRECT_BUFFER, DISPATCH_INDIRECT_BUFFER, PIXEL_PACK_BUFFER, STATIC_DRAW, DYNAMIC_DRAW, STREAM_READ, copyBuffer, VertexArray, VertexElement, FLOAT, INT, UINT
+from .draw import draw, drawInstanced, drawLines, drawLinesInstanced, drawIndirect
 print("Graphics import succeeded")
\ No newline at end of file
@@ -12,9 +12,19 @@ VERTEX_BUFFER = gl.GL_ARRAY_BUFFER
 INDEX_BUFFER = gl.GL_ELEMENT_ARRAY_BUFFER
 UNIFORM_BUFFER = gl.GL_UNIFORM_BUFFER
 SHADER_STORAGE_BUFFER = gl.GL_SHADER_STORAGE_BUFFER
+DRAW_INDIRECT_BUFFER = gl.GL_DRAW_INDIRECT_BUFFER
+DISPATCH_INDIRECT_BUFFER = gl.GL_DISPATCH_INDIRECT_BUFFER
+PIXEL_PACK_BUFFER = gl.GL_PIXEL_PACK_BUFFER
 
 STATIC_DRAW = gl.GL_STATIC_DRAW
 DYNAMIC_DRAW = gl.GL_DYNAMIC_DRAW
+STREAM_READ = gl.GL_STREAM_READ
+
+def _raw(data : np.array):
+    # Structured arrays (see schema.py) are uploaded as plain bytes
+    if data.dtype.names is not None:
+        return data.reshape(-1).view(np.uint8)
+    return data
 
 class Buffer():
     def __init__(self, type : gl.Constant, usage : gl.Constant):
@@ -23,12 +33,14 @@ class Buffer():
 
         self.ID = gl.glGenBuffers(1)
         self.length = 0
+        self._view = None
 
     def __del__(self):
         gl.glDeleteBuffers(1, self.ID)
 
     def setData(self, data : np.array):
         self.bind()
+        data = _raw(data)
         gl.glBufferData(self.type, data, self.usage)
         self.length = data.nbytes
 
@@ -39,7 +51,12 @@ class Buffer():
 
     def subData(self, data : np.array, offset : int = 0):
         self.bind()
-        gl.glBufferSubData(self.type, offset, data)
+        gl.glBufferSubData(self.type, offset, _raw(data))
+
+    def clear(self):
+        # Zero the buffer without reallocating it (length must be a multiple of 4)
+        self.bind()
+        gl.glClearBufferData(self.type, gl.GL_R32UI, gl.GL_RED_INTEGER, gl.GL_UNSIGNED_INT, None)
 
     def getData(self, length : int, offset : int = 0):
         self.bind()
@@ -47,6 +64,19 @@ class Buffer():
             length = self.length
         return gl.glGetBufferSubData(self.type, offset, length)
 
+    def view(self, dtype : np.dtype, count : int = -1):
+        # Read the buffer into a host array of count records of dtype (i.e. a structured
+        # dtype of schema.py). The array is allocated once and reused by the next calls
+        # with the same dtype and count, so it is overwritten by the next view
+        dtype = np.dtype(dtype)
+        if count < 0:
+            count = self.length // dtype.itemsize
+        if self._view is None or self._view.dtype != dtype or len(self._view) != count:
+            self._view = np.empty(count, dtype=dtype)
+        self.bind()
+        gl.glGetBufferSubData(self.type, 0, self._view.nbytes, _raw(self._view))
+        return self._view
+
     def bind(self):
         gl.glBindBuffer(self.type, self.ID)
 
@@ -56,6 +86,14 @@ class Buffer():
         else:
             gl.glBindBufferBase(SHADER_STORAGE_BUFFER, index, self.ID)
 
+def copyBuffer(source : Buffer, destination : Buffer, length : int = 0, sourceOffset : int = 0, destinationOffset : int = 0):
+    # Copy on the GPU, length 0 copies the whole source
+    if length == 0:
+        length = source.length
+    gl.glBindBuffer(gl.GL_COPY_READ_BUFFER, source.ID)
+    gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, destination.ID)
+    gl.glCopyBufferSubData(gl.GL_COPY_READ_BUFFER, gl.GL_COPY_WRITE_BUFFER, sourceOffset, destinationOffset, length)
+
 FLOAT = gl.GL_FLOAT
 INT = gl.GL_INT
 UINT = gl.GL_UNSIGNED_INT
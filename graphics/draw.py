@@ -18,3 +18,6 @@ def drawInstanced(count : int, instanceCount : int, start : int = 0):
 def drawLinesInstanced(count : int, instanceCount, start : int = 0):
     gl.glDrawElementsInstanced(gl.GL_LINES, count, gl.GL_UNSIGNED_INT, ctypes.c_void_p(start*4), instanceCount)
 
+def drawIndirect(offset : int = 0):
+    gl.glDrawElementsIndirect(gl.GL_TRIANGLES, gl.GL_UNSIGNED_INT, ctypes.c_void_p(offset))
+
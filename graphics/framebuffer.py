@@ -0,0 +1,33 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import OpenGL.GL as gl
+
+class Framebuffer():
+    def __init__(self, width : int, height : int):
+        self.width = width
+        self.height = height
+
+        self.ID = gl.glGenFramebuffers(1)
+        self.colorID = gl.glGenRenderbuffers(1)
+
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.colorID)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_RGBA8, width, height)
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.ID)
+        gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_RENDERBUFFER, self.colorID)
+        if gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER) != gl.GL_FRAMEBUFFER_COMPLETE:
+            logger.error("ERROR: framebuffer is not complete")
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+    def __del__(self):
+        gl.glDeleteFramebuffers(1, [self.ID])
+        gl.glDeleteRenderbuffers(1, [self.colorID])
+
+    def bind(self):
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.ID)
+        gl.glViewport(0, 0, self.width, self.height)
+
+    def unbind(self):
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
\ No newline at end of file
@@ -0,0 +1,105 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import OpenGL.GL as gl
+
+from typing import Callable, Sequence
+
+from .shader import ShaderProgram, memoryBarrier
+
+class Pass():
+    # Compute or draw pass (a function issuing the GL calls) with the buffer bindings
+    # it reads and writes. Bindings in indirect are read as indirect commands
+    def __init__(self, name : str, function : Callable, reads : Sequence[int], writes : Sequence[int], indirect : Sequence[int], programs : Sequence[ShaderProgram], ordered : bool):
+        self.name = name
+        self.function = function
+        self.reads = set(reads)
+        self.writes = set(writes)
+        self.indirect = set(indirect)
+        self.programs = programs
+        self.ordered = ordered
+
+    def accesses(self):
+        return self.reads | self.writes | self.indirect
+
+    def dependsOn(self, other):
+        # Read after write, write after write or write after read
+        if self.ordered and other.ordered:
+            return True
+        return len(other.writes & self.accesses()) > 0 or len(self.writes & (other.reads | other.indirect)) > 0
+
+class PassGraph():
+    # Schedules passes by their declared accesses. Passes without hazards between
+    # them run in the same batch, between batches one barrier with only the bits
+    # the next batch needs is issued. The hazard state is kept between runs, so the
+    # passes of a run also wait for the writes of the previous run. Ordered passes
+    # (i.e. draws to the same framebuffer) keep their order without a barrier.
+    # With debug the accessed bindings of the programs of each pass are checked
+    # against the declaration
+    def __init__(self, debug : bool = False):
+        self.debug = debug
+        self.passes = []
+        self.dirty = {}         # binding -> barrier bits issued since its last write
+        self.read = set()       # bindings read since the last barrier
+        self.barriers = 0       # barriers issued (statistics)
+
+    def add(self, name : str, function : Callable, reads : Sequence[int] = (), writes : Sequence[int] = (), indirect : Sequence[int] = (), programs : Sequence[ShaderProgram] = (), ordered : bool = False):
+        self.passes.append(Pass(name, function, reads, writes, indirect, programs, ordered))
+
+    def batches(self):
+        # Each pass goes in the batch after the last pass it depends on
+        levels = []
+        for i, p in enumerate(self.passes):
+            level = 0
+            for j in range(i):
+                if p.dependsOn(self.passes[j]):
+                    level = max(level, levels[j]+1)
+            levels.append(level)
+        batches = [[] for _ in range(max(levels, default=-1)+1)]
+        for p, level in zip(self.passes, levels):
+            batches[level].append(p)
+        return batches
+
+    def run(self, loop : bool = False):
+        # Execute the added passes, loop if the passes run again right after (i.e.
+        # a recorded CommandList which is replayed)
+        for batch in self.batches():
+            self._barrier(batch)
+            for p in batch:
+                if self.debug:
+                    self._validate(p)
+                p.function()
+            for p in batch:
+                self.read |= p.reads | p.indirect
+                for binding in p.writes:
+                    self.dirty[binding] = 0
+        if loop:
+            self._barrier(self.passes)
+        self.passes = []
+
+    def _barrier(self, batch : Sequence[Pass]):
+        bits = 0
+        for p in batch:
+            for binding in p.reads:
+                if binding in self.dirty and not self.dirty[binding] & gl.GL_SHADER_STORAGE_BARRIER_BIT:
+                    bits |= gl.GL_SHADER_STORAGE_BARRIER_BIT
+            for binding in p.indirect:
+                if binding in self.dirty and not self.dirty[binding] & gl.GL_COMMAND_BARRIER_BIT:
+                    bits |= gl.GL_COMMAND_BARRIER_BIT
+            for binding in p.writes:
+                if binding in self.read or (binding in self.dirty and self.dirty[binding] == 0):
+                    bits |= gl.GL_SHADER_STORAGE_BARRIER_BIT
+        if bits == 0:
+            return
+        memoryBarrier(bits)
+        self.barriers += 1
+        for binding in self.dirty:
+            self.dirty[binding] |= bits
+        self.read = set()
+
+    def _validate(self, p : Pass):
+        declared = p.accesses()
+        for program in p.programs:
+            for binding in program.storageBindings():
+                if binding not in declared:
+                    logger.error("ERROR: pass %s accesses binding %d which it does not declare"%(p.name, binding))
\ No newline at end of file
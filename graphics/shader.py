@@ -5,15 +5,62 @@ import glfw
 import OpenGL.GL as gl
 import numpy as np
 import ctypes
+import contextlib
 
-from typing import Sequence
+from typing import Callable, Sequence
 
 VERTEX_SHADER = gl.GL_VERTEX_SHADER
 FRAGMENT_SHADER = gl.GL_FRAGMENT_SHADER
 COMPUTE_SHADER = gl.GL_COMPUTE_SHADER
 
+# Maximum amount of workgroups of one dispatch in x, y and z (queried once)
+_maxGroupCount = None
+
+def maxGroupCount():
+    global _maxGroupCount
+    if _maxGroupCount is None:
+        _maxGroupCount = tuple(int(gl.glGetIntegeri_v(gl.GL_MAX_COMPUTE_WORK_GROUP_COUNT, i)[0]) for i in range(3))
+    return _maxGroupCount
+
+class CommandList():
+    # Recorded sequence of GL calls (dispatches and barriers) which can be replayed
+    # many times with little Python overhead. While recording, ShaderProgram.dispatch
+    # adds its calls to the list instead of executing them
+    recording = None
+
+    def __init__(self):
+        self.commands = []
+
+    @contextlib.contextmanager
+    def record(self):
+        CommandList.recording = self
+        try:
+            yield self
+        finally:
+            CommandList.recording = None
+
+    def add(self, function : Callable, *args):
+        self.commands.append((function, args))
+
+    def barrier(self, bits : int):
+        self.add(gl.glMemoryBarrier, bits)
+
+    def replay(self, n : int = 1):
+        commands = self.commands
+        for _ in range(n):
+            for function, args in commands:
+                function(*args)
+
+def memoryBarrier(bits : int):
+    # Recorded as well when a CommandList is recording
+    if CommandList.recording is not None:
+        CommandList.recording.barrier(bits)
+    else:
+        gl.glMemoryBarrier(bits)
+
 class Shader():
     def __init__(self, source, type):
+        self.type = type
         self.ID = gl.glCreateShader(type)
         gl.glShaderSource(self.ID, [source])
         gl.glCompileShader(self.ID)
@@ -38,15 +85,89 @@ class ShaderProgram():
             gl.glAttachShader(self.ID, shd.ID)
 
         gl.glLinkProgram(self.ID)
-        if gl.glGetProgramiv(self.ID, gl.GL_LINK_STATUS) != gl.GL_TRUE:
+        self.linked = gl.glGetProgramiv(self.ID, gl.GL_LINK_STATUS) == gl.GL_TRUE
+        if not self.linked:
             logger.error("ERROR: could not link shader program:\r\n" + str(gl.glGetProgramInfoLog(self.ID), "utf-8"))
 
+        # Tile offset of dispatches (uGroupOffset in shaders/header.glsl), -1 if unused
+        self.groupOffsetLocation = gl.glGetUniformLocation(self.ID, "uGroupOffset")
+        self.groupOffset = (0, 0, 0)
+        self.uniformLocations = {}
+
+        # Workgroup size of compute programs
+        self.localSize = (1, 1, 1)
+        if self.linked and any(shd.type == COMPUTE_SHADER for shd in self.shaders):
+            size = (gl.GLint*3)()
+            gl.glGetProgramiv(self.ID, gl.GL_COMPUTE_WORK_GROUP_SIZE, size)
+            self.localSize = tuple(size)
+
     def __del__(self):
         gl.glDeleteProgram(self.ID)
 
     def use(self):
         gl.glUseProgram(self.ID)
 
+    def storageBindings(self):
+        # Bindings of the shader storage blocks the program accesses
+        count = gl.GLint()
+        gl.glGetProgramInterfaceiv(self.ID, gl.GL_SHADER_STORAGE_BLOCK, gl.GL_ACTIVE_RESOURCES, count)
+        bindings = []
+        for i in range(count.value):
+            binding = gl.GLint()
+            gl.glGetProgramResourceiv(self.ID, gl.GL_SHADER_STORAGE_BLOCK, i, 1, [gl.GL_BUFFER_BINDING], 1, None, binding)
+            bindings.append(binding.value)
+        return bindings
+
     def dispatch(self, groupsX : int = 1, groupsY : int = 1, groupsZ : int = 1):
-        self.use()
-        gl.glDispatchCompute(groupsX, groupsY, groupsZ)
\ No newline at end of file
+        # Dispatches larger than the maximum workgroup count are split in tiles
+        # The shaders get the offset of each tile with uGroupOffset
+        if CommandList.recording is not None:
+            # The uniform state is unknown when the recording is replayed
+            self.groupOffset = None
+        self._call(gl.glUseProgram, self.ID)
+        maxX, maxY, maxZ = maxGroupCount()
+        for z in range(0, groupsZ, maxZ):
+            for y in range(0, groupsY, maxY):
+                for x in range(0, groupsX, maxX):
+                    self._setGroupOffset((x, y, z))
+                    self._call(gl.glDispatchCompute, min(maxX, groupsX-x), min(maxY, groupsY-y), min(maxZ, groupsZ-z))
+
+    def dispatchInvocations(self, x : int = 1, y : int = 1, z : int = 1):
+        # Dispatch at least x by y by z invocations, whatever the workgroup size is
+        lx, ly, lz = self.localSize
+        self.dispatch((x+lx-1)//lx, (y+ly-1)//ly, (z+lz-1)//lz)
+
+    def dispatchIndirect(self, buffer, offset : int = 0):
+        # Workgroup counts are read from buffer (a DISPATCH_INDIRECT_BUFFER) at offset
+        # Indirect dispatches are not tiled
+        if CommandList.recording is not None:
+            self.groupOffset = None
+        self._call(gl.glUseProgram, self.ID)
+        self._setGroupOffset((0, 0, 0))
+        self._call(gl.glBindBuffer, gl.GL_DISPATCH_INDIRECT_BUFFER, buffer.ID)
+        self._call(gl.glDispatchComputeIndirect, offset)
+
+    def setUniform(self, name : str, value : int):
+        # Set an uint uniform of this program (recorded when a CommandList is recording)
+        if name not in self.uniformLocations:
+            self.uniformLocations[name] = gl.glGetUniformLocation(self.ID, name)
+        if self.uniformLocations[name] < 0:
+            logger.error("ERROR: shader program has no uniform %s"%name)
+            return
+        self._call(gl.glProgramUniform1ui, self.ID, self.uniformLocations[name], value)
+
+    def _call(self, function, *args):
+        if CommandList.recording is not None:
+            CommandList.recording.add(function, *args)
+        else:
+            function(*args)
+
+    def _setGroupOffset(self, offset):
+        if offset == self.groupOffset:
+            return
+        if self.groupOffsetLocation < 0:
+            if any(offset):
+                logger.error("ERROR: dispatch needs tiles but shader does not use uGroupOffset")
+            return
+        self._call(gl.glUniform3ui, self.groupOffsetLocation, *offset)
+        self.groupOffset = offset
\ No newline at end of file
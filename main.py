@@ -1,73 +1,24 @@
-import graphics as gr
 import simulation as Sim
+import world
 
 import numpy as np
 import imgui.core as imgui
-import glm
 
 import sys
 import random
-import csv
-
-# Read the world files
-# Information is used later on in aInit
-# Using the Vehicle class to store vehicle data
-class Vehicle():
-    def __init__(self, x, y, rot, speed, start):
-        self.x = x
-        self.y = y
-        self.rot = rot
-        self.speed = speed
-        self.start = start
-    def __str__(self):
-        return '[%.2f, %.2f] %.2f -> %.2f @ %d'%(self.x, self.y, self.rot, self.speed, self.start)
-walls = []
-vehicles = []
-def readWorld(file, simtime):
-    N = 0
-    M = 0
-
-    with open(file + '.wls', 'r') as f:
-        reader = csv.reader(f)
-        for r in reader:
-            if r[0].startswith('#'):
-                continue
-            M += 1
-            walls.append([float(r[0]), float(r[1]), float(r[2]), float(r[3])])
-            # walls.append([float(r[2]), float(r[3]), float(r[0]), float(r[1])])
-
-    with open(file + '.spn', 'r') as f:
-        reader = csv.reader(f)
-        for r in reader:
-            if r[0].startswith('#'):
-                continue
-            center = glm.vec2(float(r[0]), float(r[1]))
-            pointer = glm.vec2(float(r[2]), float(r[3]))
-            rate = float(r[4])
-            speed = float(r[5])
-            rot = glm.atan(pointer.y-center.y, pointer.x-center.x)
-
-            for i in range(0, simtime, int(60/rate)):
-                N += 1
-                v = Vehicle(center.x, center.y, rot, speed, i)
-                #print(v)
-                vehicles.append(v)
-
-    return N, M
-
 
 # Algorithm pass
 #   This function is called each frame
 #   Simulation object is passed as parameter
 def aPass(sim:Sim.Simulation):
-    algoProgram.dispatch(sim.N)
+    algoProgram.dispatchInvocations(sim.N)
 
 def aData(sim:Sim.Simulation):
-    # Get data from first car
-    posState = np.frombuffer(sim.posStateBuffer.getData(0), dtype='f').reshape((sim.N, 8))
-    movState = np.frombuffer(sim.movStateBuffer.getData(0), dtype='f').reshape((sim.N, 16))
-    internalData = np.frombuffer(sim.internalDataBuffer.getData(0), dtype='f').reshape((sim.N, 16))
-    simState = np.frombuffer(sim.simStateBuffer.getData(0), dtype='uint32').reshape((sim.N, 4))
+    # Get the state of all cars (fields by name, see schema.py)
+    state = sim.state
+    positions = state.pos[:, 0:2]
+    velocities = state.vel[:, 0:2]
+    collided = state.collided
     # Do something with the data
 
 # Initializing routine
@@ -77,55 +28,27 @@ def aData(sim:Sim.Simulation):
 #   Simulation object is passed as parameter
 #   Must return a numpy array of floats with the positions of obstacles
 #       in the form of [start.x start.y end.x end.y] dtype=float
+#   The world loaded with world.load already contains the initial state of
+#       all vehicles so it is simply uploaded
 def aInit(sim:Sim.Simulation):
-    global walls, vehicles
-
-    posState = np.zeros([sim.N, 8], dtype="f")
-    movState = np.zeros([sim.N, 16], dtype="f")
-    simState = np.zeros([sim.N, 4], dtype='uint32')
-
-    # Fill posState, movState and simState buffers
-    i = 0
-    for v in vehicles:
-        posState[i][0:4] = [v.x, v.y, 0.0, 1.0]
-        posState[i][4] = v.rot-glm.pi()/2
-        unitv = glm.vec2(glm.cos(v.rot), glm.sin(v.rot))
-        movState[i][0:4] = [unitv.x*v.speed, unitv.y*v.speed, 0.0, 0.0]
-        movState[i][4:8] = [unitv.x*v.speed, unitv.y*v.speed, 0.0, 0.0]
-        movState[i][8] = 0.0
-        movState[i][9] = 0.0
-        simState[i][3] = v.start
-        i+=1
-
-    sim.posStateBuffer.setData(posState)
-    sim.movStateBuffer.setData(movState)
-
-    wallVertices = np.zeros([len(walls)*4], dtype='f')
-
-    # Fill wallVertices
-    i = 0
-    for w in walls:
-        wallVertices[i:i+4] = w
-        i += 4
-
-    return wallVertices, simState
+    return currentWorld.init(sim)
 
 # GUI drawing routine
 #   This function should draw the GUI using ImGui
-#       Changes can be made in sim.globalSettings
+#       Changes can be made in sim.settings (see schema.py)
 #   Simulation object is passed as parameter
 def aGUI(sim:Sim.Simulation):
     imgui.begin("Settings")
-    imgui.text("N=%d, M=%d"%(sim.globalSettings[1][0][1], sim.globalSettings[1][0][2]))
-    # uDeltaTime
-    _, sim.globalSettings[1][0][0] = imgui.slider_float("dt", sim.globalSettings[1][0][0], 0.0, 0.5, '%.4f')
-    _, sim.globalSettings[1][0][3] = imgui.slider_float("coh", sim.globalSettings[1][0][3], 0.0, 10.0, '%.4f')
-    _, sim.globalSettings[1][1][0] = imgui.slider_float("ali", sim.globalSettings[1][1][0], 0.0, 10.0, '%.4f')
-    _, sim.globalSettings[1][1][1] = imgui.slider_float("sep", sim.globalSettings[1][1][1], 0.0, 10.0, '%.4f')
-    _, sim.globalSettings[1][1][2] = imgui.slider_float("d_v", sim.globalSettings[1][1][2], 0.0, 100.0, '%.1f')
-    _, sim.globalSettings[1][1][3] = imgui.slider_float("d_s", sim.globalSettings[1][1][3], 0.0, 100.0, '%.1f')
-    _, sim.globalSettings[1][2][1] = imgui.slider_float("phi_max", sim.globalSettings[1][2][1], 0.0, 3.141592/360*90, '%.4f')
-    _, sim.globalSettings[1][2][0] = imgui.slider_float("dphi_max", sim.globalSettings[1][2][0], 0.0, 3.141592/360*90, '%.4f')
+    st = sim.settings
+    imgui.text("N=%d, M=%d"%(st.uN, st.uM))
+    _, st.uDeltaTime = imgui.slider_float("dt", st.uDeltaTime, 0.0, 0.5, '%.4f')
+    _, st.uw_coh = imgui.slider_float("coh", st.uw_coh, 0.0, 10.0, '%.4f')
+    _, st.uw_ali = imgui.slider_float("ali", st.uw_ali, 0.0, 10.0, '%.4f')
+    _, st.uw_sep = imgui.slider_float("sep", st.uw_sep, 0.0, 10.0, '%.4f')
+    _, st.ud_v = imgui.slider_float("d_v", st.ud_v, 0.0, 100.0, '%.1f')
+    _, st.ud_s = imgui.slider_float("d_s", st.ud_s, 0.0, 100.0, '%.1f')
+    _, st.phi_max = imgui.slider_float("phi_max", st.phi_max, 0.0, 3.141592/360*90, '%.4f')
+    _, st.dphi_max = imgui.slider_float("dphi_max", st.dphi_max, 0.0, 3.141592/360*90, '%.4f')
 
     if imgui.button('Reset'):
         random.seed(sim.seed)
@@ -133,7 +56,7 @@ def aGUI(sim:Sim.Simulation):
     imgui.end()
 
 def main():
-    global algoProgram
+    global algoProgram, currentWorld
 
     # cohesion, alignment and separation factors
     c=0.1
@@ -153,26 +76,29 @@ def main():
     # name of world definition files (spn and wls)
     file='out'
 
-    N, M = readWorld(file, simtime)
+    # The compiled world is cached in .worldcache, keyed by the file contents
+    currentWorld = world.load(file, simtime)
+    N, M = currentWorld.N, currentWorld.M
 
     # Initialize simulation
     # Needs to be ran before doing graphics stuff! (this creates the openGL context)
-    sim = Sim.Simulation(N, False, simtime, aInit, aPass, aGUI, aData, 1, True) 
-
-    # Create algorithm shader
-    shaders = []
-    with open("shaders/algorithm.comp") as f:
-        shaders.append(gr.Shader(sim.header + f.read(), gr.COMPUTE_SHADER))
-    algoProgram = gr.ShaderProgram(shaders)
-
-    sim.globalSettings[1][0][3] = c           # cohesion
-    sim.globalSettings[1][1][0] = a           # alignment
-    sim.globalSettings[1][1][1] = s           # seperation
-    sim.globalSettings[1][1][2] = dv          # d_v
-    sim.globalSettings[1][1][3] = ds          # d_s
-    sim.globalSettings[1][2][0] = dphi_max
-    sim.globalSettings[1][2][1] = phi_max
-    sim.globalSettings[1][0][0] = 0.05      # Time step per frame
+    sim = Sim.Simulation(N, False, simtime, aInit, None, aGUI, aData, 1, True) 
+
+    # Create algorithm shader (variant with the features of the simulation)
+    # The pass declares the buffers it accesses, the barriers are placed automatically
+    algoProgram = sim.program("shaders/algorithm.comp")
+    sim.addAlgorithmPass('algorithm', aPass,
+        reads=(Sim.BIND_POS_STATE, Sim.BIND_MOV_STATE, Sim.BIND_SIM_STATE, Sim.BIND_DISTANCE, Sim.BIND_WALL_INFO),
+        writes=(Sim.BIND_MOV_STATE, Sim.BIND_INTERNAL_DATA), programs=(algoProgram,))
+
+    sim.settings.uw_coh = c             # cohesion
+    sim.settings.uw_ali = a             # alignment
+    sim.settings.uw_sep = s             # seperation
+    sim.settings.ud_v = dv              # d_v
+    sim.settings.ud_s = ds              # d_s
+    sim.settings.dphi_max = dphi_max
+    sim.settings.phi_max = phi_max
+    sim.settings.uDeltaTime = 0.05      # Time step per frame
 
     # Start simulation
     sim.start()
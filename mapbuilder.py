@@ -19,6 +19,66 @@ class SpawnOptions():
     def __repr__(self):
         return str(self.rate)
 
+# Bytes per line vertex: position and color
+VERTEX_SIZE = 8*4
+# Visible items above which the level of detail mode is used (in 'auto' mode)
+LOD_ITEMS = 20000
+
+class EndpointGrid():
+    def __init__(self, cellSize:float=1.0):
+        """ Uniform grid over the endpoints of walls and spawns
+        Used for picking: only the cells around the cursor are searched instead of
+        all endpoints. Entries are (name of list, index, endpoint).
+        """
+        self.cellSize = cellSize
+        self.cells = {}
+
+    def _cell(self, p):
+        return int(np.floor(p[0]/self.cellSize)), int(np.floor(p[1]/self.cellSize))
+
+    def rebuild(self, walls, spawns, cellSize:float):
+        self.cellSize = cellSize
+        self.cells = {}
+        for name, ls in (('walls', walls), ('spawns', spawns)):
+            for i, item in enumerate(ls):
+                self.insert(item[0], (name, i, 0))
+                self.insert(item[1], (name, i, 1))
+
+    def insert(self, p, ref):
+        self.cells.setdefault(self._cell(p), []).append((p, ref))
+
+    def remove(self, p, ref):
+        cell = self.cells.get(self._cell(p), [])
+        for k, (q, r) in enumerate(cell):
+            if r == ref:
+                cell.pop(k)
+                return
+
+    def move(self, old, new, ref):
+        self.remove(old, ref)
+        self.insert(new, ref)
+
+    def at(self, p):
+        """ All entries with an endpoint exactly at p
+        """
+        return [r for q, r in self.cells.get(self._cell(p), []) if q == p]
+
+    def query(self, p, radius:float):
+        """ Closest entry within radius of p as (point, ref), None if there is none
+        """
+        cx, cy = self._cell(p)
+        reach = int(np.ceil(radius/self.cellSize))
+        best = None
+        bestDist = radius*radius
+        for x in range(cx-reach, cx+reach+1):
+            for y in range(cy-reach, cy+reach+1):
+                for q, r in self.cells.get((x, y), []):
+                    d = (q[0]-p[0])**2 + (q[1]-p[1])**2
+                    if d < bestDist:
+                        best = q, r
+                        bestDist = d
+        return best
+
 class MapBuilder():
 
     def __init__(self, file=None):
@@ -36,6 +96,12 @@ class MapBuilder():
         self.centerPos = glm.vec3(0.0)
         self.scrollPos = 1.0
         self.showSpawnOptions = None
+        self.index = EndpointGrid()
+        self._walls = np.zeros([0, 4], dtype='f8')
+        self._spawns = np.zeros([0, 4], dtype='f8')
+        self.index_count = 0
+        self.lodMode = 'auto'
+        self.lod = False
 
         if file is not None:
             self._import(file)
@@ -123,46 +189,35 @@ class MapBuilder():
         self.createLines()
 
     def checkSelect(self, curPos):
-        for i, w in enumerate(self.walls):
-            r1 = glm.sqrt((w[0][0]-curPos[0])**2 + (w[0][1]-curPos[1])**2)
-            r2 = glm.sqrt((w[1][0]-curPos[0])**2 + (w[1][1]-curPos[1])**2)
-            if r1<0.02/self.scrollPos:
-                self.selectNearby = w[0]
-                self.selectIndex = self.walls, i, 0
-                self.createLines()
-                return
-            if r2<0.02/self.scrollPos:
-                self.selectNearby = w[1]
-                self.selectIndex = self.walls, i, 1
-                self.createLines()
-                return
-
-        for i, w in enumerate(self.spawns):
-            r1 = glm.sqrt((w[0][0]-curPos[0])**2 + (w[0][1]-curPos[1])**2)
-            r2 = glm.sqrt((w[1][0]-curPos[0])**2 + (w[1][1]-curPos[1])**2)
-            if r1<0.02/self.scrollPos:
-                self.selectNearby = w[0]
-                self.selectIndex = self.spawns, i, 0
-                self.createLines()
-                return
-            if r2<0.02/self.scrollPos:
-                self.selectNearby = w[1]
-                self.selectIndex = self.spawns, i, 1
-                self.createLines()
-                return
+        hit = self.index.query(curPos, 0.02/self.scrollPos)
+        if hit is not None:
+            point, (name, i, end) = hit
+            if self.selectNearby != point:
+                old = self.selectNearby
+                self.selectNearby = point
+                self._updatePoint(old)
+                self._updatePoint(point)
+            self.selectIndex = getattr(self, name), i, end
+            return
 
         if self.selectNearby is not None:
+            old = self.selectNearby
             self.selectNearby = None
-            self.createLines()
+            self._updatePoint(old)
 
     def moveSelect(self, curPos):
         ls = self.selectIndex[0]
         i = self.selectIndex[1]
+        name = 'walls' if ls is self.walls else 'spawns'
+        old = ls[i][self.selectIndex[2]]
         if self.selectIndex[2] == 0:
             ls[i] = (curPos, ls[i][1])
         else:
             ls[i] = (ls[i][0], curPos)
-        self.createLines()
+        self.index.move(old, curPos, (name, i, self.selectIndex[2]))
+        self.selectNearby = curPos
+        self._updatePoint(old)
+        self._updateItem(ls, i)
 
     def deleteSelect(self):
         ls = self.selectIndex[0]
@@ -176,101 +231,153 @@ class MapBuilder():
             self.selectNearby = None
             self.createLines()
 
+    def _wallLines(self, walls:np.ndarray):
+        # Walls and wall shadows of (K,4) walls: K*4 vertices of [x, y, z, w, r, g, b, a]
+        line_data = np.zeros([len(walls), 4, 8], dtype='f')
+        line_data[:, :, 3] = 1.0
+
+        # Create walls
+        line_data[:, 0, 0:2] = walls[:, 0:2]                    # Wall start position
+        line_data[:, 1, 0:2] = walls[:, 2:4]                    # Wall end position
+        line_data[:, 0:2, 4:8] = [1.0, 0.0, 0.0, 1.0]           # Wall color
+
+        if self.selectNearby is not None:
+            p = self.selectNearby
+            start = (walls[:, 0] == p[0]) & (walls[:, 1] == p[1])
+            end = ~start & (walls[:, 2] == p[0]) & (walls[:, 3] == p[1])
+            line_data[start, 0, 4:8] = [0.0, 0.0, 1.0, 1.0]
+            line_data[end, 1, 4:8] = [0.0, 0.0, 1.0, 1.0]
+
+        # Create wall shadows
+        angle = np.arctan2(walls[:, 3]-walls[:, 1], walls[:, 2]-walls[:, 0]) - np.pi/2
+        offset = np.stack([np.cos(angle), np.sin(angle)], -1)/(100*self.scrollPos)
+        line_data[:, 2, 0:2] = walls[:, 0:2] - offset           # Wall shadow start position
+        line_data[:, 3, 0:2] = walls[:, 2:4] - offset           # Wall shadow end position
+        line_data[:, 2:4, 4:8] = [0.4, 0.0, 0.0, 1.0]           # Wall shadow color
+        return line_data.reshape(-1, 8)
+
+    def _spawnLines(self, spawns:np.ndarray):
+        # Spawn crosses of (S,4) spawns: S*8 vertices of [x, y, z, w, r, g, b, a]
+        line_data = np.zeros([len(spawns), 8, 8], dtype='f')
+        line_data[:, :, 3] = 1.0
+
+        r = np.hypot(spawns[:, 3]-spawns[:, 1], spawns[:, 2]-spawns[:, 0])
+        angle = np.arctan2(spawns[:, 3]-spawns[:, 1], spawns[:, 2]-spawns[:, 0])
+        # Four arms, the first one pointing in the driving direction
+        angles = angle[:, None] - np.arange(4)*np.pi/2
+        line_data[:, 0::2, 0:2] = spawns[:, None, 0:2]
+        line_data[:, 1::2, 0] = spawns[:, None, 0] + np.cos(angles)*r[:, None]
+        line_data[:, 1::2, 1] = spawns[:, None, 1] + np.sin(angles)*r[:, None]
+
+        line_data[:, 0:2, 4:8] = [0.0, 0.5, 0.0, 1.0]
+        line_data[:, 2:8, 4:8] = [0.0, 0.8, 0.0, 1.0]
+
+        if self.selectNearby is not None:
+            p = self.selectNearby
+            start = (spawns[:, 0] == p[0]) & (spawns[:, 1] == p[1])
+            end = ~start & (spawns[:, 2] == p[0]) & (spawns[:, 3] == p[1])
+            line_data[start, 0, 4:8] = [0.0, 0.0, 1.0, 1.0]
+            line_data[end, 1, 4:8] = [0.0, 0.0, 1.0, 1.0]
+        return line_data.reshape(-1, 8)
+
+    def _cursorLines(self):
+        # Cross at the clicked position: 4 vertices
+        line_data = np.zeros([4, 8], dtype='f')
+        line_data[0][0:4] = [self.cursor[0]-0.005/self.scrollPos, self.cursor[1]-0.005/self.scrollPos, 0.0, 1.0]
+        line_data[1][0:4] = [self.cursor[0]+0.005/self.scrollPos, self.cursor[1]+0.005/self.scrollPos, 0.0, 1.0]
+        line_data[2][0:4] = [self.cursor[0]+0.005/self.scrollPos, self.cursor[1]-0.005/self.scrollPos, 0.0, 1.0]
+        line_data[3][0:4] = [self.cursor[0]-0.005/self.scrollPos, self.cursor[1]+0.005/self.scrollPos, 0.0, 1.0]
+        line_data[:, 4:8] = [0.4, 0.4, 0.4, 1.0]
+        return line_data
+
+    def _updateItem(self, ls, i):
+        # Only upload the vertices of one wall or spawn
+        if ls is self.walls:
+            self._walls[i] = [*ls[i][0], *ls[i][1]]
+            data = self._wallLines(self._walls[i:i+1])
+            first = 4*i
+        else:
+            self._spawns[i] = [*ls[i][0], *ls[i][1]]
+            data = self._spawnLines(self._spawns[i:i+1])
+            first = 4*len(self.walls) + 8*i
+        self._lineVBuffer.subData(data, first*VERTEX_SIZE)
+
+    def _updatePoint(self, point):
+        # Update all items which have an endpoint at point (highlight changed)
+        if point is None:
+            return
+        for name, i, end in self.index.at(point):
+            self._updateItem(getattr(self, name), i)
+
     def createLines(self):
         self.line_count = len(self.walls)*2
         self.line_count += len(self.spawns)*4
         if self.cursor is not None:
             self.line_count += 2
 
-        line_data = np.zeros([self.line_count*2, 8], dtype='f')    
-        line_indices = np.zeros([self.line_count*2], dtype='uint32')
-        i = 0
-
-        for wall in self.walls:
-            # Create wall
-            line_data[i][0:4] = [wall[0][0], wall[0][1], 0.0, 1.0]    # Wall start position
-            line_data[i+1][0:4] = [wall[1][0], wall[1][1], 0.0, 1.0]  # Wall end position
-            line_data[i][4:8] = [1.0, 0.0, 0.0, 1.0]                  # Wall color
-            line_data[i+1][4:8] = line_data[i][4:8]
-            line_indices[i:i+2] = [i, i+1]
-
-            if self.selectNearby == wall[0]:
-                line_data[i][4:8] = [0.0, 0.0, 1.0, 1.0]
-            elif self.selectNearby == wall[1]:
-                line_data[i+1][4:8] = [0.0, 0.0, 1.0, 1.0]
-
-            i += 2
-
-            # Create wall shadow
-            angle = glm.atan(wall[1][1]-wall[0][1], wall[1][0]-wall[0][0]) - glm.pi()/2
-            unitv = glm.vec2(glm.cos(angle), glm.sin(angle))
-
-            line_data[i][0:4] = [wall[0][0]-unitv.x/(100*self.scrollPos), wall[0][1]-unitv.y/(100*self.scrollPos), 0.0, 1.0]    # Wall shadow start position
-            line_data[i+1][0:4] = [wall[1][0]-unitv.x/(100*self.scrollPos), wall[1][1]-unitv.y/(100*self.scrollPos), 0.0, 1.0]  # Wall shadow end position
-            line_data[i][4:8] = [0.4, 0.0, 0.0, 1.0]                                          # Wall shadow color
-            line_data[i+1][4:8] = line_data[i][4:8]
-            line_indices[i:i+2] = [i, i+1]
-
-            i += 2
-
-        for spawn in self.spawns:
-
-            r = glm.sqrt((spawn[1][1]-spawn[0][1])**2 + (spawn[1][0] - spawn[0][0])**2)
-            angle = glm.atan(spawn[1][1]-spawn[0][1], spawn[1][0]-spawn[0][0])
-
-            unitv = glm.vec2(glm.cos(angle)*r, glm.sin(angle)*r)
-            line_data[i][0:4] =   [spawn[0][0], spawn[0][1], 0.0, 1.0]
-            line_data[i+1][0:4] = [spawn[0][0]+unitv.x, spawn[0][1]+unitv.y, 0.0, 1.0]
-
-            angle -= glm.pi()/2.0
-            unitv = glm.vec2(glm.cos(angle)*r, glm.sin(angle)*r)
-            line_data[i+2][0:4] = [spawn[0][0], spawn[0][1], 0.0, 1.0]
-            line_data[i+3][0:4] = [spawn[0][0]+unitv.x, spawn[0][1]+unitv.y, 0.0, 1.0]
-
-            angle -= glm.pi()/2.0
-            unitv = glm.vec2(glm.cos(angle)*r, glm.sin(angle)*r)
-            line_data[i+4][0:4] = [spawn[0][0], spawn[0][1], 0.0, 1.0]
-            line_data[i+5][0:4] = [spawn[0][0]+unitv.x, spawn[0][1]+unitv.y, 0.0, 1.0]
-
-            angle -= glm.pi()/2.0
-            unitv = glm.vec2(glm.cos(angle)*r, glm.sin(angle)*r)
-            line_data[i+6][0:4] = [spawn[0][0], spawn[0][1], 0.0, 1.0]
-            line_data[i+7][0:4] = [spawn[0][0]+unitv.x, spawn[0][1]+unitv.y, 0.0, 1.0]
-
-            line_data[i][4:8] = [0.0, 0.5, 0.0, 1.0]
-            line_data[i+1][4:8] = line_data[i][4:8]
-            line_data[i+2][4:8] = [0.0, 0.8, 0.0, 1.0]
-            line_data[i+3][4:8] = line_data[i+2][4:8]
-            line_data[i+4][4:8] = line_data[i+2][4:8]
-            line_data[i+5][4:8] = line_data[i+2][4:8]
-            line_data[i+6][4:8] = line_data[i+2][4:8]
-            line_data[i+7][4:8] = line_data[i+2][4:8]
-            line_indices[i:i+8] = [i, i+1, i+2, i+3, i+4, i+5, i+6, i+7]
-
-            if self.selectNearby == spawn[0]:
-                line_data[i][4:8] = [0.0, 0.0, 1.0, 1.0]
-            elif self.selectNearby == spawn[1]:
-                line_data[i+1][4:8] = [0.0, 0.0, 1.0, 1.0]
-
-            i += 8
-
-        # Create cross if clicked
+        # Walls and spawns as arrays of [startx, starty, endx, endy]
+        self._walls = np.array(self.walls, dtype='f8').reshape(-1, 4)
+        self._spawns = np.array(self.spawns, dtype='f8').reshape(-1, 4)
+
+        parts = [self._wallLines(self._walls), self._spawnLines(self._spawns)]
         if self.cursor is not None:
-            line_data[i][0:4] = [self.cursor[0]-0.005/self.scrollPos, self.cursor[1]-0.005/self.scrollPos, 0.0, 1.0]
-            line_data[i+1][0:4] = [self.cursor[0]+0.005/self.scrollPos, self.cursor[1]+0.005/self.scrollPos, 0.0, 1.0]
-            line_data[i][4:8] = [0.4, 0.4, 0.4, 1.0]
-            line_data[i+1][4:8] = line_data[i][4:8]
-            line_indices[i:i+2] = [i, i+1]
-            i += 2
-            line_data[i][0:4] = [self.cursor[0]+0.005/self.scrollPos, self.cursor[1]-0.005/self.scrollPos, 0.0, 1.0]
-            line_data[i+1][0:4] = [self.cursor[0]-0.005/self.scrollPos, self.cursor[1]+0.005/self.scrollPos, 0.0, 1.0]
-            line_data[i][4:8] = [0.4, 0.4, 0.4, 1.0]
-            line_data[i+1][4:8] = line_data[i][4:8]
-            line_indices[i:i+2] = [i, i+1]
-            i += 2
+            parts.append(self._cursorLines())
+        line_data = np.concatenate(parts)
 
         self._lineVBuffer.setData(line_data)
+        self._updateView()
+
+        # Rebuild the picking index (pick radius depends on the zoom)
+        self.index.rebuild(self.walls, self.spawns, 0.02/self.scrollPos)
+
+    def _viewRect(self):
+        # Visible part of the world: [x0, y0, x1, y1]
+        hw = self.ratio/self.scrollPos
+        hh = 1.0/self.scrollPos
+        cx, cy = -self.centerPos.x, -self.centerPos.y
+        return cx-hw, cy-hh, cx+hw, cy+hh
+
+    def _updateView(self):
+        """ Viewport culling and level of detail
+        Only the indices of lines which overlap the visible part of the world are put
+        in the index buffer (the vertex buffer always holds everything so single items
+        can still be updated). In level of detail mode wall shadows and spawn arms are
+        left out and walls are aggregated to one wall per pair of pixels.
+        """
+        x0, y0, x1, y1 = self._viewRect()
+        w = self._walls
+        s = self._spawns
+
+        wallVisible = (np.minimum(w[:, 0], w[:, 2]) <= x1) & (np.maximum(w[:, 0], w[:, 2]) >= x0) & \
+            (np.minimum(w[:, 1], w[:, 3]) <= y1) & (np.maximum(w[:, 1], w[:, 3]) >= y0)
+        r = np.hypot(s[:, 2]-s[:, 0], s[:, 3]-s[:, 1])
+        spawnVisible = (s[:, 0]-r <= x1) & (s[:, 0]+r >= x0) & (s[:, 1]-r <= y1) & (s[:, 1]+r >= y0)
+        wallIdx = np.flatnonzero(wallVisible)
+        spawnIdx = np.flatnonzero(spawnVisible)
+
+        self.lod = self.lodMode == 'on' or (self.lodMode == 'auto' and len(wallIdx)+len(spawnIdx) > LOD_ITEMS)
+        if self.lod:
+            # Aggregate walls which start and end in the same pixels
+            pixel = 2.0/(self.scrollPos*self.window.height)
+            cells = np.floor(w[wallIdx]/pixel).astype(np.int64)
+            _, first = np.unique(cells, axis=0, return_index=True)
+            wallIdx = wallIdx[np.sort(first)]
+            wallVertices = np.arange(2)
+            spawnVertices = np.arange(2)
+        else:
+            wallVertices = np.arange(4)
+            spawnVertices = np.arange(8)
+
+        indices = [
+            (4*wallIdx[:, None] + wallVertices).reshape(-1),
+            (4*len(w) + 8*spawnIdx[:, None] + spawnVertices).reshape(-1),
+        ]
+        if self.cursor is not None:
+            indices.append(4*len(w) + 8*len(s) + np.arange(4))
+        line_indices = np.concatenate(indices).astype('uint32')
+
         self._lineIBuffer.setData(line_indices)
+        self.index_count = len(line_indices)
 
     def _initShaders(self):
         shaders = []
@@ -363,6 +470,9 @@ class MapBuilder():
             self.mode = 'place spawn'
         elif key == glfw.KEY_ESCAPE and action == glfw.PRESS:
             self.mode = None
+        elif key == glfw.KEY_L and action == glfw.PRESS:
+            self.lodMode = {'auto':'on', 'on':'off', 'off':'auto'}[self.lodMode]
+            self._updateView()
 
         # THIS WORKED BEFORE BUT NOW SOMETHING IS REALLY BROKEN HERE...
         # moveDir = glm.vec3(0.0)
@@ -380,6 +490,7 @@ class MapBuilder():
         if key == glfw.KEY_R and action==glfw.PRESS and self.selectIndex is not None:
             print(self.selectIndex[0][self.selectIndex[1]])
             self.selectIndex[0][self.selectIndex[1]] = (self.selectIndex[0][self.selectIndex[1]][1], self.selectIndex[0][self.selectIndex[1]][0])
+            self.createLines()
 
     def _onScrollEvent(self, window, x, y):
         if y<0:
@@ -399,6 +510,7 @@ class MapBuilder():
         self.ratio = float(self.window.width)/float(self.window.height)
         self.settingsData[0] = glm.ortho(-self.ratio, self.ratio, -1.0, 1.0).to_list()
         self.settingsData[0] = glm.scale(self.settingsData[0], glm.vec3(self.scrollPos)).to_list()
+        self._updateView()
 
     def onUpdate(self):
         gl.glClearColor(0.8, 0.8, 0.8, 1.0)
@@ -414,11 +526,11 @@ class MapBuilder():
         self.settingsBuffer.bindBase(1)
 
         # Draw lines
-        if self.line_count>0:
+        if self.index_count>0:
             self.basicProgram.use()
             self.lineVAO.bind()
-            gl.glLineWidth(2)
-            gr.drawLines(self.line_count*2)
+            gl.glLineWidth(1 if self.lod else 2)
+            gr.drawLines(self.index_count)
 
         # Draw cursor
         self.cursorProgram.use()
@@ -435,7 +547,9 @@ class MapBuilder():
         imgui.text('Use arrow keys to move around')
         imgui.text('When spawn highlighted use middle\nmouse button to show options')
         imgui.text('Center position: (%.2f, %.2f), Scroll position: %.2f'%(self.centerPos.x, self.centerPos.y, self.scrollPos))
+        imgui.text('L : level of detail (%s)'%self.lodMode)
         imgui.text('Mode: %s'%self.mode)
+        imgui.text('Drawn lines: %d/%d'%(self.index_count//2, self.line_count))
         imgui.end()
 
         if self.showSpawnOptions is not None:
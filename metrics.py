@@ -0,0 +1,284 @@
+import numpy as np
+
+from typing import Sequence
+
+# Traffic and flocking metrics of recorded runs
+# ---------------------------------------------
+# Metrics accumulates the metrics of a run from blocks of samples of all
+# vehicles (i.e. Trajectory.blocks(), see trajectory.py), so the memory used is
+# bounded by one block whatever the length of the run. Each block is processed
+# with array operations over all samples and vehicles at once, the neighbours of
+# the vehicles are found on a grid (sort and search of the cell keys).
+#
+# The samples need the fields x, y, vx, vy and optionally collided. A vehicle is
+# moving when its speed is above minSpeed and it did not collide, only moving
+# vehicles are measured. Collided vehicles are still obstacles for the others.
+#   order        -> polarization |sum(v/|v|)|/n of the moving vehicles per sample
+#   density      -> vehicles within densityRadius per square meter
+#   headway      -> gap (bumper to bumper) to the closest vehicle ahead in the lane
+#   timeHeadway  -> gap divided by the own speed
+#   ttc          -> time to collision with that vehicle, if closing in
+#   laneChanges  -> changes of the lane (bands of laneWidth along laneAxis) per vehicle
+#   travelTime   -> time between the first and last sample a vehicle was moving
+
+# Lane of a vehicle which is not (yet) in a lane
+_NO_LANE = np.iinfo('i8').min
+
+class Histogram():
+    def __init__(self, edges:Sequence[float]):
+        """ Accumulated distribution with fixed bins
+        Values outside of the edges are counted in the first or last bin.
+        parameters:
+            edges : list of float   Edges of the bins
+        """
+        self.edges = np.asarray(edges, dtype='f8')
+        self.counts = np.zeros(len(self.edges)-1, dtype='u8')
+        self.total = 0.0
+        self.n = 0
+
+    def add(self, values:np.ndarray):
+        bins = np.clip(np.searchsorted(self.edges, values, 'right')-1, 0, len(self.counts)-1)
+        self.counts += np.bincount(bins, minlength=len(self.counts)).astype('u8')
+        self.total += float(np.sum(values))
+        self.n += len(values)
+
+    def mean(self):
+        return self.total/self.n if self.n>0 else np.nan
+
+    def quantile(self, q:float):
+        """ Value below which a fraction q of the values lie (upper edge of its bin)
+        """
+        if self.n == 0:
+            return np.nan
+        return float(self.edges[1:][np.searchsorted(np.cumsum(self.counts), q*self.n)])
+
+    def fraction(self, value:float):
+        """ Fraction of the values in the bins below value
+        """
+        if self.n == 0:
+            return np.nan
+        return float(np.sum(self.counts[self.edges[1:]<=value]))/self.n
+
+class Metrics():
+    def __init__(self, N:int, length:float=4.9, laneWidth:float=3.5, laneAxis:int=0, laneOffset:float=0.0, laneMargin:float=0.1,
+            densityRadius:float=10.0, leaderRange:float=50.0, minSpeed:float=0.1, criticalTTC:float=2.0):
+        """ Create metrics accumulator
+        parameters:
+            N : int                 Amount of vehicles
+            length : float          Length of the vehicles in meters (for the gaps)
+            laneWidth : float       Width of the lanes in meters
+            laneAxis : int          0 if the lanes are bands of x (driving along y), 1 for bands of y
+            laneOffset : float      Coordinate of the border of lane 0
+            laneMargin : float      A vehicle is only in a lane when it is more than
+                laneMargin*laneWidth from its borders (hysteresis of the lane changes)
+            densityRadius : float   Radius of the local density in meters
+            leaderRange : float     Maximum distance to the vehicle ahead in meters
+            minSpeed : float        Minimum speed of moving vehicles in m/s
+            criticalTTC : float     Time to collision counted as critical in seconds
+        """
+        self.N = N
+        self.length = length
+        self.laneWidth = laneWidth
+        self.laneAxis = laneAxis
+        self.laneOffset = laneOffset
+        self.laneMargin = laneMargin
+        self.densityRadius = densityRadius
+        self.leaderRange = leaderRange
+        self.minSpeed = minSpeed
+        self.criticalTTC = criticalTTC
+
+        # Per sample
+        self.steps = []
+        self.times = []
+        self.order = []
+        self.meanDensity = []
+
+        # Distributions over all moving vehicles and samples
+        self.density = Histogram(np.linspace(0.0, 0.1, 101))
+        self.headway = Histogram(np.linspace(0.0, leaderRange, 101))
+        self.timeHeadway = Histogram(np.linspace(0.0, 10.0, 101))
+        self.ttc = Histogram(np.linspace(0.0, 20.0, 81))
+
+        # Per vehicle
+        self.laneChanges = np.zeros(N, dtype='u4')
+        self.firstTime = np.full(N, np.nan)
+        self.lastTime = np.full(N, np.nan)
+        self.distance = np.zeros(N)
+        self.collided = np.zeros(N, dtype=bool)
+
+        # State carried to the next block
+        self._lane = np.full(N, _NO_LANE, dtype='i8')
+        self._last = None
+
+    def update(self, steps:np.ndarray, times:np.ndarray, frames:np.ndarray):
+        """ Add a block of samples
+        parameters:
+            steps : array           Step of each sample
+            times : array           Time of each sample
+            frames : array          Structured array [samples, N] with x, y, vx, vy
+                and optionally collided
+        """
+        T = len(frames)
+        if T == 0:
+            return
+        x, y, vx, vy = frames['x'], frames['y'], frames['vx'], frames['vy']
+        speed = np.hypot(vx, vy)
+        collided = frames['collided']>0 if 'collided' in frames.dtype.names else np.zeros(frames.shape, dtype=bool)
+        moving = (speed>self.minSpeed) & ~collided
+        present = moving | collided
+
+        self.steps.append(np.asarray(steps))
+        self.times.append(np.asarray(times))
+        self.collided |= collided.any(axis=0)
+        self._updateOrder(vx, vy, speed, moving)
+        self._updateNeighbours(x, y, vx, vy, speed, moving, present)
+        self._updateLanes(x if self.laneAxis == 0 else y, moving)
+        self._updateTravel(np.asarray(times), x, y, moving)
+
+    def _updateOrder(self, vx, vy, speed, moving):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ux = np.where(moving, vx/speed, 0.0).sum(axis=1)
+            uy = np.where(moving, vy/speed, 0.0).sum(axis=1)
+            self.order.append(np.hypot(ux, uy)/moving.sum(axis=1))
+
+    def _updateNeighbours(self, x, y, vx, vy, speed, moving, present):
+        T = len(x)
+        sample, vehicle = np.nonzero(present)
+        px, py = x[sample, vehicle], y[sample, vehicle]
+        i, j = _pairs(sample, px, py, max(self.densityRadius, self.leaderRange))
+
+        # Only pairs of which the first vehicle is moving are measured
+        mine = moving[sample, vehicle]
+        keep = mine[i]
+        i, j = i[keep], j[keep]
+        dx, dy = px[j]-px[i], py[j]-py[i]
+        distance = np.hypot(dx, dy)
+
+        # Local density
+        area = np.pi*self.densityRadius**2
+        count = np.bincount(i[distance<self.densityRadius], minlength=len(px))[mine]/area
+        self.density.add(count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.meanDensity.append(np.bincount(sample[mine], weights=count, minlength=T)/np.bincount(sample[mine], minlength=T))
+
+        # Closest vehicle ahead within the lane (along the heading of the first vehicle)
+        s = speed[sample, vehicle]
+        pvx, pvy = vx[sample, vehicle], vy[sample, vehicle]
+        hx, hy = pvx/np.where(mine, s, 1.0), pvy/np.where(mine, s, 1.0)
+        ahead = dx*hx[i] + dy*hy[i]
+        lateral = np.abs(dx*hy[i] - dy*hx[i])
+        leader = (ahead>0) & (ahead<self.leaderRange) & (lateral<self.laneWidth/2)
+        i, j, ahead = i[leader], j[leader], ahead[leader]
+        first = np.lexsort((ahead, i))
+        first = first[np.r_[True, i[first][1:] != i[first][:-1]]] if len(first)>0 else first
+        i, j, ahead = i[first], j[first], ahead[first]
+
+        gap = np.maximum(ahead - self.length, 0.0)
+        self.headway.add(gap)
+        self.timeHeadway.add(gap/s[i])
+        closing = (pvx[i] - pvx[j])*hx[i] + (pvy[i] - pvy[j])*hy[i]
+        self.ttc.add(gap[closing>0]/closing[closing>0])
+
+    def _updateLanes(self, coordinate, moving):
+        # Lanes of the moving vehicles away from the borders, carried forward in time
+        T = len(coordinate)
+        position = (coordinate - self.laneOffset)/self.laneWidth
+        lane = np.floor(position)
+        inside = np.abs(position - lane - 0.5) < 0.5 - self.laneMargin
+        lanes = np.vstack([self._lane[None], np.where(moving & inside, lane.astype('i8'), _NO_LANE)])
+        index = np.where(lanes != _NO_LANE, np.arange(T+1)[:, None], 0)
+        np.maximum.accumulate(index, axis=0, out=index)
+        lanes = np.take_along_axis(lanes, index, axis=0)
+        changes = (lanes[1:] != lanes[:-1]) & (lanes[:-1] != _NO_LANE)
+        self.laneChanges += changes.sum(axis=0).astype('u4')
+        self._lane = lanes[-1]
+
+    def _updateTravel(self, times, x, y, moving):
+        T = len(times)
+        seen = moving.any(axis=0)
+        first = times[np.argmax(moving, axis=0)]
+        last = times[T-1-np.argmax(moving[::-1], axis=0)]
+        self.firstTime = np.where(seen & np.isnan(self.firstTime), first, self.firstTime)
+        self.lastTime = np.where(seen, last, self.lastTime)
+
+        # Distance driven between consecutive samples in which the vehicle was moving
+        if self._last is not None:
+            x, y, moving = np.vstack([self._last[0][None], x]), np.vstack([self._last[1][None], y]), np.vstack([self._last[2][None], moving])
+        step = np.hypot(np.diff(x, axis=0), np.diff(y, axis=0))
+        self.distance += np.where(moving[1:] & moving[:-1], step, 0.0).sum(axis=0)
+        self._last = (x[-1], y[-1], moving[-1])
+
+    def result(self):
+        """ Per sample series (step, time, order, density) and per vehicle arrays
+        (travelTime, distance, laneChanges, collided)
+        """
+        series = {name:np.concatenate(values) if values else np.zeros(0)
+            for name, values in (('step', self.steps), ('time', self.times), ('order', self.order), ('density', self.meanDensity))}
+        vehicles = {
+            'travelTime' : self.lastTime - self.firstTime,
+            'distance' : self.distance,
+            'laneChanges' : self.laneChanges,
+            'collided' : self.collided,
+        }
+        return series, vehicles
+
+    def summary(self):
+        """ Scalar metrics of the run, i.e. to score a parameter sweep
+        """
+        series, vehicles = self.result()
+        travelled = ~np.isnan(vehicles['travelTime'])
+        return {
+            'order' : float(np.nanmean(series['order'])) if len(series['order']) else np.nan,
+            'finalOrder' : float(series['order'][-1]) if len(series['order']) else np.nan,
+            'density' : self.density.mean(),
+            'headway' : self.headway.mean(),
+            'headway10' : self.headway.quantile(0.1),
+            'timeHeadway' : self.timeHeadway.mean(),
+            'criticalTTC' : self.ttc.fraction(self.criticalTTC),
+            'laneChanges' : int(self.laneChanges.sum()),
+            'travelTime' : float(np.mean(vehicles['travelTime'][travelled])) if travelled.any() else np.nan,
+            'collisions' : int(self.collided.sum()),
+        }
+
+def _pairs(sample:np.ndarray, x:np.ndarray, y:np.ndarray, radius:float):
+    # Index pairs (i, j), i != j, of the points of the same sample closer than
+    # radius. The points are sorted by the key of their grid cell (cells of radius)
+    # and the points of the 3x3 cells around each point are found with searchsorted
+    if len(x) == 0:
+        return np.zeros(0, dtype='i8'), np.zeros(0, dtype='i8')
+    cx = np.floor(x/radius).astype('i8')
+    cy = np.floor(y/radius).astype('i8')
+    cx -= cx.min() - 1
+    cy -= cy.min() - 1
+    width = int(cy.max()) + 2
+    span = (int(cx.max()) + 2)*width
+    key = sample.astype('i8')*span + cx*width + cy
+    order = np.argsort(key, kind='stable')
+    sortedKey = key[order]
+
+    pairs = []
+    for ox in (-1, 0, 1):
+        for oy in (-1, 0, 1):
+            target = key + ox*width + oy
+            lo = np.searchsorted(sortedKey, target, 'left')
+            hi = np.searchsorted(sortedKey, target, 'right')
+            n = hi - lo
+            i = np.repeat(np.arange(len(key)), n)
+            within = np.arange(len(i)) - np.repeat(np.cumsum(n) - n, n)
+            j = order[np.repeat(lo, n) + within]
+            pairs.append((i, j))
+    i = np.concatenate([p[0] for p in pairs])
+    j = np.concatenate([p[1] for p in pairs])
+    keep = (i != j) & (np.hypot(x[j]-x[i], y[j]-y[i]) < radius)
+    return i[keep], j[keep]
+
+def analyse(trajectory, **parameters):
+    """ Metrics of a run from a trajectory archive, one block of samples at a time
+    parameters:
+        trajectory : trajectory.Trajectory  Opened archive
+        parameters                          Arguments of Metrics
+    """
+    metrics = Metrics(trajectory.N, **parameters)
+    for steps, times, frames in trajectory.blocks():
+        metrics.update(steps, times, frames)
+    return metrics
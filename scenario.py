@@ -0,0 +1,233 @@
+import numpy as np
+
+import world
+
+# Procedural scenario generator
+# -----------------------------
+# Builds road networks in memory as numpy wall and spawn arrays (same layout as
+# the .wls and .spn files, see README.md) so large stress worlds can be created
+# reproducibly without writing world files by hand. A Scenario can be compiled to
+# a world.World (use World.init as algoInit) or exported to world files.
+#
+# Remember: the road facing side of a wall is the right side from start to end.
+# All generators traverse the road boundary such that the road is on the right.
+
+class Scenario():
+    def __init__(self, seed:int=0):
+        """ Create empty scenario
+        parameters:
+            seed : int      Seed for the random generator (used by jitter)
+        """
+        self.walls = np.zeros([0, 4], dtype='f8')      # [{startx, starty, endx, endy}]
+        self.spawns = np.zeros([0, 6], dtype='f8')     # [{x, y, directionx, directiony, rate, speed}]
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def M(self):
+        return len(self.walls)
+
+    def addPolyline(self, points, segmentLength:float=0.0):
+        """ Add walls along a polyline
+        parameters:
+            points : array          (P,2) points of the polyline
+            segmentLength : float   If >0 every wall is split in pieces of at most
+                this length (to create worlds with many walls)
+        """
+        points = np.asarray(points, dtype='f8').reshape(-1, 2)
+        walls = np.concatenate([points[:-1], points[1:]], axis=1)
+        if segmentLength>0:
+            walls = subdivide(walls, segmentLength)
+        self.walls = np.concatenate([self.walls, walls])
+        return self
+
+    def addSpawns(self, positions, directions, rate:float=0.01, speed:float=1.0):
+        """ Add spawn points
+        parameters:
+            positions : array       (S,2) spawn positions
+            directions : array      (S,2) or (2,) unit driving directions
+            rate : float            Vehicles per 60 frames for each spawn point
+            speed : float           Start speed in m/s
+        """
+        positions = np.asarray(positions, dtype='f8').reshape(-1, 2)
+        directions = np.broadcast_to(np.asarray(directions, dtype='f8'), positions.shape)
+        spawns = np.zeros([len(positions), 6], dtype='f8')
+        spawns[:, 0:2] = positions
+        spawns[:, 2:4] = positions + directions
+        spawns[:, 4] = rate
+        spawns[:, 5] = speed
+        self.spawns = np.concatenate([self.spawns, spawns])
+        return self
+
+    def add(self, other:'Scenario', offset=(0.0, 0.0)):
+        """ Add all walls and spawns of another scenario, moved by offset
+        """
+        offset = np.asarray(offset, dtype='f8')
+        self.walls = np.concatenate([self.walls, other.walls + np.tile(offset, 2)])
+        spawns = other.spawns.copy()
+        spawns[:, 0:4] += np.tile(offset, 2)
+        self.spawns = np.concatenate([self.spawns, spawns])
+        return self
+
+    def tile(self, nx:int, ny:int, spacing):
+        """ Return a scenario with nx by ny copies of this scenario
+        The copies are independent, make spacing larger than the scenario
+        parameters:
+            spacing : (float, float)    Distance between the copies in x and y
+        """
+        offsets = np.stack(np.meshgrid(np.arange(nx)*spacing[0], np.arange(ny)*spacing[1]), -1).reshape(-1, 2)
+        res = Scenario()
+        res.rng = self.rng
+        res.walls = (self.walls[None, :, :] + np.tile(offsets, 2)[:, None, :]).reshape(-1, 4)
+        spawns = np.repeat(self.spawns[None, :, :], len(offsets), axis=0)
+        spawns[:, :, 0:4] += np.tile(offsets, 2)[:, None, :]
+        res.spawns = spawns.reshape(-1, 6)
+        return res
+
+    def jitter(self, amount:float):
+        """ Move every spawn point randomly (normal distribution) by about amount
+        """
+        delta = self.rng.normal(0.0, amount, [len(self.spawns), 2])
+        self.spawns[:, 0:2] += delta
+        self.spawns[:, 2:4] += delta
+        return self
+
+    def vehicles(self, simtime:int):
+        """ Number of vehicles this scenario spawns in simtime frames
+        """
+        period = (60/self.spawns[:, 4]).astype(np.int64)
+        return int(np.sum((simtime + period - 1)//period))
+
+    def world(self, simtime:int):
+        """ Compile the scenario into a world.World (no files involved)
+        """
+        return world.build(self.walls, self.spawns, simtime)
+
+    def export(self, file:str='out'):
+        """ Write the scenario to world files (as MapBuilder.export does)
+        """
+        world.export(file, self.walls, self.spawns)
+
+def subdivide(walls:np.ndarray, segmentLength:float):
+    """ Split walls in pieces of at most segmentLength
+    """
+    walls = np.asarray(walls, dtype='f8').reshape(-1, 4)
+    length = np.hypot(walls[:, 2]-walls[:, 0], walls[:, 3]-walls[:, 1])
+    pieces = np.maximum(1, np.ceil(length/segmentLength)).astype(np.int64)
+    wall = np.repeat(np.arange(len(walls)), pieces)
+    first = np.cumsum(pieces) - pieces
+    k = np.arange(len(wall)) - first[wall]
+    t0 = (k/pieces[wall])[:, None]
+    t1 = ((k+1)/pieces[wall])[:, None]
+    A = walls[wall, 0:2]
+    B = walls[wall, 2:4]
+    return np.concatenate([A + (B-A)*t0, A + (B-A)*t1], axis=1)
+
+def _lanes(lanes:int, laneWidth:float, rows:int, rowDistance:float):
+    # Grid of spawn positions: lane centers in x (from 0), rows in y (from 0)
+    x = (np.arange(lanes) + 0.5)*laneWidth
+    y = np.arange(rows)*rowDistance
+    return np.stack(np.meshgrid(x, y), -1).reshape(-1, 2)
+
+def _rotate(points, angle:float):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.asarray(points, dtype='f8') @ np.array([[c, s], [-s, c]])
+
+def corridor(length:float=300.0, lanes:int=3, laneWidth:float=10.0, rows:int=3, rowDistance:float=10.0,
+        rate:float=0.01, speed:float=1.0, segmentLength:float=0.0, seed:int=0):
+    """ Straight multi-lane corridor driving up (+y), from x=0 to x=lanes*laneWidth
+    The corridor starts at y=-50 (behind the spawns) and ends at y=length
+    """
+    w = lanes*laneWidth
+    sc = Scenario(seed)
+    sc.addPolyline([(0.0, -50.0), (0.0, length)], segmentLength)
+    sc.addPolyline([(w, length), (w, -50.0)], segmentLength)
+    sc.addSpawns(_lanes(lanes, laneWidth, rows, rowDistance), (0.0, 1.0), rate, speed)
+    return sc
+
+def bottleneck(length:float=200.0, lanes:int=3, laneWidth:float=10.0, width:float=20.0, start:float=80.0,
+        taper:float=15.0, rows:int=3, rowDistance:float=10.0, rate:float=0.01, speed:float=1.0,
+        segmentLength:float=0.0, seed:int=0):
+    """ Corridor which narrows (centered) to width after start over taper meters and
+    continues for length meters (the geometry used in the experiments in ex/)
+    """
+    w = lanes*laneWidth
+    x = (w-width)/2
+    end = start + taper + length
+    sc = Scenario(seed)
+    sc.addPolyline([(0.0, -50.0), (0.0, start), (x, start+taper), (x, end)], segmentLength)
+    sc.addPolyline([(w-x, end), (w-x, start+taper), (w, start), (w, -50.0)], segmentLength)
+    sc.addSpawns(_lanes(lanes, laneWidth, rows, rowDistance), (0.0, 1.0), rate, speed)
+    return sc
+
+def merge(length:float=300.0, lanes:int=2, laneWidth:float=10.0, rampLanes:int=1, rampLength:float=100.0,
+        rampAngle:float=np.pi/8, junction:float=100.0, rows:int=3, rowDistance:float=10.0, rate:float=0.01,
+        speed:float=1.0, segmentLength:float=0.0, seed:int=0):
+    """ Main corridor driving up (+y) with an on-ramp joining from the left
+    parameters:
+        rampAngle : float       Angle between ramp and main road in radians
+        junction : float        y coordinate where the ramp joins the main road
+    """
+    w = lanes*laneWidth
+    wr = rampLanes*laneWidth
+    u = np.array([np.sin(rampAngle), np.cos(rampAngle)])         # Driving direction on the ramp
+    nl = np.array([-np.cos(rampAngle), np.sin(rampAngle)])       # Left of u
+    G = np.array([0.0, junction])                                # Inner corner of the junction
+    E = np.array([0.0, junction + wr/np.sin(rampAngle)])         # Outer corner of the junction
+
+    sc = Scenario(seed)
+    sc.addPolyline([(0.0, -50.0), G, G - rampLength*u], segmentLength)
+    sc.addPolyline([G + wr*nl - rampLength*u, E, (0.0, length)], segmentLength)
+    sc.addPolyline([(w, length), (w, -50.0)], segmentLength)
+
+    sc.addSpawns(_lanes(lanes, laneWidth, rows, rowDistance), (0.0, 1.0), rate, speed)
+    # Ramp spawns in local ramp coordinates (x across, y along the ramp)
+    ramp = _lanes(rampLanes, laneWidth, rows, rowDistance)
+    ramp = G - (rampLength-10.0)*u + np.outer(ramp[:, 0], nl) + np.outer(ramp[:, 1], u)
+    sc.addSpawns(ramp, u, rate, speed)
+    return sc
+
+def intersection(armLength:float=150.0, lanes:int=2, laneWidth:float=10.0, rows:int=3, rowDistance:float=10.0,
+        rate:float=0.01, speed:float=1.0, segmentLength:float=0.0, seed:int=0):
+    """ Four-arm intersection centered at the origin, each arm has lanes lanes in
+    both directions. Vehicles are spawned on the right half of each arm driving
+    towards the center
+    """
+    h = lanes*laneWidth
+    L = armLength
+    # Corner between the east and south arm, clockwise such that the road is on the right
+    corner = np.array([(L, -h), (h, -h), (h, -L)])
+    # Spawns on the south arm driving north
+    spawns = _lanes(lanes, laneWidth, rows, rowDistance) + np.array([0.0, -L+10.0])
+
+    sc = Scenario(seed)
+    for k in range(4):
+        angle = k*np.pi/2
+        sc.addPolyline(_rotate(corner, angle), segmentLength)
+        sc.addSpawns(_rotate(spawns, angle), _rotate([0.0, 1.0], angle), rate, speed)
+    return sc
+
+def ring(radius:float=100.0, lanes:int=2, laneWidth:float=10.0, segments:int=64, vehicles:int=20,
+        rate:float=0.01, speed:float=1.0, seed:int=0):
+    """ Ring road around the origin, driving clockwise
+    parameters:
+        radius : float      Inner radius of the ring
+        segments : int      Amount of walls of each circle
+        vehicles : int      Amount of spawn points on each lane
+    """
+    outer = radius + lanes*laneWidth
+    a = np.linspace(0.0, 2*np.pi, segments+1)
+    circle = np.stack([np.cos(a), np.sin(a)], -1)
+
+    sc = Scenario(seed)
+    # Outer circle clockwise and inner circle counterclockwise keep the road on the right
+    sc.addPolyline(circle[::-1]*outer)
+    sc.addPolyline(circle*radius)
+
+    b = np.linspace(0.0, 2*np.pi, vehicles, endpoint=False)
+    r = radius + (np.arange(lanes) + 0.5)*laneWidth
+    b, r = np.meshgrid(b, r)
+    b, r = b.reshape(-1), r.reshape(-1)
+    positions = np.stack([np.cos(b)*r, np.sin(b)*r], -1)
+    directions = np.stack([np.sin(b), -np.cos(b)], -1)
+    sc.addSpawns(positions, directions, rate, speed)
+    return sc
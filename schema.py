@@ -0,0 +1,418 @@
+import numpy as np
+
+from typing import Sequence
+
+# Single source of the buffer layouts used by the simulation
+# ---------------------------------------------------------
+# Every struct that lives in a GPU buffer is declared here once. From these
+# declarations the GLSL struct and uniform block declarations are generated
+# (and inserted into shaders/header.glsl at the '// @schema' marker) together
+# with matching structured numpy dtypes. Changing a layout thus only has to be
+# done here and both the shaders and the python side follow.
+
+SCHEMA_MARKER = '// @schema'
+
+# GLSL type -> (numpy base type, components, base alignment, size) in bytes
+_types = {
+    'float' : ('<f4', 1, 4, 4),
+    'uint'  : ('<u4', 1, 4, 4),
+    'int'   : ('<i4', 1, 4, 4),
+    'vec2'  : ('<f4', 2, 8, 8),
+    'vec4'  : ('<f4', 4, 16, 16),
+    'uvec4' : ('<u4', 4, 16, 16),
+    'mat4'  : ('<f4', 16, 16, 64),
+}
+
+def _align(offset:int, alignment:int):
+    return (offset + alignment - 1)//alignment*alignment
+
+class Field():
+    def __init__(self, name:str, type:str, count:int=1, comment:str=''):
+        """ Create struct field
+        parameters:
+            name : str      Name of the member in GLSL and numpy
+            type : str      GLSL type (float, uint, int, vec2, vec4, uvec4, mat4)
+            count : int     Array length, 1 for a non-array member
+            comment : str   Comment added to the generated GLSL declaration
+        """
+        if type not in _types:
+            raise ValueError("Unknown GLSL type '%s'"%type)
+        self.name = name
+        self.type = type
+        self.count = count
+        self.comment = comment
+
+    def glsl(self):
+        decl = '%s %s%s;'%(self.type, self.name, '' if self.count==1 else '[%d]'%self.count)
+        if self.comment:
+            decl = '%-20s// %s'%(decl, self.comment)
+        return decl
+
+class Struct():
+    def __init__(self, name:str, fields:Sequence[Field], layout:str='std430'):
+        """ Create struct declaration
+        parameters:
+            name : str                  Name of the GLSL struct (i.e. posState_s)
+            fields : list of Field      Members of the struct
+            layout : str                Memory layout rules used, std430 for storage
+                buffers and std140 for uniform blocks
+        """
+        self.name = name
+        self.fields = list(fields)
+        self.layout = layout
+
+        # Calculate offsets with the GLSL layout rules
+        names, formats, offsets = [], [], []
+        offset = 0
+        structAlign = 4
+        for f in self.fields:
+            base, components, alignment, size = _types[f.type]
+            stride = size
+            if f.count>1 and layout=='std140':
+                # Array elements are rounded up to a vec4 in std140
+                alignment = stride = _align(size, 16)
+            offset = _align(offset, alignment)
+            structAlign = max(structAlign, alignment)
+            shape = ()
+            if components>1:
+                shape += (components,)
+            if f.count>1:
+                shape = (f.count,) + shape
+            names.append(f.name)
+            formats.append((base, shape) if shape else base)
+            offsets.append(offset)
+            offset += stride*f.count if f.count>1 else size
+        if layout=='std140':
+            structAlign = _align(structAlign, 16)
+        self.size = _align(offset, structAlign)
+        self.offsets = dict(zip(names, offsets))
+        self.dtype = np.dtype({'names':names, 'formats':formats, 'offsets':offsets, 'itemsize':self.size})
+
+    def glsl(self):
+        lines = ['struct %s{    // Size %d'%(self.name, self.size)]
+        for f in self.fields:
+            lines.append('    ' + f.glsl())
+        lines.append('};')
+        return '\n'.join(lines)
+
+    def zeros(self, count:int):
+        return np.zeros(count, dtype=self.dtype)
+
+    def fromBytes(self, data, count:int=-1):
+        return np.frombuffer(data, dtype=self.dtype, count=count)
+
+    def fieldRange(self, name:str):
+        """ Byte offset and size of a member
+        """
+        return self.offsets[name], self.dtype.fields[name][0].itemsize
+
+class UniformBlock(Struct):
+    def __init__(self, name:str, binding:int, fields:Sequence[Field]):
+        """ Create uniform block declaration (std140 layout)
+        parameters:
+            name : str                  Name of the GLSL uniform block
+            binding : int               Binding point of the block
+            fields : list of Field      Members of the block
+        """
+        super().__init__(name, fields, 'std140')
+        self.binding = binding
+
+    def glsl(self):
+        lines = ['layout(binding=%d) uniform %s{'%(self.binding, self.name)]
+        for f in self.fields:
+            lines.append('    ' + f.glsl())
+        lines.append('};')
+        return '\n'.join(lines)
+
+    def view(self, array:np.ndarray=None):
+        """ Create named accessor over host memory holding this block
+        parameters:
+            array : np.ndarray      Existing (contiguous) memory to use. If None new
+                zeroed memory is allocated
+        """
+        return UniformData(self, array)
+
+class UniformData():
+    def __init__(self, block:UniformBlock, array:np.ndarray=None):
+        """ Named accessor of uniform block data with dirty range tracking
+        Members of the block can be read and written as attributes (i.e.
+        settings.uDeltaTime = 0.05). Writes through the raw array (array) are
+        tracked as well since the dirty range is found by comparing with the data
+        which was uploaded last. upload() only sends the changed bytes.
+        """
+        if array is None:
+            array = np.zeros(_align(block.size, 16)//4, dtype='f')
+        if array.nbytes<block.size:
+            raise ValueError("Array of %d bytes too small for %s (%d bytes)"%(array.nbytes, block.name, block.size))
+        object.__setattr__(self, 'block', block)
+        object.__setattr__(self, 'array', array)
+        object.__setattr__(self, '_bytes', array.reshape(-1).view(np.uint8)[:block.size])
+        object.__setattr__(self, '_record', array.reshape(-1).view(np.uint8)[:block.size].view(block.dtype)[0])
+        object.__setattr__(self, '_shadow', None)
+
+    def __getattr__(self, name):
+        if name in self.block.offsets:
+            value = self._record[name]
+            return value if isinstance(value, np.ndarray) else value.item()
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name not in self.block.offsets:
+            raise AttributeError("%s has no member '%s'"%(self.block.name, name))
+        self._record[name] = value
+
+    def markDirty(self):
+        """ Force an upload of the full block on the next upload
+        """
+        object.__setattr__(self, '_shadow', None)
+
+    def dirtyRange(self):
+        """ Return (offset, size) in bytes of changed data, None if nothing changed
+        """
+        if self._shadow is None:
+            return 0, self.block.size
+        changed = np.flatnonzero(self._bytes.view('<u4') != self._shadow.view('<u4'))
+        if len(changed)==0:
+            return None
+        return int(changed[0])*4, int(changed[-1]-changed[0]+1)*4
+
+    def upload(self, buffer):
+        """ Upload the dirty range to a buffer with subData
+        Returns the amount of uploaded bytes
+        """
+        dirty = self.dirtyRange()
+        if dirty is None:
+            return 0
+        offset, size = dirty
+        buffer.subData(self._bytes[offset:offset+size], offset)
+        if self._shadow is None:
+            object.__setattr__(self, '_shadow', self._bytes.copy())
+        else:
+            self._shadow[offset:offset+size] = self._bytes[offset:offset+size]
+        return size
+
+class StateView():
+    def __init__(self, arrays:Sequence[np.ndarray]):
+        """ Named access to the fields of several structured arrays with a record per
+        vehicle (i.e. state.pos, state.vel, state.collided). Fields are views of the
+        arrays, a name found in more arrays is taken from the first.
+        """
+        object.__setattr__(self, 'arrays', arrays)
+
+    def __getattr__(self, name):
+        for array in self.arrays:
+            if name in array.dtype.names:
+                return array[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StateView is read only, write to the buffers")
+
+    def __dir__(self):
+        return [name for array in self.arrays for name in array.dtype.names]
+
+# Buffer layouts
+# --------------
+# Assume N vehicles and M obstacles (line segments)
+
+POS_STATE = Struct('posState_s', [
+    Field('pos', 'vec4', comment='Current position in world space'),
+    Field('rot', 'float', comment='Current rotation in world space'),
+    Field('padding', 'float', 3),
+])
+
+MOV_STATE = Struct('movState_s', [
+    Field('vel', 'vec4', comment='Current velocity in world space'),
+    Field('dvel', 'vec4', comment='Desired velocity to steer towards in world space'),
+    Field('angle', 'float', comment='Current steering angle in local space'),
+    Field('speed', 'float', comment='Current speed of rear axis'),
+    Field('padding', 'float', 6),
+])
+
+SIM_STATE = Struct('simState_s', [
+    Field('steps', 'uint', comment='Amount of simulated steps'),
+    Field('collided', 'uint', comment='1 if collision has happened'),
+    Field('time', 'float', comment='Elapsed time'),
+    Field('start', 'uint', comment='Start frame number'),
+])
+
+DISTANCE_STATE = Struct('distanceState_s', [
+    Field('dist', 'float', comment='Distance between two objects'),
+    Field('angle', 'float', comment='Angle towards object in world space'),
+])
+
+WALL_INFO = Struct('wallInfo_s', [
+    Field('norm', 'float', comment='Normal on wall in world space'),
+])
+
+INTERNAL_DATA = Struct('internalData_s', [
+    Field('cohesion', 'vec4'),
+    Field('alignment', 'vec4'),
+    Field('seperation', 'vec4'),
+    Field('padding', 'vec4'),
+])
+
+# Arguments of glDrawElementsIndirect
+DRAW_COMMAND = Struct('drawCommand_s', [
+    Field('count', 'uint', comment='Number of indices'),
+    Field('instanceCount', 'uint', comment='Number of instances'),
+    Field('firstIndex', 'uint'),
+    Field('baseVertex', 'int'),
+    Field('baseInstance', 'uint'),
+])
+
+# Scatter target of the heatmap (atomic counters of one frame)
+HEAT_COUNT = Struct('heatCount_s', [
+    Field('count', 'uint', comment='Vehicles in cell'),
+    Field('speed', 'uint', comment='Sum of speeds (fixed point)'),
+])
+
+# Accumulated heatmap cell
+HEAT = Struct('heat_s', [
+    Field('density', 'float', comment='Decayed vehicle count'),
+    Field('speed', 'float', comment='Decayed sum of speeds'),
+])
+
+# Entry of the collision event log
+COLLISION_EVENT = Struct('collisionEvent_s', [
+    Field('step', 'uint', comment='Steps of the vehicle at the collision'),
+    Field('vehicle', 'uint', comment='ID of the collided vehicle'),
+    Field('other', 'uint', comment='ID of the other vehicle or index of the wall'),
+    Field('wall', 'uint', comment='1 if other is a wall'),
+    Field('pos', 'vec2', comment='Position of the vehicle'),
+])
+
+# Accumulated termination criteria (see Simulation.setTermination)
+TERMINATION = Struct('termination_s', [
+    Field('started', 'uint', comment='Vehicles in the simulation'),
+    Field('collided', 'uint', comment='Vehicles collided'),
+    Field('exited', 'uint', comment='Vehicles outside the world or collided'),
+    Field('moving', 'uint', comment='Vehicles with a velocity'),
+    Field('orderX', 'int', comment='Sum of unit velocities (fixed point)'),
+    Field('orderY', 'int'),
+    Field('order', 'float', comment='Order parameter of the last step'),
+    Field('orderReference', 'float', comment='Order parameter at the start of the steady period'),
+    Field('steadyTime', 'float', comment='Time the order parameter is steady'),
+    Field('flags', 'uint', comment='Met criteria (STOP_* in simulation.py)'),
+])
+
+# Adaptive time stepping (see Simulation.setAdaptiveTime)
+TIME_STEP = Struct('timeStep_s', [
+    Field('deltaTime', 'float', comment='Time step of the current step'),
+    Field('time', 'float', comment='Elapsed simulation time'),
+    Field('minGap', 'uint', comment='Minimum clearance of this step (float bits)'),
+    Field('maxSpeed', 'uint', comment='Maximum speed of this step (float bits)'),
+])
+
+# Neighbour list state, starts with the indirect dispatch arguments of the
+# rebuild and update passes (see Simulation.setNeighbourList)
+NEIGHBOUR_STATE = Struct('neighbourState_s', [
+    Field('rebuildGroups', 'uint', 3, comment='Dispatch of the rebuild pass'),
+    Field('updateGroups', 'uint', 3, comment='Dispatch of the update pass'),
+    Field('maxDisplacement', 'uint', comment='Maximum displacement since the rebuild (float bits)'),
+    Field('rebuild', 'uint', comment='1 forces a rebuild'),
+    Field('rebuilds', 'uint', comment='Amount of rebuilds'),
+    Field('overflow', 'uint', comment='Amount of candidates dropped (list full)'),
+])
+
+# Neighbour list of a vehicle
+NEIGHBOUR_INFO = Struct('neighbourInfo_s', [
+    Field('ref', 'vec2', comment='Position at the last rebuild'),
+    Field('count', 'uint', comment='Amount of candidates'),
+    Field('valid', 'uint', comment='1 if the vehicle was started at the last rebuild'),
+])
+
+# Field of a vehicle gathered by the probe (see Simulation.setProbe)
+PROBE_ENTRY = Struct('probeEntry_s', [
+    Field('vehicle', 'uint', comment='ID of the vehicle'),
+    Field('source', 'uint', comment='0 posState, 1 movState, 2 simState, 3 internalData'),
+    Field('stride', 'uint', comment='Words per record of the source'),
+    Field('offset', 'uint', comment='Word offset of the field in the record'),
+    Field('count', 'uint', comment='Words of the field'),
+    Field('target', 'uint', comment='Word offset of the field in a sample'),
+])
+
+# Probe counters
+PROBE_STATE = Struct('probeState_s', [
+    Field('tick', 'uint', comment='Steps since the probe was set'),
+    Field('samples', 'uint', comment='Samples in the probe buffer'),
+    Field('dropped', 'uint', comment='Samples dropped (probe buffer full)'),
+])
+
+# Detector line or region (see Simulation.setDetectors)
+DETECTOR = Struct('detector_s', [
+    Field('start', 'vec2', comment='Start of a line or minimum corner of a region'),
+    Field('end', 'vec2', comment='End of a line or maximum corner of a region'),
+    Field('region', 'uint', comment='0 for a line, 1 for a region'),
+])
+
+# Counters of a detector over one bin of uDetectorEvery steps
+DETECTOR_BIN = Struct('detectorBin_s', [
+    Field('crossings', 'uint', comment='Vehicles crossing the line or entering the region'),
+    Field('forward', 'uint', comment='Crossings from the right to the left of start->end'),
+    Field('occupied', 'uint', comment='Vehicle steps on the line or in the region'),
+    Field('speed', 'uint', comment='Sum of the speeds of the vehicles on the detector (fixed point)'),
+    Field('crossingSpeed', 'uint', comment='Sum of the speeds of the crossing vehicles (fixed point)'),
+    Field('steps', 'uint', comment='Steps of the bin'),
+    Field('duration', 'float', comment='Simulation time of the bin'),
+])
+
+# Detector counters
+DETECTOR_STATE = Struct('detectorState_s', [
+    Field('tick', 'uint', comment='Steps since the bins were read'),
+    Field('dropped', 'uint', comment='Steps dropped (bins full)'),
+])
+
+# The global uniforms
+GLOBALS = UniformBlock('globalSettingsBuffer', 1, [
+    Field('uViewProjection', 'mat4'),
+    Field('uDeltaTime', 'float'),
+    Field('uN', 'float'),
+    Field('uM', 'float'),
+    Field('uw_coh', 'float'),
+    Field('uw_ali', 'float'),
+    Field('uw_sep', 'float'),
+    Field('ud_v', 'float'),
+    Field('ud_s', 'float'),
+    Field('dphi_max', 'float'),
+    Field('phi_max', 'float'),
+    Field('uGridX', 'float', comment='Heatmap grid origin'),
+    Field('uGridY', 'float'),
+    Field('uGridCellSize', 'float'),
+    Field('uGridWidth', 'float', comment='Heatmap grid size in cells'),
+    Field('uGridHeight', 'float'),
+    Field('uHeatDecay', 'float', comment='Decay of the heatmap per frame'),
+    Field('uHeatMax', 'float', comment='Value mapped to the end of the colormap'),
+    Field('uHeatMode', 'float', comment='0 density, 1 mean speed, 2 flow'),
+    Field('uStopCollision', 'float', comment='1 to stop at the first collision'),
+    Field('uStopExited', 'float', comment='1 to stop when all vehicles exited'),
+    Field('uStopOrderTolerance', 'float', comment='Tolerance of the steady order parameter'),
+    Field('uStopOrderTime', 'float', comment='Time the order parameter must be steady, 0 disabled'),
+    Field('uAdaptiveTime', 'float', comment='1 for adaptive time steps'),
+    Field('uAdaptiveFraction', 'float', comment='Fraction of the clearance a vehicle may move per step'),
+    Field('uMinDeltaTime', 'float', comment='Bounds of the adaptive time step'),
+    Field('uMaxDeltaTime', 'float'),
+    Field('uNeighbourSkin', 'float', comment='Skin of the neighbour lists, 0 disabled'),
+    Field('uNeighbourCapacity', 'float', comment='Maximum candidates per vehicle'),
+    Field('uReorder', 'float', comment='1 if vehicles are reordered (see vehicleID)'),
+    Field('uProbeEvery', 'float', comment='Probe period in steps'),
+    Field('uProbeWords', 'float', comment='Words per probe sample'),
+    Field('uDetectorEvery', 'float', comment='Steps per detector bin'),
+])
+
+STRUCTS = [POS_STATE, MOV_STATE, SIM_STATE, DISTANCE_STATE, WALL_INFO, INTERNAL_DATA, DRAW_COMMAND, HEAT_COUNT, HEAT, COLLISION_EVENT, TERMINATION, TIME_STEP, NEIGHBOUR_STATE, NEIGHBOUR_INFO, PROBE_ENTRY, PROBE_STATE, DETECTOR, DETECTOR_BIN, DETECTOR_STATE]
+BLOCKS = [GLOBALS]
+
+def glsl():
+    """ Generate the GLSL declarations of all structs and uniform blocks
+    """
+    parts = [s.glsl() for s in STRUCTS]
+    parts += ['// The global uniforms\n' + b.glsl() for b in BLOCKS]
+    return '\n\n'.join(parts) + '\n'
+
+def expandHeader(header:str):
+    """ Replace the schema marker in a shader header with the generated declarations
+    """
+    if SCHEMA_MARKER not in header:
+        raise ValueError("Header does not contain '%s' marker"%SCHEMA_MARKER)
+    return header.replace(SCHEMA_MARKER, glsl(), 1)
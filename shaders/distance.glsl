@@ -0,0 +1,82 @@
+// Distance calculation between a vehicle and an object
+// Shared by the distance and neighbour list passes (prepended by Simulation.program)
+
+float delta(float t){
+    return step(0.0, -t)*step(0.0, t);
+}
+
+float u(float t){
+    return 1-step(0.0, -t);
+}
+
+// Calculate the distance (and angle) from vehicle i to object j (a vehicle if j<N,
+// else wall j-N), write it to the distance matrix and return the distance
+float updateDistance(uint i, uint j){
+    uint N = uint(uN);
+
+    if(i==j){
+        bDistanceState[distanceIndex(i, j)].dist = 0;
+#ifdef COMPUTE_ANGLES
+        bDistanceState[distanceIndex(i, j)].angle = 0;
+#endif
+        return 0.0;
+    }
+
+    float dist = 10*l;
+    float angle = 0.0;
+    vec2 iPos = bPosState[i].pos.xy;
+
+    // Check distance from i to j where i is a vehicle and j is a vehicle or a wall
+    if(j>=N){
+        // j is a wall
+
+        // Get two points of wall
+        vec2 A = bWallPos[(j-N)*2] * scale;
+        vec2 B = bWallPos[(j-N)*2+1] * scale;
+        float norm = bWallInfo[j-N].norm;
+
+        vec2 wA = A - iPos;
+        vec2 wB = B - iPos;
+        vec2 AB = B - A;
+        vec2 BA = A - B;
+
+        // Calculate alphaA and alphaB. MinMax is used to suppress NaN's
+        float alphaA = acos(max(min(dot(wA, BA)/(length(wA)*length(BA)), 1.0), -1.0));
+        float alphaB = acos(max(min(dot(wB, AB)/(length(wB)*length(AB)), 1.0), -1.0));
+
+        // Calculate distance towards A and B
+        float dAB = length(wA)*sin(alphaA)*u(PI_F/2-alphaA) + length(wA)*(u(alphaA-PI_F/2) + delta(alphaA - PI_F/2));
+        float dBA = length(wB)*sin(alphaB)*u(PI_F/2-alphaB) + length(wB)*(u(alphaB-PI_F/2) + delta(alphaB - PI_F/2));
+        // Combine everything
+        dist = dAB*(u(alphaA-PI_F/2)+delta(alphaA-PI_F/2)); 
+        dist += dBA*(u(alphaB-PI_F/2)+delta(alphaB-PI_F/2));
+        dist += min(dAB, dBA)*u(PI_F/2-alphaA)*u(PI_F/2-alphaB);
+
+#ifdef COMPUTE_ANGLES
+        // Angle calculation
+        // AB, BA, ABBA
+        angle = (norm-alphaA+PI_F/2)*(u(alphaA-PI_F/2)+delta(alphaA-PI_F/2));
+        angle += (norm-alphaB+PI_F/2)*(u(alphaB-PI_F/2)+delta(alphaB-PI_F/2)); 
+        angle += (norm+PI_F/2)*u(PI_F/2-alphaA)*u(PI_F/2-alphaB);
+
+        angle = mod(angle, 2*PI_F);
+#endif
+
+    }else{
+        
+        // j is a vehicle
+        vec2 jPos = bPosState[j].pos.xy;
+        dist = length(iPos-jPos);
+#ifdef COMPUTE_ANGLES
+        angle = acos(dot(vec2(cos(bPosState[i].rot+PI_F/2), sin(bPosState[i].rot+PI_F/2)), jPos-iPos)/length(jPos-iPos));
+        angle = mod(angle, PI_F);
+#endif
+
+    }
+
+    bDistanceState[distanceIndex(j, i)].dist = dist;
+#ifdef COMPUTE_ANGLES
+    bDistanceState[distanceIndex(j, i)].angle = angle;
+#endif
+    return dist;
+}
\ No newline at end of file
@@ -0,0 +1,33 @@
+layout(location=0) out vec4 fColor;
+
+in vec2 vWorld;
+
+// White -> yellow -> orange -> dark red
+vec3 colormap(float t){
+    t = clamp(t, 0.0, 1.0);
+    vec3 c = mix(vec3(1.0, 1.0, 0.6), vec3(1.0, 0.5, 0.0), smoothstep(0.0, 0.5, t));
+    return mix(c, vec3(0.5, 0.0, 0.0), smoothstep(0.5, 1.0, t));
+}
+
+void main(){
+    ivec2 c = ivec2(floor((vWorld - vec2(uGridX, uGridY)) / uGridCellSize));
+    if(c.x<0 || c.y<0 || c.x>=int(uGridWidth) || c.y>=int(uGridHeight)){
+        discard;
+    }
+
+    heat_s heat = bHeat[uint(c.y)*uint(uGridWidth) + uint(c.x)];
+    if(heat.density<=0.0){
+        discard;
+    }
+
+    // Decayed sums are normalized to values per frame
+    float norm = uHeatDecay<1.0 ? 1.0-uHeatDecay : 1.0;
+    float value = heat.density*norm;                // Density
+    if(int(uHeatMode)==1){
+        value = heat.speed/heat.density;            // Mean speed
+    }else if(int(uHeatMode)==2){
+        value = heat.speed*norm;                    // Flow (density * mean speed)
+    }
+
+    fColor = vec4(colormap(value/uHeatMax), 1.0);
+}
\ No newline at end of file
@@ -0,0 +1,12 @@
+layout(location=0) in vec2 aPos;
+
+out vec2 vWorld;
+
+// Full screen quad, the world position of each corner is found with the
+// inverse of the view projection matrix
+
+void main(){
+    vec4 world = inverse(uViewProjection) * vec4(aPos.xy, 0.0, 1.0);
+    vWorld = world.xy / world.w / scale;
+    gl_Position = vec4(aPos.xy, 0.0, 1.0);
+}
\ No newline at end of file
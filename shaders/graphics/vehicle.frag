@@ -0,0 +1,7 @@
+layout(location=0) out vec4 fColor;
+
+in vec4 vColor;
+
+void main(){
+    fColor = vColor;
+}
\ No newline at end of file
@@ -0,0 +1,85 @@
+layout(location=0) in vec3 aPos;
+layout(location=1) in float aPart;
+
+out vec4 vColor;
+
+// Draws all glyphs of a vehicle in one pass, aPart selects the glyph:
+//  0 : filling (dark red), also used as impostor when zoomed out
+//  1 : 'H' outline (red)
+//  2 : steering angle (yellow)
+//  3 : velocity (green)
+//  4 : desired velocity (blue)
+
+void main(){
+    uint i = bVisible[gl_InstanceID];
+    int part = int(aPart + 0.5);
+
+    posState_s posState = bPosState[i];
+    vec4 position = posState.pos;
+    float rotation = posState.rot;
+
+    movState_s movState = bMovState[i];
+    float angle = movState.angle;
+
+    // Translation matrix
+    mat4 tMat = mat4(
+        1.0,    0.0,    0.0,    0.0,
+        0.0,    1.0,    0.0,    0.0,
+        0.0,    0.0,    1.0,    0.0,
+        position.x,    position.y,    position.z,    1.0
+    );
+
+    // Scale matrix
+    mat4 sMat = mat4(
+        scale,    0.0,    0.0,    0.0,
+        0.0,    scale,    0.0,    0.0,
+        0.0,    0.0,    scale,    0.0,
+        0.0,    0.0,    0.0,    1.0
+    );
+
+    // Rotation matrix of the vehicle
+    mat4 rMat = mat4(
+        cos(rotation),    -sin(rotation),    0.0,    0.0,
+        sin(rotation),    cos(rotation),    0.0,    0.0,
+        0.0,    0.0,    1.0,    0.0,
+        0.0,    0.0,    0.0,    1.0
+    );
+
+    if(part==2){
+        // Steering angle at the front axis
+        mat4 tMat1 = mat4(
+            1.0,    0.0,    0.0,    0.0,
+            0.0,    1.0,    0.0,    0.0,
+            0.0,    0.0,    1.0,    0.0,
+            0.0,    l/2,    0.0,    1.0
+        );
+        mat4 rMat1 = mat4(
+            cos(angle),    -sin(angle),    0.0,    0.0,
+            sin(angle),    cos(angle),    0.0,    0.0,
+            0.0,    0.0,    1.0,    0.0,
+            0.0,    0.0,    0.0,    1.0
+        );
+        rMat = rMat * tMat1 * rMat1;
+    }else if(part>=3){
+        // Rotation in the direction of the (desired) velocity
+        vec4 velocity = part==3 ? movState.vel : movState.dvel;
+        float speed = length(velocity);
+        rMat = mat4(
+            velocity.y/speed,       -velocity.x/speed,    0.0,    0.0,
+            velocity.x/speed,       velocity.y/speed,    0.0,    0.0,
+            0.0,    0.0,    1.0,    0.0,
+            0.0,    0.0,    0.0,    1.0
+        );
+    }
+
+    const vec4 colors[5] = vec4[5](
+        vec4(0.2, 0.0, 0.0, 1.0),
+        vec4(1.0, 0.0, 0.0, 1.0),
+        vec4(1.0, 1.0, 0.0, 1.0),
+        vec4(0.0, 1.0, 0.0, 1.0),
+        vec4(0.0, 0.0, 1.0, 1.0)
+    );
+    vColor = colors[part];
+
+    gl_Position = uViewProjection * tMat * sMat * rMat * vec4(aPos.xyz, 1.0);
+}
\ No newline at end of file
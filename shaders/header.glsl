@@ -9,57 +9,9 @@
 *  Assume N vehicles and M obstacles (line segments)
 */
 
-struct posState_s{      // Size (5+3)*4
-    vec4 pos;           // Current position in world space
-    float rot;          // Current rotation in world space
-    float padding[3];
-};
-
-struct movState_s{      // Size (10+6)*4
-    vec4 vel;           // Current velocity in world space
-    vec4 dvel;          // Desired velocity to steer towards in world space
-    float angle;        // Current steering angle in local space
-    float speed;        // Current speed of rear axis
-    float padding[6];
-};
-
-struct simState_s{      // Size (2+2)*4
-    uint steps;         // Amount of simulated steps
-    uint collided;      // 1 if collision has happened
-    float time;         // Elapsed time
-    uint start;         // Start frame number
-};
-
-struct distanceState_s{ // Size (3+1)*4
-    float dist;         // Distance between two objects
-    float angle;        // Angle towards object in world space
-};
-
-struct wallInfo_s{      // Size (1+1)*4
-    float norm;         // Normal on wall in world space
-};
-
-struct internalData_s{
-    vec4 cohesion;
-    vec4 alignment;
-    vec4 seperation;
-    vec4 padding;
-};
-
-// The global uniforms
-layout(binding=1) uniform globalSettingsBuffer{
-    mat4 uViewProjection;
-    float uDeltaTime;       // [1][0][0]
-    float uN;               // [1][0][1]
-    float uM;               // [1][0][2]
-    float uw_coh;           // [1][0][3]
-    float uw_ali;           // [1][1][0]
-    float uw_sep;           // [1][1][1]
-    float ud_v;             // [1][1][2]
-    float ud_s;             // [1][1][3]
-    float dphi_max;         // [1][2][0]
-    float phi_max;          // [1][2][1]
-};
+// Structs and the global uniform block are generated from schema.py
+// and inserted here. Edit the layouts there!
+// @schema
 
 // State of each vehicle
 layout(binding=2) buffer posStateBuffer{
@@ -92,11 +44,193 @@ layout(binding=7) buffer wallInfoBuffer{
     wallInfo_s bWallInfo[];                    // Size of M
 };
 
+#ifdef DEBUG
+// Debug buffer (free to use for debugging output)
+layout(binding=8) buffer debugBuffer{
+    vec4 bDebug[];                             // Size of 4*N
+};
+#endif
+
+#ifdef WRITE_INTERNAL_DATA
 // Internal data buffer
 layout(binding=9) buffer internalDataBuffer{
-    internalData_s bInternalData[];
+    internalData_s bInternalData[];            // Size of N
+};
+#endif
+
+// Visible vehicles (GPU driven rendering)
+layout(binding=10) buffer visibleBuffer{
+    uint bVisible[];                           // Size of N
+};
+
+// Indirect draw command (GPU driven rendering)
+layout(binding=11) buffer drawCommandBuffer{
+    drawCommand_s bDrawCommand[];
+};
+
+// Heatmap scatter counters
+layout(binding=12) buffer heatCountBuffer{
+    heatCount_s bHeatCount[];                  // Size of uGridWidth*uGridHeight
+};
+
+// Heatmap
+layout(binding=13) buffer heatBuffer{
+    heat_s bHeat[];                            // Size of uGridWidth*uGridHeight
+};
+
+// Collision event counter (amount of events appended, may exceed the capacity)
+layout(binding=14) buffer collisionCountBuffer{
+    uint bCollisionCount;
+};
+
+// Collision event log
+layout(binding=15) buffer collisionEventBuffer{
+    collisionEvent_s bCollisionEvent[];        // Size of the capacity of the log
+};
+
+// Termination criteria
+layout(binding=16) buffer terminationBuffer{
+    termination_s bTermination;
+};
+
+// Adaptive time stepping
+layout(binding=17) buffer timeStepBuffer{
+    timeStep_s bTimeStep;
+};
+
+// Neighbour list state
+layout(binding=18) buffer neighbourStateBuffer{
+    neighbourState_s bNeighbourState;
+};
+
+// Candidate objects of each vehicle (vehicles j<N and walls N+j)
+layout(binding=19) buffer neighbourBuffer{
+    uint bNeighbour[];                         // Size of N*uNeighbourCapacity
+};
+
+// Neighbour list of each vehicle
+layout(binding=20) buffer neighbourInfoBuffer{
+    neighbourInfo_s bNeighbourInfo[];          // Size of N
+};
+
+// Radix sort of the spatial reordering, keys and values are read from the
+// source and written to the destination bindings (swapped after each pass)
+layout(binding=21) buffer sortKeyBuffer{
+    uint bSortKey[];                           // Size of N
+};
+
+layout(binding=22) buffer sortValueBuffer{
+    uint bSortValue[];                         // Size of N
+};
+
+layout(binding=23) buffer sortKeyOutBuffer{
+    uint bSortKeyOut[];                        // Size of N
+};
+
+layout(binding=24) buffer sortValueOutBuffer{
+    uint bSortValueOut[];                      // Size of N
+};
+
+// Digit histogram of each block (digit major)
+layout(binding=25) buffer sortHistogramBuffer{
+    uint bSortHistogram[];                     // Size of radixDigits*radixBlocks()
+};
+
+// User-facing ID of the vehicle in each slot
+layout(binding=26) buffer vehicleIDBuffer{
+    uint bVehicleID[];                         // Size of N
+};
+
+// Records permuted by the reordering (as raw words)
+layout(binding=27) buffer permuteSourceBuffer{
+    uint bPermuteSource[];
+};
+
+layout(binding=28) buffer permuteDestinationBuffer{
+    uint bPermuteDestination[];
+};
+
+// Slot of each vehicle ID (inverse of vehicleIDBuffer)
+layout(binding=29) buffer vehicleSlotBuffer{
+    uint bVehicleSlot[];                       // Size of N
+};
+
+// Probed fields of the probed vehicles
+layout(binding=30) buffer probeEntryBuffer{
+    probeEntry_s bProbeEntry[];
 };
 
+// Probe counters
+layout(binding=31) buffer probeStateBuffer{
+    probeState_s bProbeState;
+};
+
+// Probe samples (uProbeWords words each)
+layout(binding=32) buffer probeBuffer{
+    uint bProbe[];
+};
+
+// Detector lines and regions
+layout(binding=33) buffer detectorBuffer{
+    detector_s bDetector[];
+};
+
+// Detector counters
+layout(binding=34) buffer detectorStateBuffer{
+    detectorState_s bDetectorState;
+};
+
+// Detector bins, bin b of detector d at b*bDetector.length()+d
+layout(binding=35) buffer detectorBinBuffer{
+    detectorBin_s bDetectorBin[];
+};
+
+// Position of each vehicle ID in the last step, w is 1 if it was in the simulation
+layout(binding=36) buffer detectorPreviousBuffer{
+    vec4 bDetectorPrevious[];                   // Size of N
+};
+
+// Offset of the current tile of a dispatch in workgroups. Large dispatches are split
+// in tiles (see ShaderProgram.dispatch), use globalID instead of gl_GlobalInvocationID
+uniform uvec3 uGroupOffset;
+#define globalID (gl_GlobalInvocationID + uGroupOffset*gl_WorkGroupSize)
+
+// Index in the distance matrix of object j (vehicle or N+wall) seen from vehicle i
+// The matrix has N*(N+M) entries, Simulation checks that this fits in an uint
+uint distanceIndex(uint j, uint i){
+    return j*uint(uN) + i;
+}
+
+// Time step of the current step, computed on the GPU with adaptive time steps
+float deltaTime(){
+    return uAdaptiveTime>0 ? bTimeStep.deltaTime : uDeltaTime;
+}
+
+// Vehicle i has entered the simulation. The start frame is counted in steps, or
+// in multiples of uDeltaTime with adaptive time steps
+bool started(uint i){
+    if(uAdaptiveTime>0){
+        return bSimState[i].time >= float(bSimState[i].start)*uDeltaTime;
+    }
+    return bSimState[i].steps>=bSimState[i].start;
+}
+
+// ID of the vehicle in slot i, vehicles change slots when they are reordered
+uint vehicleID(uint i){
+    return uReorder>0 ? bVehicleID[i] : i;
+}
+
+// Slot of the vehicle with ID id
+uint vehicleSlot(uint id){
+    return uReorder>0 ? bVehicleSlot[id] : id;
+}
+
+// Radix sort of the reordering: digits per pass and blocks of 256 keys
+const uint radixDigits = 16;
+uint radixBlocks(){
+    return (uint(uN) + 255u) / 256u;
+}
+
 // Constants
 #define PI_F 3.1415926535897932384626433832795
 #define PI_S 3.1415927
@@ -110,6 +244,9 @@ const float scale = 1.0;
 // Max delta steering angle 37*/s
 const float l = 2.8 * scale;
 const float collisionDistance = 2.45 * scale; //2.61 * scale;
+// Footprint of a vehicle (half width and half length) and radius of its bounding circle
+const vec2 vehicleHalfSize = vec2(0.9, 2.45) * scale;
+const float vehicleRadius = length(vehicleHalfSize);
 //const float phi_max = PI_F/360*90;
 //const float dphi_max = PI_F/360*90;
 // Maximum acceleration
@@ -117,3 +254,9 @@ const float collisionDistance = 2.45 * scale; //2.61 * scale;
 const float amaxpos = 1.0; // m/s2
 const float amaxneg = -1.0; // m/s2
 const float vmax = 120/3.6; // m/s
+// Fixed point scale of speeds summed with atomics
+const float speedScale = 1000.0;
+// Fixed point scale of unit velocities summed with atomics
+const float orderScale = 1000.0;
+// Fixed point scale of speeds summed over a detector bin (coarser, the sums are large)
+const float detectorSpeedScale = 16.0;
@@ -1,4 +1,9 @@
 import graphics as gr
+import schema
+import checkpoint
+import capture
+import trajectory
+import tuning
 
 import random
 import numpy as np
@@ -6,6 +11,7 @@ import glm
 import glfw
 import OpenGL.GL as gl
 import ctypes
+import time
 from typing import Callable, Sequence
 
 import imgui.core as imgui
@@ -15,10 +21,88 @@ ZOOMSPEED = 0.05
 
 ANGLESPEED = 0.05
 
+# Vehicle size on screen (pixels) below which only impostors are drawn (renderMode 'gpu')
+LOD_PIXELS = 4.0
+
+# Maximum amount of cells of the heatmap grid (renderMode 'heatmap')
+HEATMAP_MAX_CELLS = 1<<22
+
+# Largest index of the distance matrix (uint indices in the shaders)
+MAX_DISTANCE_INDEX = 2**32-1
+
+# Capacity of the collision event log (events until the next collisionEvents() call)
+COLLISION_CAPACITY = 1<<16
+
+# Termination criteria (bits of Simulation.stopReason, see setTermination)
+STOP_COLLISION = 1
+STOP_EXITED = 2
+STOP_STEADY = 4
+STOP_WALLCLOCK = 8
+
+# Global settings which configure the run of this instance (set by the set* methods,
+# which also size the buffers), they are kept when a checkpoint is restored
+RUN_SETTINGS = ('uStopCollision', 'uStopExited', 'uStopOrderTolerance', 'uStopOrderTime',
+    'uAdaptiveTime', 'uAdaptiveFraction', 'uMinDeltaTime', 'uMaxDeltaTime',
+    'uNeighbourSkin', 'uNeighbourCapacity', 'uProbeEvery', 'uProbeWords',
+    'uDetectorEvery')
+
+# Bindings of the buffers (see shaders/header.glsl), passes declare their accesses with these
+BIND_GLOBALS = 1
+BIND_POS_STATE = 2
+BIND_MOV_STATE = 3
+BIND_SIM_STATE = 4
+BIND_DISTANCE = 5
+BIND_WALL_POS = 6
+BIND_WALL_INFO = 7
+BIND_DEBUG = 8
+BIND_INTERNAL_DATA = 9
+BIND_VISIBLE = 10
+BIND_DRAW_COMMAND = 11
+BIND_HEAT_COUNT = 12
+BIND_HEAT = 13
+BIND_COLLISION_COUNT = 14
+BIND_COLLISION_EVENT = 15
+BIND_TERMINATION = 16
+BIND_TIME_STEP = 17
+BIND_NEIGHBOUR_STATE = 18
+BIND_NEIGHBOUR = 19
+BIND_NEIGHBOUR_INFO = 20
+BIND_VEHICLE_ID = 26
+BIND_VEHICLE_SLOT = 29
+BIND_PROBE_ENTRY = 30
+BIND_PROBE_STATE = 31
+BIND_PROBE = 32
+BIND_DETECTOR = 33
+BIND_DETECTOR_STATE = 34
+BIND_DETECTOR_BIN = 35
+BIND_DETECTOR_PREVIOUS = 36
+BIND_ALL = tuple(range(1, 37))
+
+# Radix sort of the spatial reordering: key bits per pass (radixDigits in shaders/header.glsl)
+RADIX_BITS = 4
+
+# Fixed point scale of the speed sums of the detector bins (detectorSpeedScale in shaders/header.glsl)
+DETECTOR_SPEED_SCALE = 16.0
+
+# Shader features, each is injected as #define into all shaders when enabled
+#   WRITE_INTERNAL_DATA -> algorithm writes cohesion/alignment/seperation to internalDataBuffer
+#   COMPUTE_ANGLES      -> distance pass computes the angle towards each object
+#   USE_FOV             -> vehicles only see vehicles within their field of view (needs COMPUTE_ANGLES)
+#   DEBUG               -> debugBuffer (binding 8, bDebug) is allocated for debugging output
+FEATURES = ('WRITE_INTERNAL_DATA', 'COMPUTE_ANGLES', 'USE_FOV', 'DEBUG')
+DEFAULT_FEATURES = ('WRITE_INTERNAL_DATA', 'COMPUTE_ANGLES')
+
+# Shader stage by file extension
+_SHADER_TYPES = {
+    '.comp' : gr.COMPUTE_SHADER,
+    '.vert' : gr.VERTEX_SHADER,
+    '.frag' : gr.FRAGMENT_SHADER,
+}
+
 class Simulation:
 
 
-    def __init__(self, N:int=10, fastrun:bool=False, steps:int=0, algoInit:Callable=None, algoPass:Callable=None, guiPass:Callable=None, dataPass:Callable=None, dataPassPeriod:int=100, rendering:bool=True):
+    def __init__(self, N:int=10, fastrun:bool=False, steps:int=0, algoInit:Callable=None, algoPass:Callable=None, guiPass:Callable=None, dataPass:Callable=None, dataPassPeriod:int=100, rendering:bool=True, renderMode:str='instanced', features:Sequence[str]=DEFAULT_FEATURES, tuningProfile:str=tuning.PROFILE):
         """ Create simulation object
         parameters:
             N : int                 Number of vehicles
@@ -43,16 +127,31 @@ class Simulation:
                 the vehicles must be created at the start of the simulation and this is the way
                 to let them enter one after each other
             algoPass : function     Algorithm pass function. Function should dispatch the shader(s)
-                with the algorithm. Using algoProgram.dispatch(sim.N) should work
+                with the algorithm. Using algoProgram.dispatchInvocations(sim.N) should work. It
+                is synchronized with barriers on all buffers, declare the passes of the algorithm
+                with addAlgorithmPass instead (and leave this None) to only wait where needed
             guiPass : function      Gui pass function. Draw the GUI (i.e. imgui). Settings of the
-                simulation are stored in Simulation.globalSettings. See header.glsl for all the
-                settings
+                simulation are stored in Simulation.globalSettings and can be accessed by name
+                with Simulation.settings (i.e. sim.settings.uDeltaTime). See schema.py for all
+                the settings
             dataPass : function     Data pass function is called after period steps. This function
-                can be used to gather simulation data. One can retrieve data from the buffers using
-                the np.frombuffer functions 
-                (i.e. sim.frombuffer(sim.posSataBuffer.getData(0), dtype='f')).reshape((sim.N,8))
+                can be used to gather simulation data. The state of the vehicles is read by name
+                with sim.state (i.e. sim.state.pos, sim.state.vel, sim.state.collided), other
+                buffers with Buffer.view (i.e. sim.heatBuffer.view(schema.HEAT.dtype))
             dataPassPeriod : int    Period of data pass function
             rendering : bool        Set to false if rendering must be disabled
+            renderMode : str        How vehicles are drawn. 'instanced' draws all glyphs of all N
+                vehicles with separate instanced draws. 'gpu' culls vehicles on the GPU (view and
+                inactive vehicles) and draws all glyphs of the visible vehicles with one indirect
+                draw, switching to impostors when zoomed out. 'heatmap' draws a density/speed/flow
+                heatmap of all vehicles instead (see heatmapCellSize and the uHeat* settings)
+            features : list of str  Shader features of this run (see FEATURES). Only this variant
+                of the shaders is compiled and buffers of disabled features are not allocated
+                (i.e. internalDataBuffer and debugBuffer are None). Leave out the diagnostics
+                for production runs
+            tuningProfile : str     Profile file with the workgroup sizes of the heavy kernels per
+                device (see tuning.py). On the first run on a device the sizes are tuned and
+                stored. None to use the default sizes
         """
 
         self.N = N
@@ -63,6 +162,17 @@ class Simulation:
         self.dataPass = dataPass
         self.dataPassPeriod = dataPassPeriod
         self.rendering = rendering
+        self.renderMode = renderMode
+        self.features = set(features)
+        unknown = self.features - set(FEATURES)
+        if len(unknown)>0:
+            raise ValueError("Unknown shader features: %s"%', '.join(sorted(unknown)))
+        if 'USE_FOV' in self.features:
+            self.features.add('COMPUTE_ANGLES')
+        self._programs = {}
+        self.algoPasses = []
+        self.tuningProfile = tuningProfile
+        self.localSizes = {}
         self.seed = 0 # Cant remember why I needed this...
 
         # Create window and OpenGL context
@@ -77,27 +187,154 @@ class Simulation:
             glfw.swap_interval(0)
 
         # Create global settings
-        self.globalSettings = np.zeros([2,4,4], dtype="f")
+        # globalSettings is the raw memory, settings gives named access to the members
+        # declared in schema.GLOBALS and uploads only the changed range
+        self.globalSettings = np.zeros([(schema.GLOBALS.size+63)//64,4,4], dtype="f")
+        self.settings = schema.GLOBALS.view(self.globalSettings)
         ratio = float(self.window.width)/float(self.window.height)                          # Calculate ratio for orhtographic projection
         self.globalSettings[0] = glm.ortho(-ratio*10, ratio*10, -10.0, 10.0).to_list()              # ViewProjection matrix
-        self.globalSettings[1][0][0] = 0.1                                                  # deltaTime
+        self.settings.uDeltaTime = 0.1
+        self.settings.uHeatDecay = 0.95
+        self.settings.uHeatMax = 1.0
+
+        # Size of a heatmap cell in meters, the grid covers the walls of the world
+        self.heatmapCellSize = 2.0
 
         self.stepCount = 0
         self.time = 0.0
         self.inReset = False
+        self.resetReinit = False
+        self._pristine = {}
         self.zoomLevel = 1.0
         self.started = False
+        self.restored = False
+
+        # Early termination (see setTermination)
+        self.stopEvery = 0
+        self.stopWallClock = 0.0
+        self.stopReason = 0
+        self._stopStart = time.perf_counter()
+
+        # Scheduler of the passes of each step, places the barriers (see addAlgorithmPass)
+        self.passGraph = gr.PassGraph(debug='DEBUG' in self.features)
+
+        # Spatial reordering of the vehicles (see setReordering)
+        self.reorderEvery = 0
+
+        # Probed vehicles and fields (see setProbe)
+        self.probeFields = []
+        self.probeWords = 0
+        self.probeStart = 0
+        self.probeDropped = 0
+
+        # Detector lines and regions (see setDetectors)
+        self.detectorAreas = np.zeros(0)
+        self.detectorStart = 0
+        self.detectorsDropped = 0
+
+        # Offscreen frame capture (see startCapture)
+        self.capture = None
+        self.captureEvery = 1
+
+        # Trajectory archive (see startTrajectory)
+        self.trajectory = None
+        self.trajectoryEvery = 1
 
     """ Start simulation
     """
     def start(self):
-        if self.started:
+        if self.started and not self.restored:
             self._reset()
-            return
+        else:
+            self._begin()
+        self._stopStart = time.perf_counter()
+
+        # Run the simulation
+        self.window.run()
+
+    """ Initialize the world with algoInit (unless restored from a checkpoint)
+    """
+    def _begin(self):
         self.started = True
 
-        # Initialize algorithm by calling algoInit function
-        wallVertices, simState = self.algoInit(self)
+        if not self.restored:
+            # Initialize algorithm by calling algoInit function
+            wallVertices, simState = self.algoInit(self)
+            self._initWorld(wallVertices, simState)
+            self.stepCount = 0
+            self.time = 0.0
+            self._snapshot()
+        self.restored = False
+
+    """ Run n steps in a tight loop, without window, drawing and dataPass
+    The commands of one step (the dispatches of the simulation and the algorithm and
+    the barriers) are recorded once and replayed, so the Python overhead per step is
+    a loop over a few GL calls. The algorithm passes are called once to record them
+    and must only use ShaderProgram.dispatch. The simulation is initialized on the first call
+    (as start() does). Can be called repeatedly to continue.
+    parameters:
+        n : int             Amount of steps
+        callback : function Called with the simulation every every steps (i.e. to
+            gather data or change settings, changed settings are uploaded)
+        every : int         Period of callback, 0 to never call it
+    """
+    def step(self, n:int, callback:Callable=None, every:int=0):
+        if not self.started or self.restored:
+            self._begin()
+
+        self.settings.upload(self.globalSettingsBuffer)
+        self._bindBuffers()
+
+        commands = gr.CommandList()
+        graph = gr.PassGraph(self.passGraph.debug)
+        with commands.record():
+            self._addSimulationPasses(graph)
+            graph.run(loop=True)
+
+        done = 0
+        while done<n:
+            # Replay up to the next callback or termination poll
+            count = n-done
+            if callback is not None and every>0:
+                count = min(count, every - self.stepCount%every)
+            if self.stopEvery>0:
+                count = min(count, self.stopEvery - self.stepCount%self.stopEvery)
+            if self.reorderEvery>0:
+                count = min(count, self.reorderEvery - self.stepCount%self.reorderEvery)
+            if self.trajectory is not None:
+                count = min(count, self.trajectoryEvery - self.stepCount%self.trajectoryEvery)
+            if self.capture is not None:
+                count = min(count, self.captureEvery - self.stepCount%self.captureEvery)
+            commands.replay(count)
+            done += count
+            self.stepCount += count
+            if self.settings.uAdaptiveTime>0:
+                self.time = self._readTime()
+            else:
+                self.time += count*self.settings.uDeltaTime
+
+            if self.capture is not None and self.stepCount%self.captureEvery == 0:
+                # The recorded steps do not wait for the draws which read the state
+                self._capturePass(graph)
+                gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+
+            if self.reorderEvery>0 and self.stepCount%self.reorderEvery == 0:
+                self._reorderPass()
+
+            if self.trajectory is not None and self.stepCount%self.trajectoryEvery == 0:
+                self._recordTrajectory()
+
+            if callback is not None and every>0 and self.stepCount%every == 0:
+                callback(self)
+                self.settings.upload(self.globalSettingsBuffer)
+                self._bindBuffers()
+
+            if self.stopEvery>0 and self.stepCount%self.stopEvery == 0 and self._pollTermination():
+                break
+
+    """ Upload the world created by algoInit or restored from a checkpoint
+    """
+    def _initWorld(self, wallVertices:np.ndarray, simState:np.ndarray):
         # Create obstacle vertex and index buffers
         self._wallVBuffer.setData(wallVertices)
         wallIndices = np.arange(0, len(wallVertices), 1, dtype="uint32")
@@ -106,16 +343,32 @@ class Simulation:
 
         print("N = %d, M = %d"%(self.N, self.M))
 
+        # Create heatmap grid over the walls
+        self._createHeatmap(wallVertices)
+
+        # Empty the collision event log and the termination criteria
+        self.collisionCountBuffer.subData(np.zeros(1, dtype="uint32"))
+        self.collisionsDropped = 0
+        self.terminationBuffer.clear()
+        self.stopReason = 0
+        self._resetNeighbours()
+        self._resetVehicleIDs()
+        self._resetProbe()
+        self._resetDetectors()
+
         # Set global settings
         self._bindBuffers()
-        self.globalSettings[1][0][1] = float(self.N)
-        self.globalSettings[1][0][2] = float(self.M)
-        self.globalSettingsBuffer.setData(self.globalSettings)
+        self.settings.uN = self.N
+        self.settings.uM = self.M
+        self.settings.markDirty()
+        self.settings.upload(self.globalSettingsBuffer)
         gl.glMemoryBarrier(gl.GL_UNIFORM_BARRIER_BIT)
 
         # Reserve space for M dependent buffers
-        self.distanceBuffer.reserveData(4*2*self.N*(self.N+self.M))
-        self.wallInfoBuffer.reserveData(4*1*self.M)
+        if self.N*(self.N+self.M) > MAX_DISTANCE_INDEX:
+            raise ValueError("Distance matrix of N*(N+M) = %d entries cannot be indexed (max %d)"%(self.N*(self.N+self.M), MAX_DISTANCE_INDEX))
+        self.distanceBuffer.reserveData(schema.DISTANCE_STATE.size*self.N*(self.N+self.M))
+        self.wallInfoBuffer.reserveData(schema.WALL_INFO.size*self.M)
 
         # Zero out simStateBuffer
         #simState = np.zeros([self.N, 4], dtype="uint32")
@@ -126,9 +379,756 @@ class Simulation:
         self.precalcProgram.dispatch(self.M)
         gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
 
-        # Run the simulation
-        self.stepCount = 0
-        self.window.run()
+    """ Keep a pristine copy of the initial state on the GPU for fast resets
+    The copies are reused (not reallocated) as long as the sizes do not change
+    """
+    def _snapshot(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        for name in ('posStateBuffer', 'movStateBuffer', 'simStateBuffer', 'wallInfoBuffer'):
+            buffer = getattr(self, name)
+            copy = self._pristine.get(name)
+            if copy is None or copy.length != buffer.length:
+                copy = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+                copy.reserveData(buffer.length)
+                self._pristine[name] = copy
+            if buffer.length>0:
+                gr.copyBuffer(buffer, copy)
+        self._pristineStep = (self.stepCount, self.time)
+        self._resetTimeStep()
+
+    """ Restore the pristine copy of the initial state
+    Only GPU to GPU copies, nothing is reallocated or recalculated
+    """
+    def _restoreSnapshot(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        for name, copy in self._pristine.items():
+            if copy.length>0:
+                gr.copyBuffer(copy, getattr(self, name))
+        self.heatCountBuffer.clear()
+        self.heatBuffer.clear()
+        self.collisionCountBuffer.subData(np.zeros(1, dtype="uint32"))
+        self.collisionsDropped = 0
+        self.terminationBuffer.clear()
+        self.stopReason = 0
+        self._resetNeighbours()
+        self._resetVehicleIDs()
+        self.stepCount, self.time = self._pristineStep
+        self._resetTimeStep()
+        self._resetProbe()
+        self._resetDetectors()
+
+    """ Create the heatmap grid covering the bounding box of the walls
+    """
+    def _createHeatmap(self, wallVertices:np.ndarray):
+        points = np.asarray(wallVertices, dtype="f").reshape(-1, 2)
+        if len(points)>0:
+            lo = points.min(axis=0) - 10.0
+            hi = points.max(axis=0) + 10.0
+        else:
+            lo = np.array([-100.0, -100.0])
+            hi = np.array([100.0, 100.0])
+        cellSize = self.heatmapCellSize
+        while np.prod(np.ceil((hi-lo)/cellSize)) > HEATMAP_MAX_CELLS:
+            cellSize *= 2
+        width, height = np.ceil((hi-lo)/cellSize).astype(int)
+
+        self.settings.uGridX = lo[0]
+        self.settings.uGridY = lo[1]
+        self.settings.uGridCellSize = cellSize
+        self.settings.uGridWidth = width
+        self.settings.uGridHeight = height
+        self.heatCells = int(width*height)
+        self.heatCountBuffer.setData(schema.HEAT_COUNT.zeros(self.heatCells))
+        self.heatBuffer.setData(schema.HEAT.zeros(self.heatCells))
+
+    """ Enable adaptive time stepping
+    Each step the minimum clearance between the vehicles (and walls) and the maximum
+    speed are reduced on the GPU and the time step is chosen such that no vehicle
+    moves more than fraction of the clearance, within minDeltaTime and maxDeltaTime.
+    uDeltaTime stays the reference time step: the start frames of the vehicles are
+    multiples of it and dataPass is called every dataPassPeriod*uDeltaTime of
+    simulation time. time is read back from the GPU each step.
+    parameters:
+        enabled : bool          False for fixed time steps of uDeltaTime
+        fraction : float        Fraction of the clearance a vehicle may move per step
+        minDeltaTime : float    Smallest time step (in dense traffic)
+        maxDeltaTime : float    Largest time step (in free flow)
+    """
+    def setAdaptiveTime(self, enabled:bool=True, fraction:float=0.1, minDeltaTime:float=0.01, maxDeltaTime:float=0.2):
+        self._syncTime()
+        self.settings.uAdaptiveTime = float(enabled)
+        self.settings.uAdaptiveFraction = fraction
+        self.settings.uMinDeltaTime = minDeltaTime
+        self.settings.uMaxDeltaTime = maxDeltaTime
+        self._resetTimeStep()
+
+    """ Start the adaptive time stepping at the current time
+    """
+    def _resetTimeStep(self):
+        self._discardTimeReads()
+        timeStep = schema.TIME_STEP.zeros(1)
+        timeStep['deltaTime'] = self.settings.uDeltaTime
+        timeStep['time'] = self.time
+        timeStep['minGap'] = np.array([1e30], dtype="f").view("uint32")
+        self.timeStepBuffer.subData(timeStep)
+        self._nextDataTime = self.time + self.dataPassPeriod*self.settings.uDeltaTime
+
+    """ Choose the time step of this step on the GPU (adaptive time stepping)
+    """
+    def _addTimeStepPasses(self, graph:gr.PassGraph):
+        graph.add('timeStep', lambda: self.timeStepProgram.dispatch((self.N+63)//64),
+            reads=(BIND_MOV_STATE, BIND_SIM_STATE, BIND_DISTANCE), writes=(BIND_TIME_STEP,), programs=(self.timeStepProgram,))
+        graph.add('timeStepResolve', lambda: self.timeStepResolveProgram.dispatch(1),
+            reads=(BIND_TIME_STEP,), writes=(BIND_TIME_STEP,), programs=(self.timeStepResolveProgram,))
+
+    """ Elapsed simulation time of the adaptive time stepping
+    """
+    def _readTime(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        offset, size = schema.TIME_STEP.fieldRange('time')
+        return float(np.frombuffer(self.timeStepBuffer.getData(size, offset), dtype="f")[0])
+
+    """ Set time to the exact elapsed time (waits for the GPU with adaptive time steps)
+    """
+    def _syncTime(self):
+        if self.started and self.settings.uAdaptiveTime>0:
+            self._discardTimeReads()
+            self.time = self._readTime()
+
+    """ Start an asynchronous read back of the elapsed time of the adaptive time stepping
+    The time is copied into a ring of small buffers behind a fence and time is set to
+    the newest finished copy, so it lags the GPU by a frame or two but the window loop
+    never waits for the GPU (as capture.py does for the frames).
+    """
+    def _requestTime(self):
+        self._collectTime()
+        if len(self._timeReads) == len(self._timeBuffers):
+            return
+        buffer = self._timeBuffers[self._nextTimeBuffer]
+        offset, size = schema.TIME_STEP.fieldRange('time')
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        gr.copyBuffer(self.timeStepBuffer, buffer, size, offset)
+        self._timeReads.append((buffer, gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)))
+        self._nextTimeBuffer = (self._nextTimeBuffer + 1) % len(self._timeBuffers)
+
+    def _collectTime(self):
+        # Take the finished copies (oldest first) without waiting
+        while len(self._timeReads) > 0:
+            buffer, fence = self._timeReads[0]
+            status = gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+            if status not in (gl.GL_ALREADY_SIGNALED, gl.GL_CONDITION_SATISFIED):
+                return
+            gl.glDeleteSync(fence)
+            self._timeReads.pop(0)
+            self.time = float(np.frombuffer(buffer.getData(4), dtype="f")[0])
+
+    def _discardTimeReads(self):
+        # The pending copies hold a time which is no longer valid (i.e. after a reset)
+        for _, fence in self._timeReads:
+            gl.glDeleteSync(fence)
+        self._timeReads = []
+
+    """ Enable neighbour lists for the distance pass
+    The objects within max(ud_v, 2*vehicleRadius)+skin of each vehicle are collected
+    in a list which is only rebuilt when a vehicle moved more than skin/2 since the
+    last rebuild (tracked on the GPU). In between only the distances to the candidates
+    are calculated, the other entries of the distance matrix are stale but farther
+    away than ud_v and the collision broad phase. A larger skin means fewer rebuilds but longer lists.
+    parameters:
+        skin : float        Skin distance in meters, 0 to calculate all distances every step
+        capacity : int      Maximum candidates per vehicle, candidates beyond are dropped
+            (counted in neighbourState()['overflow'])
+    """
+    def setNeighbourList(self, skin:float=2.0, capacity:int=64):
+        self.settings.uNeighbourSkin = skin
+        self.settings.uNeighbourCapacity = capacity
+        if skin<=0:
+            self.neighbourStateBuffer = None
+            self.neighbourBuffer = None
+            self.neighbourInfoBuffer = None
+            return
+        self.neighbourStateBuffer = gr.Buffer(gr.DISPATCH_INDIRECT_BUFFER, gr.DYNAMIC_DRAW)
+        self.neighbourBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.neighbourBuffer.reserveData(self.N*capacity*4)
+        self.neighbourInfoBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.neighbourInfoBuffer.setData(schema.NEIGHBOUR_INFO.zeros(self.N))
+        self._resetNeighbours()
+
+    """ Force a rebuild of the neighbour lists (i.e. after the world changed)
+    """
+    def _resetNeighbours(self):
+        if self.neighbourStateBuffer is None:
+            return
+        state = schema.NEIGHBOUR_STATE.zeros(1)
+        state['rebuild'] = 1
+        self.neighbourStateBuffer.setData(state)
+
+    """ State of the neighbour lists (rebuilds and overflow), see schema.NEIGHBOUR_STATE
+    """
+    def neighbourState(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        return schema.NEIGHBOUR_STATE.fromBytes(self.neighbourStateBuffer.getData(0))[0]
+
+    """ Calculate the distance matrix, with neighbour lists if enabled
+    """
+    def _addDistancePasses(self, graph:gr.PassGraph):
+        objects = (BIND_POS_STATE, BIND_SIM_STATE, BIND_WALL_POS, BIND_WALL_INFO)
+        if self.neighbourStateBuffer is None:
+            graph.add('distance', lambda: self.distanceProgram.dispatchInvocations(self.N, self.N+self.M),
+                reads=objects, writes=(BIND_DISTANCE,), programs=(self.distanceProgram,))
+            return
+        graph.add('displacement', lambda: self.displacementProgram.dispatch((self.N+63)//64),
+            reads=(BIND_POS_STATE, BIND_SIM_STATE, BIND_NEIGHBOUR_INFO), writes=(BIND_NEIGHBOUR_STATE,), programs=(self.displacementProgram,))
+        graph.add('neighbourResolve', lambda: self.neighbourResolveProgram.dispatch(1),
+            reads=(BIND_NEIGHBOUR_STATE,), writes=(BIND_NEIGHBOUR_STATE,), programs=(self.neighbourResolveProgram,))
+        graph.add('neighbours', lambda: self.neighbourProgram.dispatchIndirect(self.neighbourStateBuffer, schema.NEIGHBOUR_STATE.offsets['rebuildGroups']),
+            reads=objects + (BIND_NEIGHBOUR_STATE,), writes=(BIND_DISTANCE, BIND_NEIGHBOUR_STATE, BIND_NEIGHBOUR, BIND_NEIGHBOUR_INFO),
+            indirect=(BIND_NEIGHBOUR_STATE,), programs=(self.neighbourProgram,))
+        graph.add('neighbourDistance', lambda: self.neighbourDistanceProgram.dispatchIndirect(self.neighbourStateBuffer, schema.NEIGHBOUR_STATE.offsets['updateGroups']),
+            reads=objects + (BIND_NEIGHBOUR, BIND_NEIGHBOUR_INFO), writes=(BIND_DISTANCE,),
+            indirect=(BIND_NEIGHBOUR_STATE,), programs=(self.neighbourDistanceProgram,))
+
+    """ Add a pass of the algorithm with the buffer bindings it accesses (BIND_*)
+    The barriers between the passes of a step are placed by the pass graph with
+    only the bits which are needed, passes which do not depend on each other run
+    without a barrier in between. The passes run after algoPass (if given) in the
+    order they are added. With the DEBUG feature the bindings the programs access
+    are checked against the declaration.
+    parameters:
+        name : str              Name of the pass (in error messages)
+        function : function     Called with the simulation, dispatches the shader(s)
+        reads : list of int     Bindings read
+        writes : list of int    Bindings written
+        indirect : list of int  Bindings read as indirect dispatch commands
+        programs : list         Programs the pass dispatches
+    """
+    def addAlgorithmPass(self, name:str, function:Callable, reads:Sequence[int]=(), writes:Sequence[int]=(), indirect:Sequence[int]=(), programs:Sequence[gr.ShaderProgram]=()):
+        self.algoPasses.append((name, function, reads, writes, indirect, programs))
+
+    """ Add the passes of one simulation step
+    """
+    def _addSimulationPasses(self, graph:gr.PassGraph):
+        self._addDistancePasses(graph)
+        graph.add('collision', lambda: self.collisionProgram.dispatchInvocations(self.N),
+            reads=(BIND_POS_STATE, BIND_SIM_STATE, BIND_DISTANCE, BIND_WALL_POS, BIND_VEHICLE_ID),
+            writes=(BIND_SIM_STATE, BIND_COLLISION_COUNT, BIND_COLLISION_EVENT), programs=(self.collisionProgram,))
+        if self.settings.uAdaptiveTime>0:
+            self._addTimeStepPasses(graph)
+        if self.algoPass is not None:
+            graph.add('algoPass', lambda: self.algoPass(self), reads=BIND_ALL, writes=BIND_ALL)
+        for name, function, reads, writes, indirect, programs in self.algoPasses:
+            graph.add(name, lambda function=function: function(self), reads, writes, indirect, programs)
+        graph.add('move', lambda: self.moveProgram.dispatchInvocations(self.N),
+            reads=(BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE, BIND_TIME_STEP),
+            writes=(BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE), programs=(self.moveProgram,))
+        if self.stopEvery>0:
+            self._addTerminationPasses(graph)
+        if self.probeBuffer is not None:
+            graph.add('probe', lambda: self.probeProgram.dispatch(1),
+                reads=(BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE, BIND_INTERNAL_DATA, BIND_VEHICLE_SLOT, BIND_PROBE_ENTRY, BIND_PROBE_STATE),
+                writes=(BIND_PROBE_STATE, BIND_PROBE), programs=(self.probeProgram,))
+        if self.detectorBuffer is not None:
+            graph.add('detector', lambda: self.detectorProgram.dispatchInvocations(self.N),
+                reads=(BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE, BIND_VEHICLE_ID, BIND_TIME_STEP, BIND_DETECTOR, BIND_DETECTOR_STATE, BIND_DETECTOR_PREVIOUS),
+                writes=(BIND_DETECTOR_BIN, BIND_DETECTOR_PREVIOUS), programs=(self.detectorProgram,))
+            graph.add('detectorResolve', lambda: self.detectorResolveProgram.dispatch(1),
+                reads=(BIND_TIME_STEP, BIND_DETECTOR, BIND_DETECTOR_STATE, BIND_DETECTOR_BIN),
+                writes=(BIND_DETECTOR_STATE, BIND_DETECTOR_BIN), programs=(self.detectorResolveProgram,))
+
+    """ Periodically reorder the vehicles by their position
+    Every every steps all vehicles are sorted on the GPU (radix sort) by the Z-order
+    code of their position and their state (posState, movState, simState and
+    internalData) is permuted, so vehicles which are close in the world are close
+    in memory. This makes the neighbour loops of the shaders read memory which is
+    likely cached, at large N. The slot of a vehicle thus changes: vehicleIDBuffer
+    holds the ID (index given by algoInit) of the vehicle in each slot and
+    vehicleSlotBuffer the slot of each ID, use vehicleData() to read state by ID
+    (checkpoints, collision events and the probe use IDs).
+    parameters:
+        every : int     Period in steps, 0 to disable
+    """
+    def setReordering(self, every:int=100):
+        self.reorderEvery = every
+        if every<=0 or self.vehicleIDBuffer is not None:
+            return
+        self.vehicleIDBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.vehicleSlotBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self._sortKeyBuffers = [gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW) for _ in range(2)]
+        self._sortValueBuffers = [gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW) for _ in range(2)]
+        for buffer in self._sortKeyBuffers + self._sortValueBuffers:
+            buffer.reserveData(self.N*4)
+        self._sortHistogramBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self._sortHistogramBuffer.reserveData((1<<RADIX_BITS)*((self.N+255)//256)*4)
+        self._permuteBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self._permuteBuffer.reserveData(self.N*max(schema.MOV_STATE.size, schema.INTERNAL_DATA.size))
+        self.settings.uReorder = 1.0
+        self._resetVehicleIDs()
+
+    """ Every vehicle back in the slot of its ID (i.e. after a reset)
+    """
+    def _resetVehicleIDs(self):
+        if self.vehicleIDBuffer is not None:
+            self.vehicleIDBuffer.setData(np.arange(self.N, dtype="uint32"))
+            self.vehicleSlotBuffer.setData(np.arange(self.N, dtype="uint32"))
+
+    """ Sort the vehicles by the Z-order code of their position and permute their state
+    """
+    def _reorderPass(self):
+        blocks = (self.N+255)//256
+        keys, values = self._sortKeyBuffers, self._sortValueBuffers
+        keys[0].bindBase(21)
+        values[0].bindBase(22)
+        self._sortHistogramBuffer.bindBase(25)
+        self.mortonKeyProgram.dispatch(blocks)
+        gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+
+        # Least significant digit first, the keys and values ping-pong between the buffers
+        for p in range(32//RADIX_BITS):
+            source, destination = p%2, 1-p%2
+            keys[source].bindBase(21)
+            values[source].bindBase(22)
+            keys[destination].bindBase(23)
+            values[destination].bindBase(24)
+            self.radixCountProgram.setUniform('uRadixShift', p*RADIX_BITS)
+            self.radixCountProgram.dispatch(blocks)
+            gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+            self.radixScanProgram.dispatch(1)
+            gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+            self.radixScatterProgram.setUniform('uRadixShift', p*RADIX_BITS)
+            self.radixScatterProgram.dispatch(blocks)
+            gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+
+        # After an even amount of passes the sorted slots are in the first buffer
+        values[0].bindBase(22)
+        records = [(self.posStateBuffer, schema.POS_STATE), (self.movStateBuffer, schema.MOV_STATE), (self.simStateBuffer, schema.SIM_STATE)]
+        if self.internalDataBuffer is not None:
+            records.append((self.internalDataBuffer, schema.INTERNAL_DATA))
+        records = [(buffer, struct.size) for buffer, struct in records] + [(self.vehicleIDBuffer, 4)]
+        self._permuteBuffer.bindBase(27)
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        for buffer, size in records:
+            gr.copyBuffer(buffer, self._permuteBuffer, self.N*size)
+            buffer.bindBase(28)
+            self.permuteProgram.setUniform('uStride', size//4)
+            self.permuteProgram.dispatch((self.N+63)//64)
+            gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT | gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        self.vehicleSlotProgram.dispatch((self.N+63)//64)
+        gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+
+        # The neighbour lists refer to the old slots
+        self._resetNeighbours()
+        self._bindBuffers()
+
+    """ ID of the vehicle in each slot
+    """
+    def vehicleIDs(self):
+        if self.vehicleIDBuffer is None:
+            return np.arange(self.N, dtype="uint32")
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        return np.frombuffer(self.vehicleIDBuffer.getData(0), dtype="uint32")
+
+    """ State of all vehicles by field name (see schema.POS_STATE, MOV_STATE, SIM_STATE
+    and INTERNAL_DATA), i.e. sim.state.pos[:, 0:2] or sim.state.collided
+    The buffers are read back into host arrays which are allocated once and reused, so
+    the fields are overwritten by the next access of state (copy them to keep them).
+    Records are in slot order, with reordering state.id holds the vehicle ID of each.
+    """
+    @property
+    def state(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        arrays = [self.posStateBuffer.view(schema.POS_STATE.dtype, self.N),
+            self.movStateBuffer.view(schema.MOV_STATE.dtype, self.N),
+            self.simStateBuffer.view(schema.SIM_STATE.dtype, self.N)]
+        if self.internalDataBuffer is not None:
+            arrays.append(self.internalDataBuffer.view(schema.INTERNAL_DATA.dtype, self.N))
+        if self.vehicleIDBuffer is not None:
+            arrays.append(self.vehicleIDBuffer.view([('id', '<u4')], self.N))
+        else:
+            arrays.append(self._identity)
+        return schema.StateView(arrays)
+
+    """ Read per vehicle state ordered by vehicle ID (independent of the reordering)
+    i.e. sim.vehicleData(sim.posStateBuffer, schema.POS_STATE)['pos']
+    parameters:
+        buffer : gr.Buffer      Buffer with N records
+        struct : schema.Struct  Layout of a record
+    """
+    def vehicleData(self, buffer:gr.Buffer, struct:schema.Struct):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        if self.vehicleIDBuffer is None:
+            return struct.fromBytes(buffer.getData(self.N*struct.size))
+        data = buffer.view(struct.dtype, self.N)
+        ordered = np.empty_like(data)
+        ordered[self.vehicleIDs()] = data
+        return ordered
+
+    """ Record fields of a few vehicles on the GPU
+    Every every steps a small pass gathers the fields of the vehicles into the next
+    sample of a probe buffer, so a time series of a few vehicles costs no read back
+    of the full state per step. readProbe() reads all samples at once. Samples
+    beyond capacity are dropped (counted in probeDropped), call readProbe() at
+    least every capacity*every steps. Call with no vehicles to disable.
+    parameters:
+        vehicles : list of int      IDs of the vehicles (index given by algoInit)
+        fields : list of str        Fields of schema.POS_STATE, MOV_STATE, SIM_STATE or
+            INTERNAL_DATA (with WRITE_INTERNAL_DATA), i.e. ['pos', 'speed', 'collided']
+        every : int                 Period in steps
+        capacity : int              Maximum samples between two readProbe()
+    """
+    def setProbe(self, vehicles:Sequence[int]=(), fields:Sequence[str]=(), every:int=1, capacity:int=1024):
+        vehicles = [int(v) for v in vehicles]
+        if len(vehicles) == 0 or len(fields) == 0:
+            self.probeFields = []
+            self.probeEntryBuffer = None
+            self.probeStateBuffer = None
+            self.probeBuffer = None
+            return
+        if any(v<0 or v>=self.N for v in vehicles):
+            raise ValueError("Probed vehicles must be IDs in [0, %d)"%self.N)
+        sources = [schema.POS_STATE, schema.MOV_STATE, schema.SIM_STATE]
+        if self.internalDataBuffer is not None:
+            sources.append(schema.INTERNAL_DATA)
+
+        # One entry per vehicle and field, the samples hold the step and then each
+        # field of all vehicles (the layout of the dtype of readProbe)
+        entries = schema.PROBE_ENTRY.zeros(len(vehicles)*len(fields))
+        self.probeFields = []
+        target = 1
+        for i, name in enumerate(fields):
+            source = next((s for s, struct in enumerate(sources) if name in struct.offsets), None)
+            if source is None:
+                raise ValueError("Unknown probe field '%s'"%name)
+            struct = sources[source]
+            offset, size = struct.fieldRange(name)
+            subtype = struct.dtype.fields[name][0]
+            self.probeFields.append((name, subtype.base, (len(vehicles),) + subtype.shape, target*4))
+            for j, vehicle in enumerate(vehicles):
+                entry = entries[i*len(vehicles) + j]
+                entry['vehicle'] = vehicle
+                entry['source'] = source
+                entry['stride'] = struct.size//4
+                entry['offset'] = offset//4
+                entry['count'] = size//4
+                entry['target'] = target
+                target += size//4
+        self.settings.uProbeEvery = max(every, 1)
+        self.probeWords = target
+        self.settings.uProbeWords = target
+
+        self.probeEntryBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.probeEntryBuffer.setData(entries)
+        self.probeStateBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.DYNAMIC_DRAW)
+        self.probeBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STREAM_READ)
+        self.probeBuffer.reserveData(capacity*target*4)
+        self._resetProbe()
+
+    """ Discard the samples, the probe starts again at the current step
+    """
+    def _resetProbe(self):
+        if self.probeStateBuffer is None:
+            return
+        self.probeStateBuffer.setData(schema.PROBE_STATE.zeros(1))
+        self.probeStart = self.stepCount
+        self.probeDropped = 0
+
+    """ Return the samples of the probe since the last call
+    Only the counters and the samples are read back. Returns a structured array with
+    the step of each sample and per probed field an array over the probed vehicles
+    (in the order given to setProbe), i.e. probe['pos'][:, 0, 0:2] is the position
+    of the first vehicle over time.
+    """
+    def readProbe(self):
+        if self.probeBuffer is None:
+            return np.zeros(0, dtype=[('step', '<u4')])
+        dtype = np.dtype({'names':['step'] + [name for name, _, _, _ in self.probeFields],
+            'formats':['<u4'] + [(base, shape) for _, base, shape, _ in self.probeFields],
+            'offsets':[0] + [offset for _, _, _, offset in self.probeFields],
+            'itemsize':self.probeWords*4})
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        state = schema.PROBE_STATE.fromBytes(self.probeStateBuffer.getData(schema.PROBE_STATE.size)).copy()
+        count = int(state['samples'][0])
+        samples = np.zeros(0, dtype=dtype)
+        if count>0:
+            samples = np.frombuffer(self.probeBuffer.getData(count*dtype.itemsize), dtype=dtype).copy()
+            # The pass runs at the end of a step, before the step count is incremented
+            samples['step'] += self.probeStart + 1
+        self.probeDropped += int(state['dropped'][0])
+        state['samples'] = 0
+        state['dropped'] = 0
+        self.probeStateBuffer.subData(state)
+        return samples
+
+    """ Measure traffic at virtual loop detectors on the GPU
+    Each step a pass counts for every detector the vehicles crossing the line (or
+    entering the region) since the last step and the vehicles on it with their
+    speed, accumulated in bins of every steps on the GPU. Only the bins are read
+    back, with readDetectors(). Bins beyond capacity are dropped (counted in
+    detectorsDropped), call readDetectors() at least every capacity*every steps.
+    Call without detectors to disable.
+    parameters:
+        lines : list of (x0, y0, x1, y1)    Detector lines, given like walls
+        regions : list of (x0, y0, x1, y1)  Detector regions, corners of a box
+        every : int                         Steps per bin
+        capacity : int                      Maximum bins between two readDetectors()
+    """
+    def setDetectors(self, lines:Sequence[Sequence[float]]=(), regions:Sequence[Sequence[float]]=(), every:int=100, capacity:int=256):
+        if len(lines) + len(regions) == 0:
+            self.detectorAreas = np.zeros(0)
+            self.detectorBuffer = None
+            self.detectorStateBuffer = None
+            self.detectorBinBuffer = None
+            self.detectorPreviousBuffer = None
+            return
+        detectors = schema.DETECTOR.zeros(len(lines) + len(regions))
+        for i, (x0, y0, x1, y1) in enumerate(lines):
+            detectors[i] = ((x0, y0), (x1, y1), 0)
+        for i, (x0, y0, x1, y1) in enumerate(regions, len(lines)):
+            detectors[i] = ((min(x0, x1), min(y0, y1)), (max(x0, x1), max(y0, y1)), 1)
+        self.detectorAreas = np.where(detectors['region']>0, np.prod(detectors['end'] - detectors['start'], axis=1), np.nan)
+        self.settings.uDetectorEvery = max(every, 1)
+
+        self.detectorBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.detectorBuffer.setData(detectors)
+        self.detectorStateBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.DYNAMIC_DRAW)
+        self.detectorBinBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.DYNAMIC_DRAW)
+        self.detectorBinBuffer.reserveData(capacity*len(detectors)*schema.DETECTOR_BIN.size)
+        self.detectorPreviousBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.detectorPreviousBuffer.reserveData(self.N*16)
+        self._resetDetectors()
+
+    """ Empty the bins, the detectors start again at the current step
+    """
+    def _resetDetectors(self):
+        if self.detectorBuffer is None:
+            return
+        self.detectorStateBuffer.setData(schema.DETECTOR_STATE.zeros(1))
+        self.detectorBinBuffer.clear()
+        self.detectorPreviousBuffer.clear()
+        self.detectorStart = self.stepCount
+        self.detectorsDropped = 0
+
+    """ Return the completed bins of the detectors since the last call
+    Only the counters of the bins are read back. Returns a structured array of the
+    bins with the step the bin starts at, its steps and duration (simulation time)
+    and per detector (lines first, then regions, in the order given to setDetectors):
+        crossings       Vehicles crossing the line or entering the region
+        forward         Crossings from the right to the left of the line (start->end)
+        flow            Crossings per hour
+        occupancy       Mean amount of vehicles on the line or in the region
+        density         Vehicles per square meter of the regions (nan for lines)
+        speed           Mean speed of the vehicles on the detector
+        crossingSpeed   Mean speed of the crossing vehicles (time mean speed)
+    """
+    def readDetectors(self):
+        D = len(self.detectorAreas)
+        dtype = [('step', '<u8'), ('steps', '<u4'), ('duration', '<f4'), ('crossings', '<u4', (D,)), ('forward', '<u4', (D,)), ('flow', '<f4', (D,)),
+            ('occupancy', '<f4', (D,)), ('density', '<f4', (D,)), ('speed', '<f4', (D,)), ('crossingSpeed', '<f4', (D,))]
+        if self.detectorBuffer is None:
+            return np.zeros(0, dtype=dtype)
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        state = schema.DETECTOR_STATE.fromBytes(self.detectorStateBuffer.getData(schema.DETECTOR_STATE.size)).copy()
+        every = max(int(self.settings.uDetectorEvery), 1)
+        capacity = self.detectorBinBuffer.length//(D*schema.DETECTOR_BIN.size)
+        tick = int(state['tick'][0])
+        complete, partial = divmod(tick, every)
+        used = min(complete + (partial>0), capacity)
+        counters = schema.DETECTOR_BIN.fromBytes(self.detectorBinBuffer.getData(used*D*schema.DETECTOR_BIN.size)).reshape(used, D)
+
+        n = min(complete, capacity)
+        bins = np.zeros(n, dtype=dtype)
+        c = counters[:n]
+        bins['step'] = self.detectorStart + np.arange(n)*every
+        bins['steps'] = c['steps'][:, 0]
+        bins['duration'] = c['duration'][:, 0]
+        bins['crossings'] = c['crossings']
+        bins['forward'] = c['forward']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bins['flow'] = c['crossings']/c['duration']*3600
+            bins['occupancy'] = c['occupied']/c['steps']
+            bins['density'] = bins['occupancy']/self.detectorAreas
+            bins['speed'] = c['speed']/DETECTOR_SPEED_SCALE/c['occupied']
+            bins['crossingSpeed'] = c['crossingSpeed']/DETECTOR_SPEED_SCALE/c['crossings']
+
+        # The bin in progress moves to the front, the others are emptied
+        cleared = np.zeros_like(counters)
+        if partial>0 and complete<capacity:
+            cleared[0] = counters[complete]
+        if used>0:
+            self.detectorBinBuffer.subData(cleared)
+        self.detectorsDropped += int(state['dropped'][0])
+        self.detectorStart += complete*every
+        state['tick'] = partial
+        state['dropped'] = 0
+        self.detectorStateBuffer.subData(state)
+        return bins
+
+    """ Stop the run early when one of the criteria is met
+    The criteria are evaluated on the GPU each step into a flag buffer which is
+    polled every every steps, so a run stops at most every-1 steps late. The met
+    criteria are in stopReason (STOP_* bits). Call without arguments to disable.
+    parameters:
+        collision : bool        Stop at the first collision
+        exited : bool           Stop when all vehicles left the world (the walls plus a
+            margin of 10m) or collided
+        orderTolerance : float  Tolerance of the order parameter (polarization of the
+            velocities, 1 if all vehicles drive in the same direction)
+        orderTime : float       Stop when the order parameter stayed within orderTolerance
+            for orderTime of simulation time, 0 to disable
+        wallClock : float       Stop after wallClock seconds of real time, 0 to disable
+        every : int             Poll period in steps
+    """
+    def setTermination(self, collision:bool=False, exited:bool=False, orderTolerance:float=0.01, orderTime:float=0.0, wallClock:float=0.0, every:int=10):
+        self.settings.uStopCollision = float(collision)
+        self.settings.uStopExited = float(exited)
+        self.settings.uStopOrderTolerance = orderTolerance
+        self.settings.uStopOrderTime = orderTime
+        self.stopWallClock = wallClock
+        enabled = collision or exited or orderTime>0 or wallClock>0
+        self.stopEvery = every if enabled else 0
+        self.stopReason = 0
+        self._stopStart = time.perf_counter()
+
+    """ Evaluate the termination criteria of this step on the GPU
+    """
+    def _addTerminationPasses(self, graph:gr.PassGraph):
+        graph.add('termination', lambda: self.terminationProgram.dispatch((self.N+63)//64),
+            reads=(BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE), writes=(BIND_TERMINATION,), programs=(self.terminationProgram,))
+        graph.add('terminationResolve', lambda: self.terminationResolveProgram.dispatch(1),
+            reads=(BIND_SIM_STATE, BIND_TERMINATION, BIND_TIME_STEP), writes=(BIND_TERMINATION,), programs=(self.terminationResolveProgram,))
+
+    """ Read the termination flags, returns True if the run must stop
+    """
+    def _pollTermination(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        offset, size = schema.TERMINATION.fieldRange('flags')
+        self.stopReason = int(np.frombuffer(self.terminationBuffer.getData(size, offset), dtype="uint32")[0])
+        if self.stopWallClock>0 and time.perf_counter()-self._stopStart >= self.stopWallClock:
+            self.stopReason |= STOP_WALLCLOCK
+        return self.stopReason != 0
+
+    """ Return the collisions since the last call
+    Only the event counter and the new events are read back (not simState). Each
+    vehicle has one event, at its first collision. Returns a structured array (see
+    schema.COLLISION_EVENT). Events which did not fit in the log are counted in
+    collisionsDropped, call this more often if that happens.
+    """
+    def collisionEvents(self):
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        count = int(np.frombuffer(self.collisionCountBuffer.getData(4), dtype="uint32")[0])
+        if count == 0:
+            return schema.COLLISION_EVENT.zeros(0)
+        n = min(count, COLLISION_CAPACITY)
+        events = schema.COLLISION_EVENT.fromBytes(self.collisionEventBuffer.getData(n*schema.COLLISION_EVENT.size))
+        self.collisionsDropped += count - n
+        self.collisionCountBuffer.subData(np.zeros(1, dtype="uint32"))
+        return events
+
+    """ Save the full simulation state to a checkpoint file
+    The state of all vehicles, the walls, the global settings and the step count
+    and time are written to a single memory-mapped file (see checkpoint.py)
+    """
+    def checkpoint(self, path:str):
+        self._syncTime()
+        gl.glMemoryBarrier(gl.GL_BUFFER_UPDATE_BARRIER_BIT)
+        sections = {
+            'posState' : self.vehicleData(self.posStateBuffer, schema.POS_STATE),
+            'movState' : self.vehicleData(self.movStateBuffer, schema.MOV_STATE),
+            'simState' : self.vehicleData(self.simStateBuffer, schema.SIM_STATE),
+            'walls' : self._wallVBuffer.getData(0),
+            'wallInfo' : self.wallInfoBuffer.getData(0),
+            'globals' : self.globalSettings,
+        }
+        if self.internalDataBuffer is not None:
+            sections['internalData'] = self.vehicleData(self.internalDataBuffer, schema.INTERNAL_DATA)
+        checkpoint.write(path, self.N, self.M, self.stepCount, self.time, sections)
+
+    """ Restore the full simulation state from a checkpoint file
+    Can be called before start() (start() then continues from the checkpoint
+    instead of calling algoInit) or while running (i.e. from dataPass). The global
+    settings are restored as well, change them afterwards to fork a variation. The
+    run configuration of this instance (RUN_SETTINGS, i.e. neighbour lists, adaptive
+    time, termination, probe and detectors) is kept, the buffers are sized for it.
+    """
+    def restore(self, path:str):
+        cp = checkpoint.Checkpoint(path)
+        if cp.N != self.N:
+            raise ValueError("Checkpoint has N = %d but simulation has N = %d"%(cp.N, self.N))
+
+        self.posStateBuffer.setData(np.asarray(cp['posState']))
+        self.movStateBuffer.setData(np.asarray(cp['movState']))
+        if self.internalDataBuffer is not None and 'internalData' in cp:
+            self.internalDataBuffer.setData(np.asarray(cp['internalData']))
+        # The checkpoint gives the parameters of the simulation, the run configuration
+        # of this instance is kept
+        kept = {name:getattr(self.settings, name) for name in RUN_SETTINGS}
+        self.globalSettings.reshape(-1).view(np.uint8)[:] = cp['globals']
+        for name, value in kept.items():
+            setattr(self.settings, name, value)
+        # The checkpoint is in ID order, the shaders map slots to IDs only if this instance reorders
+        self.settings.uReorder = float(self.vehicleIDBuffer is not None)
+        self._initWorld(np.asarray(cp.get('walls', 'f')), np.asarray(cp['simState']))
+        if cp.M>0:
+            self.wallInfoBuffer.subData(np.asarray(cp['wallInfo']))
+
+        self.stepCount = cp.stepCount
+        self.time = cp.time
+        self.restored = True
+        self._snapshot()
+
+    """ Start capturing frames
+    Frames are drawn into an offscreen framebuffer of width by height pixels and
+    read back asynchronously (see capture.py), after every every-th step of both
+    start() and step() and also if rendering is disabled. The level of detail of
+    renderMode 'gpu' follows from width.
+    parameters:
+        path : str      Directory for a png sequence or file for a raw rgb24 video
+        every : int     Capture every every-th step
+        format : str    'png' or 'raw'
+    """
+    def startCapture(self, path:str, width:int=800, height:int=800, every:int=1, format:str='png'):
+        self.stopCapture()
+        self.capture = capture.FrameCapture(path, width, height, format)
+        self.captureEvery = every
+
+    """ Stop capturing frames and write the remaining frames
+    """
+    def stopCapture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    """ Start recording the trajectories of all vehicles
+    The position, rotation, velocity, speed, steering angle and collision flag of
+    every vehicle (by ID) are quantized and written compressed to a trajectory
+    archive (see trajectory.py), read it with trajectory.Trajectory(path).
+    parameters:
+        path : str      File to write to
+        every : int     Record every every-th step
+        fields : dict   Recorded fields and their quanta, see trajectory.FIELDS
+    """
+    def startTrajectory(self, path:str, every:int=1, fields:dict=trajectory.FIELDS):
+        self.stopTrajectory()
+        self.trajectory = trajectory.TrajectoryWriter(path, self.N, fields)
+        self.trajectoryEvery = every
+
+    """ Stop recording trajectories and complete the archive
+    """
+    def stopTrajectory(self):
+        if self.trajectory is not None:
+            try:
+                self.trajectory.close()
+            finally:
+                self.trajectory = None
+
+    """ Add the current state to the trajectory archive
+    """
+    def _recordTrajectory(self):
+        self._syncTime()
+        self.trajectory.append(self.stepCount, self.time, {
+            'posState' : self.vehicleData(self.posStateBuffer, schema.POS_STATE),
+            'movState' : self.vehicleData(self.movStateBuffer, schema.MOV_STATE),
+            'simState' : self.vehicleData(self.simStateBuffer, schema.SIM_STATE),
+        })
 
     """ Create buffers for simulation
     """
@@ -140,18 +1140,58 @@ class Simulation:
         self.globalSettingsBuffer = gr.Buffer(gr.UNIFORM_BUFFER, gr.DYNAMIC_DRAW)
         self.wallInfoBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
         self.distanceBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
-        self.debugBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
-        self.internalDataBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.debugBuffer = None
+        self.internalDataBuffer = None
+        self.visibleBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.drawCommandBuffer = gr.Buffer(gr.DRAW_INDIRECT_BUFFER, gr.DYNAMIC_DRAW)
+        self.heatCountBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.heatBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.collisionCountBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.DYNAMIC_DRAW)
+        self.collisionEventBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.terminationBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.DYNAMIC_DRAW)
+        self.timeStepBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.DYNAMIC_DRAW)
+        self.neighbourStateBuffer = None
+        self.neighbourBuffer = None
+        self.neighbourInfoBuffer = None
+        self.vehicleIDBuffer = None
+        self.vehicleSlotBuffer = None
+        self.probeEntryBuffer = None
+        self.probeStateBuffer = None
+        self.probeBuffer = None
+        self.detectorBuffer = None
+        self.detectorStateBuffer = None
+        self.detectorBinBuffer = None
+        self.detectorPreviousBuffer = None
+        self._identity = np.zeros(self.N, dtype=[('id', '<u4')])
+        self._identity['id'] = np.arange(self.N)
 
         # Reserve space for buffers
-        self.posStateBuffer.reserveData(self.N*8*4)
-        self.movStateBuffer.reserveData(self.N*16*4)
-        self.globalSettingsBuffer.reserveData(22*4)
-        self.debugBuffer.reserveData(self.N*16*4)
-        self.internalDataBuffer.reserveData(self.N*16*4)
+        self.posStateBuffer.reserveData(self.N*schema.POS_STATE.size)
+        self.movStateBuffer.reserveData(self.N*schema.MOV_STATE.size)
+        self.globalSettingsBuffer.reserveData(schema.GLOBALS.size)
+        self.visibleBuffer.reserveData(self.N*4)
+        self.drawCommandBuffer.reserveData(schema.DRAW_COMMAND.size*2)
+        self.collisionCountBuffer.setData(np.zeros(1, dtype="uint32"))
+        self.collisionEventBuffer.reserveData(COLLISION_CAPACITY*schema.COLLISION_EVENT.size)
+        self.collisionsDropped = 0
+        self.terminationBuffer.setData(schema.TERMINATION.zeros(1))
+        self.timeStepBuffer.setData(schema.TIME_STEP.zeros(1))
+        self._timeBuffers = [gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STREAM_READ) for _ in range(3)]
+        for buffer in self._timeBuffers:
+            buffer.reserveData(4)
+        self._timeReads = []
+        self._nextTimeBuffer = 0
+
+        # Buffers only used by some shader features
+        if 'DEBUG' in self.features:
+            self.debugBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+            self.debugBuffer.reserveData(self.N*16*4)
+        if 'WRITE_INTERNAL_DATA' in self.features:
+            self.internalDataBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+            self.internalDataBuffer.reserveData(self.N*schema.INTERNAL_DATA.size)
 
         # Zero out simStateBuffer
-        simState = np.zeros([self.N, 4], dtype="uint32")
+        simState = schema.SIM_STATE.zeros(self.N)
         self.simStateBuffer.setData(simState)
 
     """ Bind buffers to right binding
@@ -164,8 +1204,34 @@ class Simulation:
         self.distanceBuffer.bindBase(5)
         self._wallVBuffer.bindBase(6, type=gr.SHADER_STORAGE_BUFFER)
         self.wallInfoBuffer.bindBase(7)
-        self.debugBuffer.bindBase(8)
-        self.internalDataBuffer.bindBase(9)
+        if self.debugBuffer is not None:
+            self.debugBuffer.bindBase(8)
+        if self.internalDataBuffer is not None:
+            self.internalDataBuffer.bindBase(9)
+        self.visibleBuffer.bindBase(10)
+        self.drawCommandBuffer.bindBase(11, type=gr.SHADER_STORAGE_BUFFER)
+        self.heatCountBuffer.bindBase(12)
+        self.heatBuffer.bindBase(13)
+        self.collisionCountBuffer.bindBase(14)
+        self.collisionEventBuffer.bindBase(15)
+        self.terminationBuffer.bindBase(16)
+        self.timeStepBuffer.bindBase(17)
+        if self.neighbourStateBuffer is not None:
+            self.neighbourStateBuffer.bindBase(18, type=gr.SHADER_STORAGE_BUFFER)
+            self.neighbourBuffer.bindBase(19)
+            self.neighbourInfoBuffer.bindBase(20)
+        if self.vehicleIDBuffer is not None:
+            self.vehicleIDBuffer.bindBase(26)
+            self.vehicleSlotBuffer.bindBase(29)
+        if self.probeBuffer is not None:
+            self.probeEntryBuffer.bindBase(30)
+            self.probeStateBuffer.bindBase(31)
+            self.probeBuffer.bindBase(32)
+        if self.detectorBuffer is not None:
+            self.detectorBuffer.bindBase(33)
+            self.detectorStateBuffer.bindBase(34)
+            self.detectorBinBuffer.bindBase(35)
+            self.detectorPreviousBuffer.bindBase(36)
 
     """ Create assets for drawing
     """
@@ -207,6 +1273,7 @@ class Simulation:
             0.87, -2.45, 0.0,
             0.9, -2.45, 0.0,
         ], dtype="f")
+        carVertices = vertices
         self._carVBuffer.setData(vertices)
         self._carIBuffer = gr.Buffer(gr.INDEX_BUFFER, gr.STATIC_DRAW)
         indices = np.array([
@@ -220,6 +1287,7 @@ class Simulation:
             12, 13, 17,
             12, 17, 16,
         ], dtype="uint32")
+        carIndices = indices
         self._carIBuffer.setData(indices)
         self.carVAO = gr.VertexArray(self._carVBuffer, self._carIBuffer, [
             gr.VertexElement(3, gr.FLOAT)
@@ -233,16 +1301,58 @@ class Simulation:
             0.02, 1.0, 0.0,
             0.02, 0.0, 0.0,
         ], dtype="f")
+        lineVertices = vertices
         self._lineVBuffer.setData(vertices)
         self._lineIBuffer = gr.Buffer(gr.INDEX_BUFFER, gr.STATIC_DRAW)
         indices = np.array([
             0, 1, 2, 0, 2, 3
         ], dtype="uint32")
+        lineIndices = indices
         self._lineIBuffer.setData(indices)
         self.lineVAO = gr.VertexArray(self._lineVBuffer, self._lineIBuffer, [
             gr.VertexElement(3, gr.FLOAT)
         ])
 
+        # VEHICLE VAO (all glyphs in one mesh for the GPU driven rendering)
+        # Vertices are [x, y, z, part], see shaders/graphics/vehicle.vert
+        carVertices = carVertices.reshape(-1, 3)
+        lineVertices = lineVertices.reshape(-1, 3)
+        parts = [
+            (carVertices[[12, 13, 17, 16]], np.array([0, 1, 2, 0, 2, 3])),    # Filling (first, used as impostor)
+            (carVertices, carIndices[:42]),                                     # H outline
+            (lineVertices, lineIndices),                                        # Steering angle
+            (lineVertices, lineIndices),                                        # Velocity
+            (lineVertices, lineIndices),                                        # Desired velocity
+        ]
+        vertices, indices, first = [], [], 0
+        for part, (v, i) in enumerate(parts):
+            vertices.append(np.concatenate([v, np.full([len(v), 1], part, dtype="f")], axis=1))
+            indices.append(i + first)
+            first += len(v)
+        self._vehicleVBuffer = gr.Buffer(gr.VERTEX_BUFFER, gr.STATIC_DRAW)
+        self._vehicleVBuffer.setData(np.concatenate(vertices).astype("f"))
+        self._vehicleIBuffer = gr.Buffer(gr.INDEX_BUFFER, gr.STATIC_DRAW)
+        self._vehicleIBuffer.setData(np.concatenate(indices).astype("uint32"))
+        self._vehicleIndexCount = self._vehicleIBuffer.length//4
+        self.vehicleVAO = gr.VertexArray(self._vehicleVBuffer, self._vehicleIBuffer, [
+            gr.VertexElement(3, gr.FLOAT),
+            gr.VertexElement(1, gr.FLOAT)
+        ])
+
+        # SCREEN VAO (full screen quad)
+        self._screenVBuffer = gr.Buffer(gr.VERTEX_BUFFER, gr.STATIC_DRAW)
+        self._screenVBuffer.setData(np.array([
+            -1.0, -1.0,
+            1.0, -1.0,
+            1.0, 1.0,
+            -1.0, 1.0,
+        ], dtype="f"))
+        self._screenIBuffer = gr.Buffer(gr.INDEX_BUFFER, gr.STATIC_DRAW)
+        self._screenIBuffer.setData(np.array([0, 1, 2, 0, 2, 3], dtype="uint32"))
+        self.screenVAO = gr.VertexArray(self._screenVBuffer, self._screenIBuffer, [
+            gr.VertexElement(2, gr.FLOAT)
+        ])
+
         # Wall
         # ----
         self._wallVBuffer = gr.Buffer(gr.VERTEX_BUFFER, gr.STATIC_DRAW)
@@ -254,90 +1364,189 @@ class Simulation:
         # Create shaders
         # --------------
         # The header contains all the buffer bindings and will be prepended to all the shaders
-        header = ''
+        # The struct and uniform block declarations are generated from schema.py and the
+        # #defines of the enabled features are inserted after the #version line
         with open("shaders/header.glsl") as f:
-            header = f.read()
+            self.header = self._variantHeader(schema.expandHeader(f.read()))
+        self._tune()
 
         # Car drawing program
         # Draws vehicle as red 'H'
-        shaders = []
-        with open("shaders/graphics/car.vert") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.VERTEX_SHADER))
-        with open("shaders/graphics/red.frag") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.FRAGMENT_SHADER))
-        self.carProgram = gr.ShaderProgram(shaders)
+        self.carProgram = self.program("shaders/graphics/car.vert", "shaders/graphics/red.frag")
 
         # Car filling program
         # Fill in vehicle
-        shaders = []
-        with open("shaders/graphics/car.vert") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.VERTEX_SHADER))
-        with open("shaders/graphics/darkred.frag") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.FRAGMENT_SHADER))
-        self.carFillingProgram = gr.ShaderProgram(shaders)
+        self.carFillingProgram = self.program("shaders/graphics/car.vert", "shaders/graphics/darkred.frag")
 
         # Steering angle program
         # Draws a yellow line at the front of the vehicle
-        shaders = []
-        with open("shaders/graphics/angle.vert") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.VERTEX_SHADER))
-        with open("shaders/graphics/yellow.frag") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.FRAGMENT_SHADER))
-        self.angleProgram = gr.ShaderProgram(shaders)
+        self.angleProgram = self.program("shaders/graphics/angle.vert", "shaders/graphics/yellow.frag")
 
         # Velocity program
         # Draws a green line at the center of the vehicle
-        shaders = []
-        with open("shaders/graphics/velocity.vert") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.VERTEX_SHADER))
-        with open("shaders/graphics/green.frag") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.FRAGMENT_SHADER))
-        self.velocityProgram = gr.ShaderProgram(shaders)
+        self.velocityProgram = self.program("shaders/graphics/velocity.vert", "shaders/graphics/green.frag")
 
         # Desired velocity program
         # Draws a blue line at the center of the vehicle
-        shaders = []
-        with open("shaders/graphics/dvelocity.vert") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.VERTEX_SHADER))
-        with open("shaders/graphics/blue.frag") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.FRAGMENT_SHADER))
-        self.dVelocityProgram = gr.ShaderProgram(shaders)
+        self.dVelocityProgram = self.program("shaders/graphics/dvelocity.vert", "shaders/graphics/blue.frag")
+
+        # Vehicle program
+        # Draws all glyphs of the visible vehicles in one pass (GPU driven rendering)
+        self.vehicleProgram = self.program("shaders/graphics/vehicle.vert", "shaders/graphics/vehicle.frag")
+
+        # Cull program
+        # Fills the visible vehicle list and the indirect draw command
+        self.cullProgram = self.program("shaders/cull.comp")
+
+        # Heatmap programs
+        # Scatter vehicles into the grid, accumulate the grid and draw it colormapped
+        self.heatmapProgram = self.program("shaders/heatmap.comp")
+        self.heatResolveProgram = self.program("shaders/heatresolve.comp")
+        self.heatmapDrawProgram = self.program("shaders/graphics/heatmap.vert", "shaders/graphics/heatmap.frag")
 
         # Obstacle program
         # Draws yellow lines as walls
-        shaders = []
-        with open("shaders/graphics/wall.vert") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.VERTEX_SHADER))
-        with open("shaders/graphics/blue.frag") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.FRAGMENT_SHADER))
-        self.wallProgram = gr.ShaderProgram(shaders)
+        self.wallProgram = self.program("shaders/graphics/wall.vert", "shaders/graphics/blue.frag")
 
         # Distance calculation program
         # Creates a N+M,N sized matrix with distances between vehicle i and object j
-        shaders = []
-        with open("shaders/distance.comp") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.COMPUTE_SHADER))
-        self.distanceProgram = gr.ShaderProgram(shaders)
+        self.distanceProgram = self.program("shaders/distance.glsl", "shaders/distance.comp")
+
+        # Neighbour list programs
+        # Track the displacement, rebuild the lists when needed or update the distances
+        # of the candidates only
+        self.displacementProgram = self.program("shaders/displacement.comp")
+        self.neighbourResolveProgram = self.program("shaders/neighbourresolve.comp")
+        self.neighbourProgram = self.program("shaders/distance.glsl", "shaders/neighbours.comp")
+        self.neighbourDistanceProgram = self.program("shaders/distance.glsl", "shaders/neighbourdistance.comp")
+
+        # Collision program
+        # Tests the footprints of close objects and logs the collisions
+        self.collisionProgram = self.program("shaders/collision.comp")
+
+        # Termination programs
+        # Accumulate and evaluate the early termination criteria
+        self.terminationProgram = self.program("shaders/termination.comp")
+        self.terminationResolveProgram = self.program("shaders/terminationresolve.comp")
+
+        # Time step programs
+        # Reduce the clearance and speed of all vehicles and choose the adaptive time step
+        self.timeStepProgram = self.program("shaders/timestep.comp")
+        self.timeStepResolveProgram = self.program("shaders/timestepresolve.comp")
+
+        # Reordering programs
+        # Sort the vehicles by the Z-order code of their position and permute their state
+        self.mortonKeyProgram = self.program("shaders/mortonkey.comp")
+        self.radixCountProgram = self.program("shaders/radixcount.comp")
+        self.radixScanProgram = self.program("shaders/radixscan.comp")
+        self.radixScatterProgram = self.program("shaders/radixscatter.comp")
+        self.permuteProgram = self.program("shaders/permute.comp")
+        self.vehicleSlotProgram = self.program("shaders/vehicleslot.comp")
+
+        # Probe program
+        # Gathers the probed fields of the probed vehicles into the probe buffer
+        self.probeProgram = self.program("shaders/probe.comp")
+
+        # Detector programs
+        # Count the crossings and occupancy of the detector lines and regions
+        self.detectorProgram = self.program("shaders/detector.comp")
+        self.detectorResolveProgram = self.program("shaders/detectorresolve.comp")
 
         # Vehicle movement program
         # Calculates the velocity and steering angle from a desired velocity 
-        shaders = []
-        with open("shaders/vehiclemovement.comp") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.COMPUTE_SHADER))
-        self.moveProgram = gr.ShaderProgram(shaders)
+        self.moveProgram = self.program("shaders/vehiclemovement.comp")
 
         # Precalc program
         # Calculates the normals on each obstacle
-        shaders = []
-        with open("shaders/precalc.comp") as f:
-            shaders.append(gr.Shader(header + f.read(), gr.COMPUTE_SHADER))
-        self.precalcProgram = gr.ShaderProgram(shaders)
+        self.precalcProgram = self.program("shaders/precalc.comp")
+
+    """ Insert the #defines of the enabled features after the #version line
+    """
+    def _variantHeader(self, header:str):
+        version, _, rest = header.partition('\n')
+        defines = ''.join('#define %s\n'%feature for feature in sorted(self.features))
+        return version + '\n' + defines + rest
+
+    """ Compile (or get from the cache) a shader program of the variant of this run
+    The header with the feature #defines is prepended to each file, the shader
+    stage follows from the extension (.comp, .vert, .frag). Library files (.glsl)
+    are prepended to the next shader file. Use this for the algorithm shaders as
+    well (i.e. sim.program("shaders/algorithm.comp"))
+    """
+    def program(self, *files:str):
+        if files not in self._programs:
+            self._programs[files] = self._compile(files, self.localSizes.get(files[-1]))
+        return self._programs[files]
 
-        self.header = header
+    """ Compile a shader program, with the workgroup size localSize (x, y) if given
+    """
+    def _compile(self, files:Sequence[str], localSize:Sequence[int]=None):
+        header = self.header
+        if localSize is not None:
+            version, _, rest = header.partition('\n')
+            header = version + '\n#define LOCAL_SIZE_X %d\n#define LOCAL_SIZE_Y %d\n'%tuple(localSize) + rest
+        shaders = []
+        library = ''
+        for file in files:
+            with open(file) as f:
+                source = f.read()
+            extension = file[file.rindex('.'):]
+            if extension == '.glsl':
+                library += source + '\n'
+                continue
+            shaders.append(gr.Shader(header + library + source, _SHADER_TYPES[extension]))
+            library = ''
+        return gr.ShaderProgram(shaders)
+
+    """ Load the workgroup sizes of this device from the profile, tune them on the first run
+    """
+    def _tune(self):
+        if self.tuningProfile is None:
+            return
+        sizes = tuning.load(self.tuningProfile, self.features)
+        if sizes is None:
+            print("Tuning workgroup sizes for %s"%tuning.renderer())
+            sizes = tuning.tune(self._compile)
+            tuning.save(sizes, self.tuningProfile, self.features)
+        self.localSizes = sizes
+
+    """ Add the compute passes which prepare the draws of this step (culling, heatmap)
+    """
+    def _addViewPasses(self, graph:gr.PassGraph):
+        if self.renderMode == 'gpu':
+            graph.add('cull', self._cull, reads=(BIND_POS_STATE, BIND_SIM_STATE), writes=(BIND_VISIBLE, BIND_DRAW_COMMAND), programs=(self.cullProgram,))
+        elif self.renderMode == 'heatmap':
+            graph.add('heatmap', lambda: self.heatmapProgram.dispatch((self.N+63)//64),
+                reads=(BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE), writes=(BIND_HEAT_COUNT,), programs=(self.heatmapProgram,))
+            graph.add('heatResolve', lambda: self.heatResolveProgram.dispatch((self.heatCells+63)//64),
+                reads=(BIND_HEAT_COUNT, BIND_HEAT), writes=(BIND_HEAT_COUNT, BIND_HEAT), programs=(self.heatResolveProgram,))
+
+    """ Add the passes which draw the vehicles and obstacles
+    The draws keep their order and use the results of the view passes (see
+    _addViewPasses), so they can be drawn again (i.e. for a capture) without them.
+    The level of detail follows from the width of the target framebuffer
+    """
+    def _addDrawPasses(self, graph:gr.PassGraph, width:int):
+        if self.renderMode == 'gpu':
+            graph.add('drawVehicles', lambda: self._drawVehiclesCulled(width), reads=(BIND_POS_STATE, BIND_MOV_STATE, BIND_VISIBLE),
+                indirect=(BIND_DRAW_COMMAND,), programs=(self.vehicleProgram,), ordered=True)
+        elif self.renderMode == 'heatmap':
+            graph.add('drawHeatmap', self._drawHeatmap, reads=(BIND_HEAT,), programs=(self.heatmapDrawProgram,), ordered=True)
+        else:
+            graph.add('drawVehicles', self._drawVehicles, reads=(BIND_POS_STATE, BIND_MOV_STATE),
+                programs=(self.carProgram, self.carFillingProgram, self.angleProgram, self.velocityProgram, self.dVelocityProgram), ordered=True)
+        graph.add('drawWalls', self._drawWalls, programs=(self.wallProgram,), ordered=True)
+
+    """ Draw the obstacles
+    """
+    def _drawWalls(self):
+        self.wallProgram.use()
+        self.wallVAO.bind()
+        gl.glDrawElements(gl.GL_LINES, self._wallIBuffer.length//4, gl.GL_UNSIGNED_INT, ctypes.c_void_p(0))
 
-    """ Draw vehicles and obstacles
+    """ Draw all vehicles with instanced draws per glyph
     """
-    def _drawObjects(self):
+    def _drawVehicles(self):
         # Draw car
         self.carVAO.bind()
         self.carFillingProgram.use()
@@ -345,7 +1554,6 @@ class Simulation:
         self.carProgram.use()
         gr.drawInstanced(42, self.N)
 
-
         # Draw steering angle vector
         self.angleProgram.use()
         self.lineVAO.bind()
@@ -359,50 +1567,108 @@ class Simulation:
         self.dVelocityProgram.use()
         gr.drawInstanced(6, self.N)
 
-        # Draw walls
-        self.wallProgram.use()
-        self.wallVAO.bind()
-        gl.glDrawElements(gl.GL_LINES, self._wallIBuffer.length//4, gl.GL_UNSIGNED_INT, ctypes.c_void_p(0))
+    """ Fill the visible vehicle list and the indirect draw command
+    """
+    def _cull(self):
+        # Reset the draw commands of the impostor (only the filling) and of the full vehicle
+        command = schema.DRAW_COMMAND.zeros(2)
+        command['count'] = (6, self._vehicleIndexCount)
+        self.drawCommandBuffer.subData(command)
 
-    """ Render pass callback
+        self.cullProgram.dispatch((self.N+63)//64)
+
+    """ Draw the visible vehicles with one indirect draw into a framebuffer of width pixels
+    The cull pass writes the visible vehicles and their count into the draw commands,
+    only the impostors are drawn when the vehicles are small in the framebuffer
     """
-    def _renderPass(self):
-        # Update globalSettingsBuffer
-        self.globalSettingsBuffer.setData(self.globalSettings)
+    def _drawVehiclesCulled(self, width:int):
+        self.vehicleProgram.use()
+        self.vehicleVAO.bind()
+        self.drawCommandBuffer.bind()
+        gr.drawIndirect(0 if self._vehiclePixels(width)<LOD_PIXELS else schema.DRAW_COMMAND.size)
+
+    """ Draw the heatmap as one full screen quad
+    The cost does not depend on the amount of vehicles drawn
+    """
+    def _drawHeatmap(self):
+        self.heatmapDrawProgram.use()
+        self.screenVAO.bind()
+        gr.draw(6)
 
-        self._bindBuffers()
+    """ Length of a vehicle in pixels in a framebuffer of width pixels
+    """
+    def _vehiclePixels(self, width:int):
+        return abs(self.globalSettings[0][0][0]) * 4.9 * width/2
 
-        self.distanceProgram.dispatch(self.N, self.N+self.M)
-        gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+    """ Draw the vehicles and obstacles into the capture framebuffer and start its readback
+    With drawn the view passes (see _addViewPasses) already ran this step and only
+    the draws are replayed
+    """
+    def _capturePass(self, graph:gr.PassGraph, drawn:bool=False):
+        self.capture.begin()
+        if not drawn:
+            self._addViewPasses(graph)
+        self._addDrawPasses(graph, self.capture.width)
+        graph.run()
+        self.capture.end()
+        gl.glViewport(0, 0, self.window.width, self.window.height)
 
-        self.algoPass(self)
-        gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+    """ Render pass callback
+    """
+    def _renderPass(self):
+        # Update changed part of globalSettingsBuffer
+        self.settings.upload(self.globalSettingsBuffer)
 
-        self.moveProgram.dispatch(self.N)
-        gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+        self._bindBuffers()
 
+        # Simulation step and drawing, the pass graph places the barriers
+        adaptive = self.settings.uAdaptiveTime>0
+        self._addSimulationPasses(self.passGraph)
         if self.rendering:
-            # Draw objects to screen
-            self._drawObjects()
+            self._addViewPasses(self.passGraph)
+            self._addDrawPasses(self.passGraph, self.window.width)
+        self.passGraph.run()
 
+        if self.rendering:
             # Draw GUI
             self.guiPass(self)
 
         # Increase step count
         self.stepCount += 1
-        self.time += self.globalSettings[1][0][0]
+        if adaptive:
+            self._requestTime()
+        else:
+            self.time += self.settings.uDeltaTime
         if self.steps>0 and self.stepCount==self.steps:
             # self.window.close()
             self.window.softclose()
 
-        # Run dataPass after period
-        if self.dataPassPeriod>0 and self.stepCount%self.dataPassPeriod == 0:
+        # Capture the state after the step, before the reordering invalidates the visible list
+        if self.capture is not None and self.stepCount%self.captureEvery == 0:
+            self._capturePass(self.passGraph, drawn=self.rendering)
+
+        # Reorder the vehicles before dataPass sees the state
+        if self.reorderEvery>0 and self.stepCount%self.reorderEvery == 0:
+            self._reorderPass()
+
+        if self.trajectory is not None and self.stepCount%self.trajectoryEvery == 0:
+            self._recordTrajectory()
+
+        # Stop early if a termination criterion is met
+        if self.stopEvery>0 and self.stepCount%self.stopEvery == 0 and self._pollTermination():
+            self.window.softclose()
+
+        # Run dataPass after period (in simulation time with adaptive time steps)
+        if adaptive:
+            if self.dataPassPeriod>0 and self.time >= self._nextDataTime:
+                self._nextDataTime += self.dataPassPeriod*self.settings.uDeltaTime
+                self.dataPass(self)
+        elif self.dataPassPeriod>0 and self.stepCount%self.dataPassPeriod == 0:
             self.dataPass(self)
 
         if self.inReset:
             self.inReset = False
-            imgui.render()
-            self._reset()
+            self._reset(self.resetReinit)
 
     """ Window resize callback
     """
@@ -442,45 +1708,26 @@ class Simulation:
         if glfw.get_key(window, glfw.KEY_ESCAPE):
             self.window.close()
 
-    """ Reset simulation
+    """ Reset simulation (after the current step)
+    By default the initial state (of algoInit or the restored checkpoint) is copied
+    back from the pristine copy on the GPU. With reinit algoInit is called again,
+    use this if algoInit creates a different world each time.
     """
-    def reset(self):
+    def reset(self, reinit:bool=False):
         self.inReset = True
+        self.resetReinit = reinit
 
     """ Internal reset function
+    The running window loop simply continues with the reset state
     """
-    def _reset(self):
-        # Initialize algorithm by calling algoInit function
-        wallVertices, simState = self.algoInit(self)
-        # Create obstacle vertex and index buffers
-        self._wallVBuffer.setData(wallVertices)
-        wallIndices = np.arange(0, len(wallVertices), 1, dtype="uint32")
-        self._wallIBuffer.setData(wallIndices)
-        self.M = len(wallVertices)//4           # M = amount of obstacles
-
-        print("N = %d, M = %d"%(self.N, self.M))
-
-        # Set global settings
-        self._bindBuffers()
-        self.globalSettings[1][0][1] = float(self.N)
-        self.globalSettings[1][0][2] = float(self.M)
-        self.globalSettingsBuffer.setData(self.globalSettings)
-        gl.glMemoryBarrier(gl.GL_UNIFORM_BARRIER_BIT)
-
-        # Reserve space for M dependent buffers
-        self.distanceBuffer.reserveData(4*2*self.N*(self.N+self.M))
-        self.wallInfoBuffer.reserveData(4*1*self.M)
-
-        # Zero out simStateBuffer
-        #simState = np.zeros([self.N, 4], dtype="uint32")
-        self.simStateBuffer.setData(simState)
-
-        # Execute precalc shader
-        # This will calculate obstacle normals
-        self.precalcProgram.dispatch(self.M)
-        gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
-
-        # Run the simulation
-        self.stepCount = 0
-        self.time = 0.0
-        self.window.run()
\ No newline at end of file
+    def _reset(self, reinit:bool=False):
+        if reinit or len(self._pristine)==0:
+            # Initialize algorithm by calling algoInit function
+            wallVertices, simState = self.algoInit(self)
+            self._initWorld(wallVertices, simState)
+            self.stepCount = 0
+            self.time = 0.0
+            self._snapshot()
+        else:
+            self._restoreSnapshot()
+        self._stopStart = time.perf_counter()
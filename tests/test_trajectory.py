@@ -0,0 +1,43 @@
+import numpy as np
+
+import schema
+import trajectory
+
+def _sections(N:int, step:int):
+    posState = schema.POS_STATE.zeros(N)
+    posState['pos'][:, 0] = np.arange(N) + 0.1*step
+    posState['pos'][:, 1] = -0.2*step
+    posState['rot'] = 0.01*step
+    movState = schema.MOV_STATE.zeros(N)
+    movState['vel'][:, 0] = 1.0
+    movState['speed'] = 1.0
+    simState = schema.SIM_STATE.zeros(N)
+    return {'posState' : posState, 'movState' : movState, 'simState' : simState}
+
+def test_empty(tmp_path):
+    path = str(tmp_path/'empty.trj')
+    writer = trajectory.TrajectoryWriter(path, 300, chunkSteps=4, chunkVehicles=256)
+    writer.close()
+    assert writer.file is None
+
+    archive = trajectory.Trajectory(path)
+    assert len(archive) == 0
+    assert archive.chunks.shape == (0, 2)
+    assert len(archive.track(5)) == 0
+    assert list(archive.blocks()) == []
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path/'run.trj')
+    N = 300
+    writer = trajectory.TrajectoryWriter(path, N, chunkSteps=4, chunkVehicles=256)
+    for step in range(10):
+        writer.append(step, step*0.05, _sections(N, step))
+    writer.close()
+
+    archive = trajectory.Trajectory(path)
+    assert len(archive) == 10
+    track = archive.track(270, 2, 7)
+    assert list(track['step']) == [2, 3, 4, 5, 6]
+    assert np.allclose(track['x'], 270 + 0.1*track['step'], atol=1e-3)
+    frame = archive.frame(9)
+    assert np.allclose(frame['y'], -1.8, atol=1e-3)
@@ -0,0 +1,254 @@
+import numpy as np
+import functools
+import zlib
+
+from typing import Dict, Sequence
+
+# Trajectory archive format
+# -------------------------
+# Complete trajectories of a run, compressed about 10x against float32 dumps of
+# the state. Every field is quantized to an integer multiple of its quantum (the
+# error is at most half a quantum and does not drift), the samples are split in
+# chunks of chunkSteps samples by chunkVehicles vehicles and each chunk stores
+# the change of every value since the previous sample of the chunk (the first
+# sample of a chunk is stored as is), byte-shuffled and deflated. Tracks change
+# smoothly so the changes are small and compress well.
+#
+# The file is memory-mapped for reading and only the chunks a query needs are
+# inflated: a track reads one column of chunks, a frame one row.
+#   header  -> magic, version, N, fields, samples, chunkSteps, chunkVehicles,
+#              offset of the tables
+#   chunks  -> deflated int32 [fields, vehicles, steps] of each chunk
+#   tables  -> fields [{name, section, member, component, quantum}]
+#              samples [{step, time}]
+#              chunks [step block, vehicle block] -> {offset in file, size in bytes}
+# The header is written last (on close), a file of an interrupted run cannot be read.
+
+MAGIC = b'FLOCKTRJ'
+VERSION = 1
+ALIGNMENT = 64
+
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('N', '<u4'),
+    ('fields', '<u4'),
+    ('samples', '<u4'),
+    ('chunkSteps', '<u4'),
+    ('chunkVehicles', '<u4'),
+    ('tables', '<u8'),
+])
+
+FIELD = np.dtype([
+    ('name', 'S16'),
+    ('section', 'S16'),
+    ('member', 'S16'),
+    ('component', '<i4'),
+    ('quantum', '<f8'),
+])
+
+SAMPLE = np.dtype([
+    ('step', '<u8'),
+    ('time', '<f8'),
+])
+
+CHUNK = np.dtype([
+    ('offset', '<u8'),
+    ('size', '<u8'),
+])
+
+# Recorded fields, name -> (section, member of the struct, component or -1, quantum)
+# The sections are the per vehicle arrays passed to TrajectoryWriter.append
+FIELDS = {
+    'x' : ('posState', 'pos', 0, 1e-3),
+    'y' : ('posState', 'pos', 1, 1e-3),
+    'rot' : ('posState', 'rot', -1, 1e-4),
+    'vx' : ('movState', 'vel', 0, 1e-3),
+    'vy' : ('movState', 'vel', 1, 1e-3),
+    'speed' : ('movState', 'speed', -1, 1e-3),
+    'angle' : ('movState', 'angle', -1, 1e-4),
+    'collided' : ('simState', 'collided', -1, 1.0),
+}
+
+def _align(offset:int):
+    return (offset + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+def _shuffle(values:np.ndarray):
+    # Bytes of the same significance next to each other (the high bytes of small
+    # changes are mostly 0 or 255)
+    return values.view(np.uint8).reshape(-1, 4).T.tobytes()
+
+def _unshuffle(data:bytes, shape:Sequence[int]):
+    return np.frombuffer(data, dtype=np.uint8).reshape(4, -1).T.copy().view('<i4').reshape(shape)
+
+class TrajectoryWriter():
+    def __init__(self, path:str, N:int, fields:Dict[str, tuple]=FIELDS, chunkSteps:int=64, chunkVehicles:int=256, level:int=6):
+        """ Create trajectory archive
+        parameters:
+            path : str              File to write to
+            N : int                 Amount of vehicles
+            fields : dict           Name -> (section, member, component or -1, quantum)
+                of each recorded field, see FIELDS
+            chunkSteps : int        Samples per chunk
+            chunkVehicles : int     Vehicles per chunk
+            level : int             zlib compression level
+        """
+        self.path = path
+        self.N = N
+        self.fields = dict(fields)
+        self.chunkSteps = chunkSteps
+        self.chunkVehicles = chunkVehicles
+        self.level = level
+        self.samples = []
+        self.chunks = []            # Per step block a list of (offset, size) per vehicle block
+        self.pending = np.zeros([chunkSteps, len(self.fields), N], dtype='<i4')
+        self.count = 0              # Samples in pending
+
+        self.file = open(path, 'wb')
+        self.file.write(bytes(_align(HEADER.itemsize)))
+
+    def append(self, step:int, time:float, sections:Dict[str, np.ndarray]):
+        """ Add a sample of all vehicles
+        parameters:
+            step : int          Step count of the simulation
+            time : float        Elapsed simulation time
+            sections : dict     Section -> per vehicle structured array (ordered by
+                vehicle ID), i.e. {'posState' : sim.vehicleData(sim.posStateBuffer, schema.POS_STATE), ...}
+        """
+        for i, (section, member, component, quantum) in enumerate(self.fields.values()):
+            values = sections[section][member]
+            if component>=0:
+                values = values[:, component]
+            self.pending[self.count, i] = np.rint(values/quantum)
+        self.samples.append((step, time))
+        self.count += 1
+        if self.count == self.chunkSteps:
+            self._flush()
+
+    def close(self):
+        """ Write the remaining samples, the tables and the header
+        """
+        if self.file is None:
+            return
+        if self.count>0:
+            self._flush()
+
+        fields = np.zeros(len(self.fields), dtype=FIELD)
+        for i, (name, (section, member, component, quantum)) in enumerate(self.fields.items()):
+            fields[i] = (name.encode(), section.encode(), member.encode(), component, quantum)
+        samples = np.array(self.samples, dtype=SAMPLE)
+        chunks = np.array(self.chunks, dtype=CHUNK).reshape(len(self.chunks), (self.N + self.chunkVehicles - 1)//self.chunkVehicles)
+
+        tables = _align(self.file.tell())
+        self.file.seek(tables)
+        for table in (fields, samples, chunks):
+            self.file.write(table.tobytes())
+        header = np.zeros(1, dtype=HEADER)
+        header[0] = (MAGIC, VERSION, self.N, len(fields), len(samples), self.chunkSteps, self.chunkVehicles, tables)
+        self.file.seek(0)
+        self.file.write(header.tobytes())
+        self.file.close()
+        self.file = None
+
+    def _flush(self):
+        # Compress the pending samples, one chunk per vehicle block
+        values = self.pending[:self.count].transpose(1, 2, 0)
+        deltas = values.copy()
+        deltas[:, :, 1:] -= values[:, :, :-1]
+        row = []
+        for v in range(0, self.N, self.chunkVehicles):
+            data = zlib.compress(_shuffle(np.ascontiguousarray(deltas[:, v:v+self.chunkVehicles])), self.level)
+            row.append((self.file.tell(), len(data)))
+            self.file.write(data)
+        self.chunks.append(row)
+        self.count = 0
+
+class Trajectory():
+    def __init__(self, path:str, cacheSize:int=64):
+        """ Open a trajectory archive (read only, memory-mapped)
+        parameters:
+            path : str          File to read
+            cacheSize : int     Amount of inflated chunks kept for later queries
+        """
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r')
+        header = self.mm[:HEADER.itemsize].view(HEADER)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError("%s is not a trajectory file"%path)
+        if header['version'] != VERSION:
+            raise ValueError("Trajectory version %d is not supported"%header['version'])
+        self.N = int(header['N'])
+        self.chunkSteps = int(header['chunkSteps'])
+        self.chunkVehicles = int(header['chunkVehicles'])
+
+        offset = int(header['tables'])
+        fields = self.mm[offset:offset+FIELD.itemsize*int(header['fields'])].view(FIELD)
+        offset += fields.nbytes
+        samples = self.mm[offset:offset+SAMPLE.itemsize*int(header['samples'])].view(SAMPLE)
+        offset += samples.nbytes
+        stepBlocks = (len(samples) + self.chunkSteps - 1)//self.chunkSteps
+        vehicleBlocks = (self.N + self.chunkVehicles - 1)//self.chunkVehicles
+        self.chunks = self.mm[offset:offset+CHUNK.itemsize*stepBlocks*vehicleBlocks].view(CHUNK).reshape(stepBlocks, vehicleBlocks)
+
+        self.fields = [f['name'].decode() for f in fields]
+        self.quanta = fields['quantum'].astype('<f4')
+        self.steps = samples['step']
+        self.times = samples['time']
+        self.dtype = np.dtype([(name, '<f4') for name in self.fields])
+        self._chunk = functools.lru_cache(cacheSize)(self._inflate)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def track(self, vehicle:int, start:int=0, stop:int=None):
+        """ Fields of one vehicle over the samples with start <= step < stop
+        Returns a structured array with step, time and the fields (see FIELDS)
+        """
+        first, last = np.searchsorted(self.steps, [start, stop if stop is not None else np.iinfo('<u8').max])
+        track = np.zeros(last-first, dtype=[('step', '<u8'), ('time', '<f8')] + self.dtype.descr)
+        track['step'] = self.steps[first:last]
+        track['time'] = self.times[first:last]
+        block, v = divmod(vehicle, self.chunkVehicles)
+        for s in range(first//self.chunkSteps, (last + self.chunkSteps - 1)//self.chunkSteps):
+            begin = max(first, s*self.chunkSteps)
+            end = min(last, (s+1)*self.chunkSteps)
+            values = self._chunk(s, block)[:, v, begin - s*self.chunkSteps:end - s*self.chunkSteps]
+            for i, name in enumerate(self.fields):
+                track[name][begin-first:end-first] = values[i]*self.quanta[i]
+        return track
+
+    def frame(self, step:int):
+        """ Fields of all vehicles (by ID) at the sample of step
+        Returns a structured array of the fields (see FIELDS)
+        """
+        sample = int(np.searchsorted(self.steps, step))
+        if sample == len(self.steps) or self.steps[sample] != step:
+            raise KeyError("Step %d was not recorded"%step)
+        s, k = divmod(sample, self.chunkSteps)
+        frame = np.zeros(self.N, dtype=self.dtype)
+        for block in range(self.chunks.shape[1]):
+            values = self._chunk(s, block)[:, :, k]
+            for i, name in enumerate(self.fields):
+                frame[name][block*self.chunkVehicles:(block+1)*self.chunkVehicles] = values[i]*self.quanta[i]
+        return frame
+
+    def blocks(self):
+        """ Iterate over the samples of all vehicles one step block at a time
+        Yields steps, times and a structured array [samples, N] of the fields, so
+        a whole run can be processed in memory of one block (see metrics.py)
+        """
+        for s in range(self.chunks.shape[0]):
+            first, last = s*self.chunkSteps, min((s+1)*self.chunkSteps, len(self.steps))
+            frames = np.zeros([last-first, self.N], dtype=self.dtype)
+            for block in range(self.chunks.shape[1]):
+                values = self._inflate(s, block)
+                for i, name in enumerate(self.fields):
+                    frames[name][:, block*self.chunkVehicles:(block+1)*self.chunkVehicles] = values[i].T*self.quanta[i]
+            yield self.steps[first:last], self.times[first:last], frames
+
+    def _inflate(self, s:int, block:int):
+        # Quantized values [fields, vehicles, steps] of a chunk
+        offset, size = int(self.chunks[s, block]['offset']), int(self.chunks[s, block]['size'])
+        steps = min(self.chunkSteps, len(self.steps) - s*self.chunkSteps)
+        vehicles = min(self.chunkVehicles, self.N - block*self.chunkVehicles)
+        deltas = _unshuffle(zlib.decompress(self.mm[offset:offset+size]), (len(self.fields), vehicles, steps))
+        return np.cumsum(deltas, axis=2, dtype='<i4')
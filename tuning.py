@@ -0,0 +1,204 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import graphics as gr
+import schema
+
+import OpenGL.GL as gl
+import numpy as np
+import json
+import os
+import time
+
+from typing import Callable, Dict, Sequence, Tuple
+
+# Workgroup size autotuning
+# -------------------------
+# The best local size of the heavy kernels differs per GPU (and for the llvmpipe
+# CPU rasterizer). On the first run on a device (GL_RENDERER) each kernel is
+# compiled with each candidate local size and timed on a synthetic world. The
+# winners are stored in a profile file and the kernels are compiled with them on
+# later runs. The enabled features change the kernels (#defines), so each set of
+# features is tuned separately. Delete the entry of a device (or the file) to
+# tune again.
+#
+# Profile (json): {"renderer features" : {stage file : [local size x, local size y]}}
+#   features -> the enabled features sorted and joined by ',' (see simulation.FEATURES)
+# The sizes are injected as LOCAL_SIZE_X/LOCAL_SIZE_Y #defines (see the kernels)
+
+PROFILE = 'tuning.json'
+
+# Tuned kernels, stage file -> (files of the program, dimensions of the dispatch)
+KERNELS = {
+    'shaders/distance.comp' : (('shaders/distance.glsl', 'shaders/distance.comp'), 2),
+    'shaders/collision.comp' : (('shaders/collision.comp',), 1),
+    'shaders/algorithm.comp' : (('shaders/algorithm.comp',), 1),
+    'shaders/vehiclemovement.comp' : (('shaders/vehiclemovement.comp',), 1),
+}
+
+# Candidate local sizes by dimensions, the 2D candidates also vary the tile shape
+CANDIDATES = {
+    1 : [(1, 1), (32, 1), (64, 1), (128, 1), (256, 1), (512, 1)],
+    2 : [(1, 1), (8, 8), (16, 16), (32, 8), (8, 32), (64, 1), (1, 64), (32, 32)],
+}
+
+def renderer():
+    """ Name of the device of the current context
+    """
+    return gl.glGetString(gl.GL_RENDERER).decode()
+
+def _key(features:Sequence[str]):
+    # Profile entry of the current device with the features
+    return '%s %s'%(renderer(), ','.join(sorted(features)))
+
+def load(path:str=PROFILE, features:Sequence[str]=()):
+    """ Local sizes of the current device and features from the profile, None if they are not tuned yet
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        sizes = json.load(f).get(_key(features))
+    if sizes is None:
+        return None
+    return {file:tuple(size) for file, size in sizes.items()}
+
+def save(sizes:Dict[str, Tuple[int, int]], path:str=PROFILE, features:Sequence[str]=()):
+    """ Store the local sizes of the current device and features in the profile (other entries are kept)
+    """
+    profile = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profile = json.load(f)
+    profile[_key(features)] = {file:list(size) for file, size in sizes.items()}
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+
+def tune(compile:Callable, N:int=2048, M:int=64, repeats:int=10):
+    """ Time the candidate local sizes of each kernel, returns the fastest of each
+    The synthetic world is unbound and released afterwards, bind the buffers of the
+    simulation again before dispatching
+    parameters:
+        compile : function  compile(files, localSize) -> gr.ShaderProgram
+        N, M : int          Amount of vehicles and walls of the synthetic world
+        repeats : int       Amount of timed dispatches per candidate
+    """
+    world = _SyntheticWorld(N, M)
+    try:
+        return _time(compile, world, N, M, repeats)
+    finally:
+        world.release()
+
+def _time(compile:Callable, world:'_SyntheticWorld', N:int, M:int, repeats:int):
+    # Fastest candidate of each kernel on the bound synthetic world
+    maxInvocations = int(gl.glGetIntegerv(gl.GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS))
+
+    sizes = {}
+    for file, (files, dimensions) in KERNELS.items():
+        invocations = (N, N+M) if dimensions == 2 else (N,)
+        best = None
+        for size in CANDIDATES[dimensions]:
+            if size[0]*size[1] > maxInvocations:
+                continue
+            program = compile(files, size)
+            if not program.linked:
+                continue
+
+            # Same state for each candidate, the first dispatch is not timed (warm up)
+            world.reset()
+            program.dispatchInvocations(*invocations)
+            gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+            gl.glFinish()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                program.dispatchInvocations(*invocations)
+                gl.glMemoryBarrier(gl.GL_SHADER_STORAGE_BARRIER_BIT)
+            gl.glFinish()
+            elapsed = (time.perf_counter() - start)/repeats
+
+            logger.info("%s %dx%d: %.3f ms"%(file, size[0], size[1], elapsed*1000))
+            if best is None or elapsed < best[0]:
+                best = (elapsed, size)
+        if best is not None:
+            sizes[file] = best[1]
+    return sizes
+
+class _SyntheticWorld():
+    # Random vehicles and walls in a square of about 100m2 per vehicle, bound to
+    # the bindings of the simulation (see shaders/header.glsl)
+    def __init__(self, N:int, M:int):
+        # Imported here, simulation imports this module
+        from simulation import (BIND_GLOBALS, BIND_POS_STATE, BIND_MOV_STATE, BIND_SIM_STATE, BIND_DISTANCE,
+            BIND_WALL_POS, BIND_WALL_INFO, BIND_DEBUG, BIND_INTERNAL_DATA, BIND_COLLISION_COUNT,
+            BIND_COLLISION_EVENT, BIND_TIME_STEP)
+
+        rng = np.random.default_rng(0)
+        size = np.sqrt(N)*10.0
+
+        self.posState = schema.POS_STATE.zeros(N)
+        self.posState['pos'][:, 0:2] = rng.uniform(0.0, size, (N, 2))
+        self.posState['rot'] = rng.uniform(0.0, 2*np.pi, N)
+        self.movState = schema.MOV_STATE.zeros(N)
+        self.movState['vel'][:, 0] = 10.0*np.sin(self.posState['rot'])
+        self.movState['vel'][:, 1] = 10.0*np.cos(self.posState['rot'])
+        self.movState['dvel'] = self.movState['vel']
+        self.simState = schema.SIM_STATE.zeros(N)
+        walls = rng.uniform(0.0, size, (M, 4)).astype("f")
+
+        globalSettings = np.zeros([(schema.GLOBALS.size+63)//64, 4, 4], dtype="f")
+        settings = schema.GLOBALS.view(globalSettings)
+        settings.uN = N
+        settings.uM = M
+        settings.uDeltaTime = 0.05
+        settings.uw_coh = 0.1
+        settings.uw_ali = 6.0
+        settings.uw_sep = 3.0
+        settings.ud_v = 15.0
+        settings.ud_s = 10.0
+        settings.dphi_max = np.pi/360*37
+        settings.phi_max = np.pi/360*37
+
+        def storage(length):
+            buffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+            buffer.reserveData(length)
+            return buffer
+
+        self.globalSettingsBuffer = gr.Buffer(gr.UNIFORM_BUFFER, gr.DYNAMIC_DRAW)
+        self.globalSettingsBuffer.reserveData(schema.GLOBALS.size)
+        settings.markDirty()
+        settings.upload(self.globalSettingsBuffer)
+        self.wallBuffer = gr.Buffer(gr.SHADER_STORAGE_BUFFER, gr.STATIC_DRAW)
+        self.wallBuffer.setData(walls)
+        self.posStateBuffer = storage(N*schema.POS_STATE.size)
+        self.movStateBuffer = storage(N*schema.MOV_STATE.size)
+        self.simStateBuffer = storage(N*schema.SIM_STATE.size)
+        self.collisionCountBuffer = storage(4)
+        self.buffers = {
+            BIND_GLOBALS : self.globalSettingsBuffer,
+            BIND_POS_STATE : self.posStateBuffer,
+            BIND_MOV_STATE : self.movStateBuffer,
+            BIND_SIM_STATE : self.simStateBuffer,
+            BIND_DISTANCE : storage(N*(N+M)*schema.DISTANCE_STATE.size),
+            BIND_WALL_POS : self.wallBuffer,
+            BIND_WALL_INFO : storage(M*schema.WALL_INFO.size),
+            BIND_DEBUG : storage(N*16*4),
+            BIND_INTERNAL_DATA : storage(N*schema.INTERNAL_DATA.size),
+            BIND_COLLISION_COUNT : self.collisionCountBuffer,
+            BIND_COLLISION_EVENT : storage(1024*schema.COLLISION_EVENT.size),
+            BIND_TIME_STEP : storage(schema.TIME_STEP.size),
+        }
+        for binding, buffer in self.buffers.items():
+            buffer.bindBase(binding)
+
+    def reset(self):
+        self.posStateBuffer.subData(self.posState)
+        self.movStateBuffer.subData(self.movState)
+        self.simStateBuffer.subData(self.simState)
+        self.collisionCountBuffer.subData(np.zeros(1, dtype="uint32"))
+
+    def release(self):
+        # Unbind the buffers and drop them (deleted with the last reference)
+        for binding, buffer in self.buffers.items():
+            gl.glBindBufferBase(buffer.type, binding, 0)
+        self.buffers = {}
+        self.globalSettingsBuffer = self.wallBuffer = self.collisionCountBuffer = None
+        self.posStateBuffer = self.movStateBuffer = self.simStateBuffer = None
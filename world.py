@@ -0,0 +1,158 @@
+import numpy as np
+
+import hashlib
+import os
+import csv
+
+import schema
+
+# World loading
+# -------------
+# Reads the world files (.wls with the walls and .spn with the spawn points, see
+# README.md) in bulk into numpy arrays and builds the initial posState, movState
+# and simState arrays of all vehicles at once. The compiled result is cached as
+# an .npz file keyed by the hash of the source files so repeated runs on the same
+# world start almost instantly.
+
+CACHE_DIR = '.worldcache'
+CACHE_VERSION = 1
+
+def _readCSV(path:str, columns:int):
+    # Rows starting with '#' are comments (as in MapBuilder)
+    data = np.loadtxt(path, delimiter=',', comments='#', dtype='f8', ndmin=2)
+    if data.size == 0:
+        return np.zeros([0, columns], dtype='f8')
+    return data[:, :columns]
+
+def parse(file:str):
+    """ Parse the world files
+    parameters:
+        file : str      Name of the world files without extension
+    returns:
+        walls : np.ndarray      [{startx, starty, endx, endy}] (M,4)
+        spawns : np.ndarray     [{spawnx, spawny, directionx, directiony, rate, speed}] (S,6)
+    """
+    walls = _readCSV(file + '.wls', 4)
+    spawns = _readCSV(file + '.spn', 6)
+    return walls, spawns
+
+def export(file:str, walls:np.ndarray, spawns:np.ndarray):
+    """ Write world files in the format of MapBuilder.export
+    parameters:
+        file : str              Name of the world files without extension
+        walls : np.ndarray      (M,4) wall vertices
+        spawns : np.ndarray     (S,6) spawn points
+    """
+    with open(file + '.spn', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerows(np.asarray(spawns).reshape(-1, 6).tolist())
+
+    with open(file + '.wls', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerows(np.asarray(walls).reshape(-1, 4).tolist())
+
+class World():
+    def __init__(self, walls:np.ndarray, posState:np.ndarray, movState:np.ndarray, simState:np.ndarray):
+        """ Compiled world: the initial state of all vehicles and the walls
+        Use World.init as algoInit function of the simulation
+        """
+        self.walls = np.ascontiguousarray(walls, dtype='f')
+        self.posState = posState
+        self.movState = movState
+        self.simState = simState
+        self.N = len(posState)
+        self.M = len(walls)
+
+    def wallVertices(self):
+        return self.walls.reshape(-1)
+
+    def init(self, sim):
+        """ algoInit function
+        Uploads the vehicle states and returns the wall vertices and simState
+        """
+        sim.posStateBuffer.setData(self.posState)
+        sim.movStateBuffer.setData(self.movState)
+        return self.wallVertices().copy(), self.simState.copy()
+
+    def save(self, path:str):
+        np.savez(path, walls=self.walls, posState=self.posState, movState=self.movState, simState=self.simState)
+
+    @staticmethod
+    def load(path:str):
+        with np.load(path) as f:
+            return World(f['walls'], f['posState'], f['movState'], f['simState'])
+
+def build(walls:np.ndarray, spawns:np.ndarray, simtime:int):
+    """ Build the initial state of all vehicles
+    Each spawn point spawns a vehicle every int(60/rate) frames from frame 0 up to
+    simtime (the rate must be in (0, 60]). The vehicles are ordered per spawn
+    point, then by start frame.
+    parameters:
+        walls : np.ndarray      (M,4) wall vertices
+        spawns : np.ndarray     (S,6) spawn points
+        simtime : int           Simulation time in frames
+    """
+    spawns = np.asarray(spawns, dtype='f8').reshape(-1, 6)
+    rates = spawns[:, 4]
+    invalid = ~((rates>0) & (rates<=60))
+    if np.any(invalid):
+        raise ValueError("Spawn rates must be in (0, 60], got %s"%rates[invalid])
+    period = (60/spawns[:, 4]).astype(np.int64)
+    counts = (simtime + period - 1)//period
+    counts[counts<0] = 0
+    N = int(counts.sum())
+
+    # Index of the spawn point and the number of the vehicle at that spawn point
+    spawn = np.repeat(np.arange(len(spawns)), counts)
+    first = np.cumsum(counts) - counts
+    number = np.arange(N) - first[spawn]
+
+    center = spawns[spawn, 0:2]
+    pointer = spawns[spawn, 2:4]
+    speed = spawns[spawn, 5]
+    rot = np.arctan2(pointer[:, 1]-center[:, 1], pointer[:, 0]-center[:, 0])
+
+    posState = schema.POS_STATE.zeros(N)
+    posState['pos'][:, 0:2] = center
+    posState['pos'][:, 3] = 1.0
+    posState['rot'] = rot - np.pi/2
+
+    movState = schema.MOV_STATE.zeros(N)
+    movState['vel'][:, 0] = np.cos(rot)*speed
+    movState['vel'][:, 1] = np.sin(rot)*speed
+    movState['dvel'] = movState['vel']
+
+    simState = schema.SIM_STATE.zeros(N)
+    simState['start'] = number*period[spawn]
+
+    return World(np.asarray(walls, dtype='f').reshape(-1, 4), posState, movState, simState)
+
+def _key(file:str, simtime:int):
+    h = hashlib.sha1()
+    for ext in ('.wls', '.spn'):
+        with open(file + ext, 'rb') as f:
+            h.update(f.read())
+    # Layout changes in schema.py invalidate the cache as well
+    h.update(('%d,%d,%d,%d,%d'%(simtime, CACHE_VERSION, schema.POS_STATE.size, schema.MOV_STATE.size, schema.SIM_STATE.size)).encode())
+    return h.hexdigest()
+
+def load(file:str, simtime:int, cache:bool=True, cacheDir:str=CACHE_DIR):
+    """ Load a world, using the compiled world cache if possible
+    parameters:
+        file : str          Name of the world files without extension
+        simtime : int       Simulation time in frames
+        cache : bool        Use and fill the compiled world cache
+        cacheDir : str      Directory of the cache
+    """
+    path = None
+    if cache:
+        path = os.path.join(cacheDir, '%s-%s.npz'%(os.path.basename(file), _key(file, simtime)[:16]))
+        if os.path.exists(path):
+            return World.load(path)
+
+    w = build(*parse(file), simtime)
+
+    if path is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        w.save(path)
+    return w